@@ -2,11 +2,19 @@
 Application to enter the meta data for each link in the network
 
 """
+import sys
+
+sys.path.append("../scripts")
+
 import tkinter as tk
 from tkinter import messagebox
 from pymongo import MongoClient
+import pandas as pd
 import json
 
+from import_links import prepare_links, make_feature
+from db_utils import bump_metadata_version
+
 
 def clear_placeholder(event):
     current_text = coords_text.get("1.0", "end-1c")
@@ -16,8 +24,8 @@ def clear_placeholder(event):
 
 # MongoDB connection (Local)
 client = MongoClient('mongodb://localhost:27017/')
-db = client['microwave_links']
-collection = db['links']
+db = client['cml']
+collection = db['cml_metadata']
 
 # Function to insert data
 
@@ -43,38 +51,46 @@ def insert_data():
     mibs = mibs_entry.get().split(',')
     oids = oids_entry.get().split(',')
 
-    # Check if the link_id and sublink_id combination already exists in the database
-    existing_link = collection.find_one(
-        {"properties.link_id": link_id, "properties.sublink_id": sublink_id})
+    # Device that is polled over SNMP for the OIDs
+    host = host_entry.get().strip()
+
+    # Check if the link_id already exists in the database
+    existing_link = collection.find_one({"properties.link_id": int(link_id)}) if link_id.isdigit() else None
 
     if existing_link:
         messagebox.showerror(
-            'Error', 'This Link ID and Sublink ID combination already exists in the database.')
+            'Error', 'This Link ID already exists in the database.')
         return
 
-    # Create the geoJSON structure
-    geojson_data = {
-        "type": "Feature",
-        "geometry": {
-            "type": "LineString",
-            "coordinates": coordinates
-        },
-        "properties": {
+    # Create the geoJSON structure with the midpoint and length, as for a bulk import
+    try:
+        row = {
             "link_id": link_id,
+            "lon1": coordinates[0][0],
+            "lat1": coordinates[0][1],
+            "lon2": coordinates[1][0],
+            "lat2": coordinates[1][1],
+            "frequency": frequency_value,
             "sublink_id": sublink_id,
             "radome": radome,
-            "frequency": {
-                "value": float(frequency_value),
-                "units": frequency_units
-            },
-            "MIB": mibs,
-            "OID": oids
+            "host": host,
         }
-    }
+    except (IndexError, TypeError) as e:
+        messagebox.showerror('Error', f'Invalid coordinates format: {e}')
+        return
+    links, rejected = prepare_links(pd.DataFrame([row]))
+    if rejected:
+        messagebox.showerror('Error', f'Invalid link: {rejected[0]["reason"]}')
+        return
+    geojson_data = make_feature(links.to_dict("records")[0])
+    geojson_data["properties"]["frequency"]["units"] = frequency_units
+    geojson_data["properties"]["MIB"] = mibs
+    geojson_data["properties"]["OID"] = oids
 
     try:
         # Insert into MongoDB
         collection.insert_one(geojson_data)
+        bump_metadata_version(db['cml_state'])
         messagebox.showinfo('Success', 'Link data inserted successfully!')
     except Exception as e:
         messagebox.showerror('Error', f'Failed to insert data: {e}')
@@ -132,8 +148,13 @@ tk.Label(root, text="OIDs (comma-separated)").grid(row=6, column=0)
 oids_entry = tk.Entry(root)
 oids_entry.grid(row=6, column=1)
 
+# SNMP host
+tk.Label(root, text="Host (SNMP)").grid(row=7, column=0)
+host_entry = tk.Entry(root)
+host_entry.grid(row=7, column=1)
+
 # Submit Button
 submit_btn = tk.Button(root, text="Submit", command=insert_data)
-submit_btn.grid(row=7, columnspan=4)
+submit_btn.grid(row=8, columnspan=4)
 
 root.mainloop()
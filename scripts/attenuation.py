@@ -6,7 +6,8 @@
 import sys
 
 sys.path.append("../scripts")
-from db_utils import get_cmls, is_valid_power
+from db_utils import get_cmls, valid_power, get_dirty_times, get_watermark, set_watermark, is_same
+from db_utils import get_neighbours, RAIN_CLASS_RANGE, QC_REJECT
 
 import concurrent.futures
 import pandas as pd
@@ -16,32 +17,24 @@ import numpy as np
 import os
 import argparse
 from datetime import datetime
-import math
 
 import logging
 logging.basicConfig(format = '%(asctime)s %(message)s',level=logging.INFO) 
 
-def calc_atten(doc: dict) -> float:
+def calc_atten(p_min: np.ndarray, p_ref: np.ndarray, qc: np.ndarray) -> np.ndarray:
     """
-    Calculate the attenuation.
+    Calculate the attenuation for a set of records.
 
     Args:
-        doc (dict): document from the cml[data] database.
+        p_min (np.ndarray): p_min in dBm, NaN for no data
+        p_ref (np.ndarray): reference power in dBm, NaN for no data
+        qc (np.ndarray): QC bits of the records, 0 if they have not been checked
 
     Returns:
-        float: attenuation in dBm or NaN.
-    """    
-    p_min = doc.get("power", {}).get("p_min")
-    p_ref = doc.get("atten", {}).get("p_ref")
-    
-    if p_min is not None and p_ref is not None:
-        p_min = float(p_min)
-        p_ref = float(p_ref)
-
-        if is_valid_power(p_min) and is_valid_power(p_ref):
-            return p_ref - p_min
-
-    return float("NaN")
+        np.ndarray: attenuation in dBm, NaN if a power is not valid or the record failed the QC
+    """
+    valid = valid_power(p_min) & valid_power(p_ref) & ((qc & QC_REJECT) == 0)
+    return np.where(valid, p_ref - p_min, np.nan)
 
 def valid_date(s: str) -> np.datetime64:
     """
@@ -62,7 +55,8 @@ def valid_date(s: str) -> np.datetime64:
         raise argparse.ArgumentTypeError(f"Not a valid date: {s!r}") from e
 
 
-def calculate_attenuation(ref_time:datetime, cmls:pd.DataFrame, data_col:pymongo.collection.Collection):
+def calculate_attenuation(ref_time:datetime, cmls:pd.DataFrame, data_col:pymongo.collection.Collection, incremental:bool=True,
+                          neighbour_cmls:pd.DataFrame=None):
     """
     Calculate the attenuation for a set of links at a time
     Assumes that the reference power has been calculated 
@@ -71,41 +65,70 @@ def calculate_attenuation(ref_time:datetime, cmls:pd.DataFrame, data_col:pymongo
         ref_time (datetime): _description_
         cml (dict): Dictionary of link metadata in the area of interest 
         data_col (pymongo.collection.Collection): _description_
+        incremental (bool): Only process the records flagged with dirty.atten
+        neighbour_cmls (pd.DataFrame): Links to search for neighbours, e.g. a partition and its halo. Defaults to cmls.
     """
+    if neighbour_cmls is None:
+        neighbour_cmls = cmls
     links = cmls["link_id"].values.astype(int).tolist() 
     query = {"link_id":{"$in":links}, "time.end_time":ref_time}
-    projection = {"link_id":1, "power":1, "atten":1,"_id":0}
-    number_links = data_col.count_documents(filter=query)
+    if incremental:
+        query["dirty.atten"] = True
+    projection = {"link_id":1, "power":1, "atten":1, "qc":1, "_id":0}
+    docs = list(data_col.find(filter=query, projection=projection))
+    number_links = len(docs)
 
     # no links found so return 
     if number_links == 0:
         return 
-    
+
+    # calculate the attenuation for all the records at once
+    link_ids = np.array([doc["link_id"] for doc in docs])
+    p_min = np.array([doc.get("power", {}).get("p_min") for doc in docs], dtype=float)
+    p_ref = np.array([doc.get("atten", {}).get("p_ref") for doc in docs], dtype=float)
+    qc = np.array([doc.get("qc", 0) for doc in docs], dtype=np.int64)
+    length = cmls.set_index("link_id")["length"].reindex(link_ids).values / 1000.0  # length in km
+
+    atten = calc_atten(p_min, p_ref, qc)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        s_atten = np.where(length > 0, atten / length, np.nan)  # specific attenuation
+    atten[np.isnan(s_atten)] = np.nan
+
     max_updates = 1000 
     updates = [] 
-    for doc in data_col.find(filter=query, projection=projection): 
-        link_id = doc["link_id"] 
-        length = float(cmls.loc[cmls["link_id"] == link_id]["length"]) / 1000.0  # length in km
-
-        atten = calc_atten(doc)
-        if not math.isnan(atten) and length > 0:
-            s_atten = atten / length  # specific attenuation
-            atten_doc = {"atten.atten": atten, "atten.s_atten": s_atten}
-
-            # Prepare bulk update
-            updates.append(pymongo.UpdateOne(
-                {"link_id": link_id, "time.end_time": ref_time},
-                {"$set": atten_doc},
-                upsert=True
-            ))
-            if len(updates) > max_updates:
-                data_col.bulk_write(updates)
-                updates = []
+    changed_links = []
+    for doc, link_id, link_atten, link_s_atten in zip(docs, link_ids.tolist(), atten.tolist(), s_atten.tolist()):
+        atten_doc = {"atten.atten": link_atten, "atten.s_atten": link_s_atten, "dirty.atten": False}
+
+        # a change in the attenuation changes the rain rate for this link
+        # and the rain classification in the neighbourhood
+        old_s_atten = doc.get("atten", {}).get("s_atten")
+        if not is_same(doc.get("atten", {}).get("atten"), link_atten) or not is_same(old_s_atten, link_s_atten):
+            atten_doc["dirty.rain"] = True
+            changed_links.append(link_id)
+
+        # Prepare bulk update
+        updates.append(pymongo.UpdateOne(
+            {"link_id": link_id, "time.end_time": ref_time},
+            {"$set": atten_doc},
+            upsert=True
+        ))
+        if len(updates) > max_updates:
+            data_col.bulk_write(updates)
+            updates = []
 
     # Perform bulk write operation if there are updates
     if updates:
         data_col.bulk_write(updates)
 
+    # Flag the rain classification for the neighbours of the links that have changed
+    neighbours = get_neighbours(neighbour_cmls, changed_links, RAIN_CLASS_RANGE)
+    if neighbours:
+        data_col.update_many(
+            {"link_id": {"$in": neighbours}, "time.end_time": ref_time},
+            {"$set": {"dirty.has_rain": True}},
+        )
+
     logging.info(f"Updated attenuation at {number_links} links at {ref_time}")
 
 
@@ -117,9 +140,11 @@ def main():
         formatter_class=argparse.ArgumentDefaultsHelpFormatter,
     )
     parser.add_argument("-s", "--start", type=valid_date,
-                        help="Start date yyyy-mm-dd")
+                        help="Start date yyyy-mm-dd, default is the first dirty record")
     parser.add_argument("-e", "--end", type=valid_date,
-                        help="End date yyyy-mm-dd")
+                        help="End date yyyy-mm-dd, default is the p_ref watermark")
+    parser.add_argument("-a", "--all", action="store_true",
+                        help="Process every time step between start and end, not just the dirty records")
     args = parser.parse_args()
 
 
@@ -141,6 +166,7 @@ def main():
     db = myclient["cml"]
     cml_col = db["cml_metadata"]
     data_col = db["cml_data"]
+    state_col = db["cml_state"]
 
     # get a list of the cmls in the area that we are working with
     longitude = 4.0
@@ -153,11 +179,23 @@ def main():
     logging.info(f"Start date = {start_time}")
     logging.info(f"End date = {end_time}")
 
-    start_time_dt = pd.to_datetime(start_time).to_pydatetime()
-    end_time_dt = pd.to_datetime(end_time).to_pydatetime()
-    times = pd.date_range(start=start_time_dt, end=end_time_dt, freq="15min")
+    start_time_dt = None if start_time is None else pd.to_datetime(start_time).to_pydatetime()
+    end_time_dt = None if end_time is None else pd.to_datetime(end_time).to_pydatetime()
+    if args.all:
+        if start_time_dt is None or end_time_dt is None:
+            parser.error("--all needs --start and --end")
+        times = pd.date_range(start=start_time_dt, end=end_time_dt, freq="15min")
+    else:
+        # do not go past the time steps that have a reference power
+        if end_time_dt is None:
+            end_time_dt = get_watermark(state_col, "p_ref")
+        links = cmls["link_id"].values.astype(int).tolist()
+        times = get_dirty_times(data_col, "atten", links, start_time_dt, end_time_dt)
+    logging.info(f"Processing {len(times)} time steps")
+
     for ref_time in times:
-        calculate_attenuation(ref_time, cmls, data_col)
+        calculate_attenuation(ref_time, cmls, data_col, incremental=not args.all)
+        set_watermark(state_col, "atten", ref_time)
 
 
 if __name__ == "__main__":
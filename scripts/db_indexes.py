@@ -0,0 +1,377 @@
+"""
+    Canonical indexes for the cml database
+
+    Applies any missing indexes and checks that the queries used by each stage
+    are supported by an index by running explain() on the real query shapes.
+    Exits with status 1 if a query uses a collection scan or examines too many
+    documents for each document that is returned.
+
+"""
+import sys
+
+sys.path.append("../scripts")
+
+import argparse
+import logging
+from datetime import timedelta
+
+import pymongo
+import pymongo.collection
+import pymongo.database
+
+from db_utils import STAGES, P_REF_WINDOW, RAIN_CLASS_RANGE, EARTH_RADIUS, MIN_LENGTH, MAX_LENGTH, MIN_FREQUENCY, MAX_FREQUENCY
+from db_utils import qc_filter
+
+logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
+
+# Indexes for the time series data
+# Most stages query one time step for a list of links, calc_p_ref queries the dry
+# records for one link over 24 h, and cml_interpolate queries the records with rain
+DATA_INDEXES = [
+    pymongo.IndexModel(
+        [("link_id", pymongo.ASCENDING), ("time.end_time", pymongo.ASCENDING)],
+        name="link_id_time",
+    ),
+    pymongo.IndexModel(
+        [("time.end_time", pymongo.ASCENDING), ("link_id", pymongo.ASCENDING)],
+        name="time_link_id",
+    ),
+    pymongo.IndexModel(
+        [("link_id", pymongo.ASCENDING), ("time.end_time", pymongo.ASCENDING)],
+        name="dry_link_id_time",
+        partialFilterExpression={"atten.has_rain": False},
+    ),
+    pymongo.IndexModel(
+        [("time.end_time", pymongo.ASCENDING), ("link_id", pymongo.ASCENDING)],
+        name="s_atten_time_link_id",
+        partialFilterExpression={"atten.s_atten": {"$type": "double"}},
+    ),
+    pymongo.IndexModel(
+        [("time.end_time", pymongo.ASCENDING), ("link_id", pymongo.ASCENDING)],
+        name="rain_time_link_id",
+        partialFilterExpression={"rain": {"$exists": True}},
+    ),
+] + [
+    # one small index per stage that only holds the records waiting for that stage
+    pymongo.IndexModel(
+        [("time.end_time", pymongo.ASCENDING), ("link_id", pymongo.ASCENDING)],
+        name=f"dirty_{stage}",
+        partialFilterExpression={f"dirty.{stage}": True},
+    )
+    for stage in STAGES
+]
+
+# Indexes for the link metadata
+METADATA_INDEXES = [
+    pymongo.IndexModel(
+        [("properties.link_id", pymongo.ASCENDING)], name="link_id", unique=True
+    ),
+    pymongo.IndexModel(
+        [("properties.midpoint", pymongo.GEOSPHERE)], name="midpoint_location"
+    ),
+]
+
+# Indexes for the daily summaries written by retention.py, the summaries expire
+# after DAILY_TTL and retention.py changes this with collMod
+DAILY_TTL = 10 * 365 * 86400  # s
+DAILY_INDEXES = [
+    pymongo.IndexModel(
+        [("link_id", pymongo.ASCENDING), ("date", pymongo.ASCENDING)], name="link_id_date"
+    ),
+    pymongo.IndexModel(
+        [("date", pymongo.ASCENDING)], name="date_ttl", expireAfterSeconds=DAILY_TTL
+    ),
+]
+
+CANONICAL_INDEXES = {
+    "cml_data": DATA_INDEXES,
+    "cml_metadata": METADATA_INDEXES,
+    "cml_daily": DAILY_INDEXES,
+}
+
+
+def index_kind(collection_name: str) -> str:
+    """
+    Return the type of collection for a collection name, so that copies such as
+    cml_test_data get the same indexes as cml_data
+
+    Args:
+        collection_name (str): Name of the collection
+
+    Returns:
+        str: Key into CANONICAL_INDEXES
+    """
+    if collection_name.endswith("metadata"):
+        return "cml_metadata"
+    if collection_name.endswith("daily"):
+        return "cml_daily"
+    return "cml_data"
+
+
+def apply_indexes(col: pymongo.collection.Collection, kind: str = None) -> list:
+    """
+    Create the canonical indexes that are missing from a collection.
+    Existing indexes with the same name are left alone, so this can be run at any time.
+
+    Args:
+        col (pymongo.collection.Collection): Collection to be indexed
+        kind (str, optional): Key into CANONICAL_INDEXES. Defaults to the type from the name.
+
+    Returns:
+        list: Names of the indexes that were created
+    """
+    if kind is None:
+        kind = index_kind(col.name)
+    existing = col.index_information()
+
+    missing = []
+    for index in CANONICAL_INDEXES[kind]:
+        name = index.document["name"]
+        if name in existing:
+            if existing[name]["key"] != list(index.document["key"].items()):
+                logging.warning(f"{col.name}.{name} exists with a different key {existing[name]['key']}")
+            continue
+        missing.append(index)
+
+    if missing:
+        created = col.create_indexes(missing)
+        logging.info(f"Created {created} on {col.name}")
+        return created
+    return []
+
+
+def extra_indexes(col: pymongo.collection.Collection, kind: str = None) -> list:
+    """
+    Return the indexes on a collection that are not in the canonical set
+
+    Args:
+        col (pymongo.collection.Collection): Collection to check
+        kind (str, optional): Key into CANONICAL_INDEXES. Defaults to the type from the name.
+
+    Returns:
+        list: Names of the extra indexes
+    """
+    if kind is None:
+        kind = index_kind(col.name)
+    names = {index.document["name"] for index in CANONICAL_INDEXES[kind]}
+    names.add("_id_")
+    return [name for name in col.index_information() if name not in names]
+
+
+def plan_stages(plan: dict) -> list:
+    """
+    Return the names of all the stages in a query plan
+
+    Args:
+        plan (dict): winningPlan from explain()
+
+    Returns:
+        list: Stage names, e.g. IXSCAN, FETCH, COLLSCAN
+    """
+    stages = []
+    if "stage" in plan:
+        stages.append(plan["stage"])
+    for key in ["inputStage", "queryPlan", "outerStage", "innerStage"]:
+        if key in plan:
+            stages += plan_stages(plan[key])
+    for sub_plan in plan.get("inputStages", []):
+        stages += plan_stages(sub_plan)
+    return stages
+
+
+def explain_query(db: pymongo.database.Database, command: dict) -> dict:
+    """
+    Run explain() with execution statistics on a find or distinct command
+
+    Args:
+        db (pymongo.database.Database): Database
+        command (dict): find or distinct command
+
+    Returns:
+        dict: Stages in the winning plan, documents examined and returned
+    """
+    result = db.command({"explain": command, "verbosity": "executionStats"})
+    plan = result["queryPlanner"]["winningPlan"]
+    stats = result["executionStats"]
+    return {
+        "stages": plan_stages(plan),
+        "docs_examined": stats["totalDocsExamined"],
+        "keys_examined": stats["totalKeysExamined"],
+        "returned": stats["nReturned"],
+    }
+
+
+def query_shapes(db: pymongo.database.Database, data_name: str, metadata_name: str) -> dict:
+    """
+    Build the queries used by each stage, using a time step and links from the data
+
+    Args:
+        db (pymongo.database.Database): Database
+        data_name (str): Name of the time series collection
+        metadata_name (str): Name of the metadata collection
+
+    Returns:
+        dict: find or distinct command for each query
+    """
+    data_col = db[data_name]
+    cml_col = db[metadata_name]
+
+    # use the latest time step and the links with data at that time
+    last_doc = data_col.find_one(sort=[("time.end_time", pymongo.DESCENDING)])
+    if last_doc is None:
+        return {}
+    ref_time = last_doc["time"]["end_time"]
+    link_id = last_doc["link_id"]
+    links = data_col.distinct("link_id", {"time.end_time": ref_time})
+    link_doc = cml_col.find_one({"properties.link_id": link_id}) or cml_col.find_one()
+    lon, lat = link_doc["properties"]["midpoint"]["coordinates"] if link_doc else (4.0, 52.0)
+
+    step_query = {"link_id": {"$in": links}, "time.end_time": ref_time}
+    shapes = {
+        "calc_p_ref": {
+            "find": data_name,
+            "filter": {
+                "link_id": link_id,
+                "time.end_time": {"$gte": ref_time - P_REF_WINDOW, "$lte": ref_time},
+                "atten.has_rain": False,
+                **qc_filter(),
+            },
+            "projection": {"power": 1, "_id": 0},
+        },
+        "time_step": {"find": data_name, "filter": step_query, "projection": {"link_id": 1, "_id": 0}},
+        "is_raining": {
+            "find": data_name,
+            "filter": {
+                "link_id": {"$in": links[:20]},
+                "time.end_time": ref_time,
+                "atten.s_atten": {"$ne": float("NaN"), "$type": "double"},
+            },
+            "projection": {"link_id": 1, "atten": 1, "_id": 0},
+        },
+        "get_link_rain": {
+            "find": data_name,
+            "filter": {**step_query, "rain": {"$exists": True}},
+        },
+        "get_cmls": {
+            "find": metadata_name,
+            "filter": {
+                "properties.midpoint": {
+                    "$geoWithin": {"$centerSphere": [[lon, lat], 250000 / EARTH_RADIUS]}
+                },
+                "properties.length.value": {"$gt": MIN_LENGTH, "$lt": MAX_LENGTH},
+                "properties.frequency.value": {"$gt": MIN_FREQUENCY, "$lt": MAX_FREQUENCY},
+            },
+            "projection": {
+                "_id": 0,
+                "properties.link_id": 1,
+                "properties.frequency.value": 1,
+                "properties.length.value": 1,
+                "properties.midpoint.coordinates": 1,
+            },
+        },
+        "neighbours": {
+            "find": metadata_name,
+            "filter": {
+                "properties.midpoint": {
+                    "$nearSphere": {
+                        "$geometry": {"type": "Point", "coordinates": [lon, lat]},
+                        "$maxDistance": RAIN_CLASS_RANGE,
+                    }
+                }
+            },
+            "projection": {"properties.link_id": 1, "_id": 0},
+        },
+    }
+    for stage in STAGES:
+        shapes[f"dirty_{stage}_times"] = {
+            "distinct": data_name,
+            "key": "time.end_time",
+            "query": {
+                f"dirty.{stage}": True,
+                "link_id": {"$in": links},
+                "time.end_time": {"$gte": ref_time - timedelta(days=7), "$lte": ref_time},
+            },
+        }
+        shapes[f"dirty_{stage}_step"] = {
+            "find": data_name,
+            "filter": {**step_query, f"dirty.{stage}": True},
+        }
+    return shapes
+
+
+def check_queries(db: pymongo.database.Database, data_name: str, metadata_name: str, max_ratio: float) -> bool:
+    """
+    Run explain() on each query and report the ones that are not supported by an index
+
+    Args:
+        db (pymongo.database.Database): Database
+        data_name (str): Name of the time series collection
+        metadata_name (str): Name of the metadata collection
+        max_ratio (float): Largest acceptable documents examined per document returned
+
+    Returns:
+        bool: True if all the queries pass
+    """
+    shapes = query_shapes(db, data_name, metadata_name)
+    if not shapes:
+        logging.warning(f"No data in {data_name} to build the queries")
+        return True
+
+    passed = True
+    for name, command in shapes.items():
+        result = explain_query(db, command)
+        ratio = result["docs_examined"] / max(result["returned"], 1)
+        problems = []
+        if "COLLSCAN" in result["stages"]:
+            problems.append("COLLSCAN")
+        if ratio > max_ratio:
+            problems.append(f"examined/returned = {ratio:.1f}")
+
+        status = "FAIL " + ", ".join(problems) if problems else "ok"
+        logging.info(
+            f"{name:24s} {'/'.join(result['stages']):40s} "
+            f"examined {result['docs_examined']:8d} returned {result['returned']:8d} {status}"
+        )
+        if problems:
+            passed = False
+    return passed
+
+
+def main():
+    """Apply the canonical indexes and check the query plans"""
+    parser = argparse.ArgumentParser(
+        description="Manage the indexes on the cml database and check the query plans",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("--data", default="cml_data", help="Time series collection")
+    parser.add_argument("--metadata", default="cml_metadata", help="Link metadata collection")
+    parser.add_argument("--apply", action="store_true", help="Create any missing indexes")
+    parser.add_argument("--drop-extra", action="store_true", help="Drop indexes that are not in the canonical set")
+    parser.add_argument("--check", action="store_true", help="Run explain() on the query shapes of each stage")
+    parser.add_argument("--max-ratio", type=float, default=10.0,
+                        help="Largest acceptable documents examined per document returned")
+    args = parser.parse_args()
+
+    uri_str = "mongodb://localhost:27017"
+    myclient = pymongo.MongoClient(uri_str)
+    db = myclient["cml"]
+
+    for name in [args.data, args.metadata]:
+        col = db[name]
+        if args.apply:
+            apply_indexes(col)
+        extra = extra_indexes(col)
+        if extra and args.drop_extra:
+            for index_name in extra:
+                col.drop_index(index_name)
+            logging.info(f"Dropped {extra} from {name}")
+        elif extra:
+            logging.info(f"Indexes on {name} that are not in the canonical set: {extra}")
+
+    if args.check:
+        if not check_queries(db, args.data, args.metadata, args.max_ratio):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,54 +5,186 @@ import pymongo
 import pymongo.collection
 import numpy as np
 import math
+import os
+import stat
+import time
+from pathlib import Path
+import bson
+
+# pymongoarrow decodes the query results straight into Arrow columns if it is installed
+try:
+    import pymongoarrow.api
+    import pyarrow
+except ImportError:
+    pymongoarrow = None
+
+# Processing stages for the time series data, in the order that they are run
+STAGES = ["p_ref", "atten", "has_rain", "rain"]
+
+# Window for the reference power, new power data change p_ref for this long afterwards
+P_REF_WINDOW = timedelta(days=1)
+
+# Neighbourhood used in the rain / no-rain classification in m
+RAIN_CLASS_RANGE = 10000
+
+# Mean radius of the Earth in m, as used by MongoDB for spherical queries
+EARTH_RADIUS = 6378100.0
+
+# Links that are used for the rain estimates, path length in m and frequency in GHz
+MIN_LENGTH = 500
+MAX_LENGTH = 10000
+MIN_FREQUENCY = 10.0
+MAX_FREQUENCY = 40.0
+
+# The get_cmls results are cached in files so that the stages and the workers share
+# one lookup, the cache key includes the metadata version so a change is seen at once.
+# The directory is private to the user and the files are CSV, so they cannot run code
+CMLS_CACHE_DIR = Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache")) / "cml_rain"
+CMLS_CACHE_TTL = 3600.0  # s
+CMLS_DTYPES = {"link_id": "int64", "frequency": "float64", "length": "float64", "mid_lon": "float64", "mid_lat": "float64"}
+
+# Valid range for pmax or pmin based on the PDF of the Netherlands link data, in dBm
+MIN_VALID_POWER = -70.0
+MAX_VALID_POWER = -20.0
+
+# Bits in the qc field of a record, set by scripts/qc.py
+QC_RANGE = 1  # p_min or p_max outside the valid range, or p_min above p_max
+QC_FLAT = 2  # p_min and p_max have not changed for many time steps, a stuck link
+QC_JUMP = 4  # power jumps above the time steps either side, rain only lowers the power
+QC_CLIMATOLOGY = 8  # power outside the bounds from the history of the link
+QC_REJECT = QC_RANGE | QC_FLAT | QC_JUMP | QC_CLIMATOLOGY
+
+# Fields in cml_data that can be read as time x link matrices
+SERIES_FIELDS = {
+    "p_min": "power.p_min",
+    "p_max": "power.p_max",
+    "p_ref": "atten.p_ref",
+    "atten": "atten.atten",
+    "s_atten": "atten.s_atten",
+    "has_rain": "atten.has_rain",
+    "rain": "rain",
+    "qc": "qc",
+}
+
+
+def private_cache_dir(cache_dir: Path) -> bool:
+    """
+    Make the cache directory with mode 0700 and check that no one else can write to it
+
+    Args:
+        cache_dir (Path): Cache directory
+
+    Returns:
+        bool: True if the directory can be used for the cache
+    """
+    try:
+        cache_dir.mkdir(mode=0o700, parents=True, exist_ok=True)
+        info = cache_dir.stat()
+    except OSError:
+        return False
+    return info.st_uid == os.getuid() and not info.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+
 
 def get_cmls(
     cml_col: pymongo.collection.Collection,
     longitude: float,
     latitude: float,
     max_range: float,
+    cache_ttl: float = CMLS_CACHE_TTL,
 ) -> pd.DataFrame:
     """Return the CMLs that are within a radius of a location
 
+    The length and frequency limits are applied in the query and only the fields
+    that are needed are returned. The result is cached in CMLS_CACHE_DIR for
+    cache_ttl seconds, keyed on the location, range and the metadata version.
+    The cache is not used if the directory is not private to the user.
+
     Args:
         cml_col (pymongo.collection.Collection): Collection of CMLs
         longitude (float): degrees of longitude
         latitude (float): degress of latitude
         max_range (float): maximum range in m
+        cache_ttl (float): Seconds to use a cached result, 0 to always query
 
     Returns:
-        pd.DataFrame:
+        pd.DataFrame: link_id, frequency, length, mid_lon and mid_lat, sorted by link_id
     """
+    cache_file = None
+    if cache_ttl > 0 and private_cache_dir(CMLS_CACHE_DIR):
+        version = get_metadata_version(cml_col.database["cml_state"])
+        cache_file = CMLS_CACHE_DIR / (
+            f"cmls_{cml_col.database.name}_{cml_col.name}_{longitude:.6f}_{latitude:.6f}"
+            f"_{max_range:.0f}_v{version}.csv"
+        )
+        try:
+            if time.time() - cache_file.stat().st_mtime < cache_ttl:
+                cml_df = pd.read_csv(cache_file, dtype=CMLS_DTYPES)
+                if list(cml_df.columns) == list(CMLS_DTYPES):
+                    return cml_df
+        except (OSError, ValueError, pd.errors.ParserError):
+            pass
+
+    # $geoWithin does not sort by distance like $nearSphere
     query = {
         "properties.midpoint": {
-            "$nearSphere": {
-                "$geometry": {"type": "Point", "coordinates": [longitude, latitude]},
-                "$maxDistance": max_range,
-            }
-        }
+            "$geoWithin": {"$centerSphere": [[longitude, latitude], max_range / EARTH_RADIUS]}
+        },
+        "properties.length.value": {"$gt": MIN_LENGTH, "$lt": MAX_LENGTH},
+        "properties.frequency.value": {"$gt": MIN_FREQUENCY, "$lt": MAX_FREQUENCY},
+    }
+    projection = {
+        "_id": 0,
+        "properties.link_id": 1,
+        "properties.frequency.value": 1,
+        "properties.length.value": 1,
+        "properties.midpoint.coordinates": 1,
     }
 
     records = []
-    for doc in cml_col.find(filter=query):
+    for doc in cml_col.find(filter=query, projection=projection):
+        props = doc["properties"]
         record = {
-            "link_id": int(doc["properties"]["link_id"]),
-            "frequency": float(doc["properties"]["frequency"]["value"]),
-            "length": float(doc["properties"]["length"]["value"]),
-            "mid_lon": float(doc["properties"]["midpoint"]["coordinates"][0]),
-            "mid_lat": float(doc["properties"]["midpoint"]["coordinates"][1]),
+            "link_id": int(props["link_id"]),
+            "frequency": float(props["frequency"]["value"]),
+            "length": float(props["length"]["value"]),
+            "mid_lon": float(props["midpoint"]["coordinates"][0]),
+            "mid_lat": float(props["midpoint"]["coordinates"][1]),
         }
         records.append(record)
 
     # Convert the list of records to a DataFrame
-    cml_df = pd.DataFrame(records)
-    cml_df = cml_df.loc[(cml_df["length"] > 500) & (cml_df["length"] < 10000) ]
-    cml_df = cml_df.loc[(cml_df["frequency"] > 10.0) & (cml_df["frequency"] < 40.0)]
+    cml_df = pd.DataFrame(records, columns=list(CMLS_DTYPES)).astype(CMLS_DTYPES)
+    cml_df = cml_df.sort_values("link_id").reset_index(drop=True)
+
+    # written to a temporary file first so that other processes never read part of a file
+    if cache_file is not None:
+        try:
+            tmp_file = cache_file.with_suffix(f".{os.getpid()}.tmp")
+            cml_df.to_csv(tmp_file, index=False)
+            os.replace(tmp_file, cache_file)
+        except OSError:
+            pass
 
     return cml_df
 
+
+def valid_power(power) -> np.ndarray:
+    """
+    Check that the link powers are within the valid range
+
+    Args:
+        power (array_like): Link powers, NaN for no data
+
+    Returns:
+        np.ndarray: True where the power is within the range
+    """
+    power = np.asarray(power, dtype=float)
+    return (power >= MIN_VALID_POWER) & (power <= MAX_VALID_POWER)
+
+
 def is_valid_power(power: float) -> bool:
     """
-    Check that the link power is within a valid range
+    Check that a single link power is within a valid range, use valid_power for arrays
 
     Args:
         power (float): Link power to be checked
@@ -60,18 +192,24 @@ def is_valid_power(power: float) -> bool:
     Returns:
         bool: True if within the range 
     """
-
-    if math.isnan(power) or (power is None):
-        return False 
-    
-    # Valid range for pmax or pmin based on the PDF of the Netherlands link data
-    max_valid_power = -20
-    min_valid_power = -70
-    if (power >= min_valid_power) & (power <= max_valid_power):
-        return True
-    else:
+    if power is None:
         return False
-    
+    return bool(valid_power(power))
+
+
+def qc_filter(mask: int = QC_REJECT) -> dict:
+    """
+    Query filter for the records that pass the quality control.
+    Records that have not been checked by scripts/qc.py do not have a qc field and pass.
+
+    Args:
+        mask (int, optional): QC bits that reject a record. Defaults to QC_REJECT.
+
+    Returns:
+        dict: Filter to be merged into a cml_data query
+    """
+    return {"qc": {"$not": {"$bitsAnySet": mask}}}
+
 
 def calc_p_ref(link_id: int, data_col: pymongo.collection.Collection, time: datetime) -> float:
     """
@@ -86,34 +224,347 @@ def calc_p_ref(link_id: int, data_col: pymongo.collection.Collection, time: date
     """
     ref_power = float("NaN")
     min_number_records = 25
-    start_time = time - timedelta(days=1)
+    start_time = time - P_REF_WINDOW
 
-    # Query MongoDB for dry periods without rain
+    # Query MongoDB for dry periods without rain that pass the quality control
     query = {
         "link_id": link_id,
         "time.end_time": {"$gte": start_time, "$lte": time},
-        "atten.has_rain": False
+        "atten.has_rain": False,
+        **qc_filter(),
     }
     projection = {"power": 1, "_id": 0}
 
     # Aggregate directly if records exist
     records = list(data_col.find(filter=query, projection=projection))
     if len(records) > min_number_records:
-        pave = []
-        for doc in records:
-            pmin = doc.get("power", {}).get("p_min")
-            pmax = doc.get("power", {}).get("p_max")
-            if pmin is not None and pmax is not None:
-                try:
-                    value = (float(pmin) + float(pmax)) / 2.0
-                    if is_valid_power(value):
-                        pave.append(value)
-                except (ValueError, TypeError):
-                    continue
+        p_min = np.array([doc.get("power", {}).get("p_min") for doc in records], dtype=float)
+        p_max = np.array([doc.get("power", {}).get("p_max") for doc in records], dtype=float)
+        pave = (p_min + p_max) / 2.0
+        pave = pave[valid_power(pave)]
 
         # Calculate the median if we have enough valid data
         if len(pave) >= min_number_records:
-            ref_power = np.median(pave)
+            ref_power = float(np.median(pave))
 
     return ref_power
 
+
+
+def dirty_flags(stages: list = STAGES) -> dict:
+    """
+    Flags to be set on a new record so that every stage processes it
+
+    Args:
+        stages (list): Stages that need to be run
+
+    Returns:
+        dict: dirty sub-document
+    """
+    return {stage: True for stage in stages}
+
+
+def mark_dirty(
+    data_col: pymongo.collection.Collection,
+    link_ids: list,
+    start_time: datetime,
+    end_time: datetime,
+    stages: list,
+) -> int:
+    """
+    Flag the records for a set of links and times as needing a stage to be run
+
+    Args:
+        data_col (pymongo.collection.Collection): Time series CML data
+        link_ids (list): Links to be flagged
+        start_time (datetime): First end_time to be flagged
+        end_time (datetime): Last end_time to be flagged
+        stages (list): Stages that need to be run
+
+    Returns:
+        int: Number of records that were modified
+    """
+    if len(link_ids) == 0:
+        return 0
+    query = {
+        "link_id": {"$in": [int(link_id) for link_id in link_ids]},
+        "time.end_time": {"$gte": start_time, "$lte": end_time},
+    }
+    flags = {f"dirty.{stage}": True for stage in stages}
+    result = data_col.update_many(query, {"$set": flags})
+    return result.modified_count
+
+
+def mark_ingested(
+    data_col: pymongo.collection.Collection,
+    link_ids: list,
+    start_time: datetime,
+    end_time: datetime,
+) -> int:
+    """
+    Flag the reference power that depends on newly ingested power data.
+    New records are inserted with dirty_flags(), but p_ref looks back over 24 h so
+    the existing records for the following 24 h also need to be recalculated.
+
+    Args:
+        data_col (pymongo.collection.Collection): Time series CML data
+        link_ids (list): Links with new data
+        start_time (datetime): First end_time of the new data
+        end_time (datetime): Last end_time of the new data
+
+    Returns:
+        int: Number of records that were modified
+    """
+    return mark_dirty(data_col, link_ids, start_time, end_time + P_REF_WINDOW, ["p_ref"])
+
+
+def get_dirty_times(
+    data_col: pymongo.collection.Collection,
+    stage: str,
+    links: list,
+    start_time: datetime = None,
+    end_time: datetime = None,
+) -> list:
+    """
+    Return the time steps that have records flagged for a stage
+
+    Args:
+        data_col (pymongo.collection.Collection): Time series CML data
+        stage (str): Name of the stage
+        links (list): Links to be processed
+        start_time (datetime, optional): First time to be processed. Defaults to None.
+        end_time (datetime, optional): Last time to be processed. Defaults to None.
+
+    Returns:
+        list: Sorted list of end_time values with dirty records
+    """
+    query = {f"dirty.{stage}": True, "link_id": {"$in": links}}
+    time_range = {}
+    if start_time is not None:
+        time_range["$gte"] = start_time
+    if end_time is not None:
+        time_range["$lte"] = end_time
+    if time_range:
+        query["time.end_time"] = time_range
+
+    return sorted(data_col.distinct("time.end_time", filter=query))
+
+
+def get_watermark(state_col: pymongo.collection.Collection, stage: str) -> datetime:
+    """
+    Return the latest time that a stage has processed
+
+    Args:
+        state_col (pymongo.collection.Collection): Processing state collection
+        stage (str): Name of the stage
+
+    Returns:
+        datetime: Watermark or None if the stage has not been run
+    """
+    doc = state_col.find_one({"_id": f"watermark.{stage}"})
+    if doc is None:
+        return None
+    return doc["time"]
+
+
+def set_watermark(state_col: pymongo.collection.Collection, stage: str, time: datetime):
+    """
+    Move the watermark for a stage forward to time
+
+    Args:
+        state_col (pymongo.collection.Collection): Processing state collection
+        stage (str): Name of the stage
+        time (datetime): Time step that has been processed
+    """
+    state_col.update_one(
+        {"_id": f"watermark.{stage}"},
+        {"$max": {"time": time}, "$set": {"updated": datetime.utcnow()}},
+        upsert=True,
+    )
+
+
+def is_same(old_value, new_value) -> bool:
+    """
+    Check if a derived field has changed, treating NaN as equal to NaN
+
+    Args:
+        old_value: Value in the database, can be None
+        new_value: New value
+
+    Returns:
+        bool: True if the value has not changed
+    """
+    if old_value is None or new_value is None:
+        return old_value is None and new_value is None
+    if isinstance(old_value, float) and isinstance(new_value, float):
+        if math.isnan(old_value) and math.isnan(new_value):
+            return True
+    return old_value == new_value
+
+
+def haversine(lon1, lat1, lon2, lat2):
+    """
+    Great circle distance between points, works on scalars or NumPy arrays
+
+    Args:
+        lon1: Longitude of the first point in degrees
+        lat1: Latitude of the first point in degrees
+        lon2: Longitude of the second point in degrees
+        lat2: Latitude of the second point in degrees
+
+    Returns:
+        Distance in m
+    """
+    lon1, lat1, lon2, lat2 = map(np.radians, (lon1, lat1, lon2, lat2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(a))
+
+
+def get_neighbours(cmls: pd.DataFrame, link_ids: list, max_range: float) -> list:
+    """
+    Return the links with mid-points within a range of the mid-points of a set of links
+
+    Args:
+        cmls (pd.DataFrame): Link metadata from get_cmls
+        link_ids (list): Links at the centre of the neighbourhoods
+        max_range (float): Radius of the neighbourhood in m
+
+    Returns:
+        list: Links in any of the neighbourhoods, including the links themselves
+    """
+    if len(link_ids) == 0:
+        return []
+
+    lon = cmls["mid_lon"].values
+    lat = cmls["mid_lat"].values
+    centre = cmls["link_id"].isin(link_ids).values
+
+    # distance from each centre link to every link
+    dist = haversine(lon[centre][:, None], lat[centre][:, None], lon[None, :], lat[None, :])
+    in_range = (dist <= max_range).any(axis=0)
+    return cmls["link_id"].values[in_range].astype(int).tolist()
+
+
+def get_metadata_version(state_col: pymongo.collection.Collection) -> int:
+    """
+    Return the version of the link metadata, this is incremented every time links are added or changed
+
+    Args:
+        state_col (pymongo.collection.Collection): Processing state collection
+
+    Returns:
+        int: Version number, 0 if the metadata have not been changed by import_links.py
+    """
+    doc = state_col.find_one({"_id": "cml_metadata"})
+    if doc is None:
+        return 0
+    return int(doc["version"])
+
+
+def bump_metadata_version(state_col: pymongo.collection.Collection) -> int:
+    """
+    Increment the version of the link metadata so that cached lookups are refreshed
+
+    Args:
+        state_col (pymongo.collection.Collection): Processing state collection
+
+    Returns:
+        int: New version number
+    """
+    doc = state_col.find_one_and_update(
+        {"_id": "cml_metadata"},
+        {"$inc": {"version": 1}, "$set": {"updated": datetime.utcnow()}},
+        upsert=True,
+        return_document=pymongo.ReturnDocument.AFTER,
+    )
+    return int(doc["version"])
+
+
+def get_link_series(
+    data_col: pymongo.collection.Collection,
+    link_ids: list,
+    start_time: datetime,
+    end_time: datetime,
+    fields: tuple = ("p_min", "p_max", "atten", "rain"),
+    batch_size: int = 100000,
+) -> dict:
+    """
+    Read the time series for a set of links as time x link matrices.
+    The fields are flattened by the server and decoded into Arrow columns with
+    pymongoarrow if it is installed. Without it the server groups the records into
+    one document per link and day with an array for each field, so a dict is only
+    built for each group and each array is converted to NumPy in one go.
+
+    Args:
+        data_col (pymongo.collection.Collection): Time series CML data
+        link_ids (list): Links to be read
+        start_time (datetime): First end_time
+        end_time (datetime): Last end_time
+        fields (tuple, optional): Names from SERIES_FIELDS. Defaults to ("p_min", "p_max", "atten", "rain").
+        batch_size (int, optional): Documents in each batch from the server. Defaults to 100000.
+
+    Returns:
+        dict: "times" (datetime64 array), "link_ids" (int array) and a float matrix
+        with shape (number of times, number of links) for each field, NaN where there is no data.
+        has_rain is 1.0 for rain and 0.0 for no rain.
+    """
+    link_ids = [int(link_id) for link_id in link_ids]
+    match = {"$match": {
+        "link_id": {"$in": link_ids},
+        "time.end_time": {"$gte": start_time, "$lte": end_time},
+    }}
+
+    if pymongoarrow is not None:
+        pipeline = [match, {"$project": {
+            "_id": 0,
+            "link_id": 1,
+            "end_time": "$time.end_time",
+            **{name: f"${SERIES_FIELDS[name]}" for name in fields},
+        }}]
+        schema = {"link_id": pyarrow.int64(), "end_time": pyarrow.timestamp("ms")}
+        for name in fields:
+            schema[name] = pyarrow.bool_() if name == "has_rain" else pyarrow.float64()
+        table = pymongoarrow.api.aggregate_arrow_all(
+            data_col, pipeline, schema=pymongoarrow.api.Schema(schema), batchSize=batch_size
+        )
+        columns = {
+            "link_id": table.column("link_id").to_numpy(zero_copy_only=False),
+            "end_time": table.column("end_time").to_numpy(zero_copy_only=False),
+        }
+        for name in fields:
+            columns[name] = table.column(name).cast(pyarrow.float64()).to_numpy(zero_copy_only=False)
+    else:
+        # one document per link and day with the columns as arrays, the times as ms
+        # since the epoch and null for a missing field so the arrays stay aligned
+        pipeline = [match, {"$group": {
+            "_id": {"link_id": "$link_id", "day": {"$dateTrunc": {"date": "$time.end_time", "unit": "day"}}},
+            "end_time": {"$push": {"$toLong": "$time.end_time"}},
+            **{name: {"$push": {"$ifNull": [f"${SERIES_FIELDS[name]}", None]}} for name in fields},
+        }}]
+        groups = []
+        for batch in data_col.aggregate_raw_batches(pipeline, batchSize=batch_size, allowDiskUse=True):
+            groups.extend(bson.decode_all(batch))
+        lengths = np.array([len(group["end_time"]) for group in groups], dtype=np.int64)
+        columns = {
+            "link_id": np.repeat(np.array([group["_id"]["link_id"] for group in groups], dtype=np.int64), lengths),
+            "end_time": np.concatenate(
+                [np.array(group["end_time"], dtype=np.int64) for group in groups] + [np.zeros(0, dtype=np.int64)]
+            ).astype("datetime64[ms]"),
+        }
+        for name in fields:
+            columns[name] = np.concatenate(
+                [np.array(group[name], dtype=float) for group in groups] + [np.zeros(0)]
+            )
+
+    # scatter the columns into the time x link matrices
+    times = np.unique(columns["end_time"])
+    links = np.unique(np.array(link_ids, dtype=np.int64))
+    time_index = np.searchsorted(times, columns["end_time"])
+    link_index = np.searchsorted(links, columns["link_id"])
+
+    series = {"times": times, "link_ids": links}
+    for name in fields:
+        matrix = np.full((len(times), len(links)), np.nan)
+        matrix[time_index, link_index] = columns[name]
+        series[name] = matrix
+    return series
@@ -0,0 +1,277 @@
+"""
+    Bulk import of link metadata from an operator inventory
+
+    Reads a CSV file (e.g. the 4TU .dat files) or a GeoJSON FeatureCollection,
+    calculates the mid-points and path lengths, validates the links and upserts
+    them into cml_metadata. Only the links that are new or have changed are
+    written, and these are listed in the report so that caches can be refreshed.
+
+"""
+import sys
+
+sys.path.append("../scripts")
+
+import argparse
+import json
+import logging
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pymongo
+import pymongo.collection
+
+from db_utils import haversine, bump_metadata_version
+from db_indexes import apply_indexes
+
+logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
+
+# Columns in the inventory and the names that are used here
+CSV_COLUMNS = {
+    "ID": "link_id",
+    "XStart": "lon1",
+    "YStart": "lat1",
+    "XEnd": "lon2",
+    "YEnd": "lat2",
+    "Frequency": "frequency",
+    "PathLength": "path_length_km",
+}
+
+# Optional properties that are copied from the inventory
+EXTRA_PROPERTIES = ["sublink_id", "radome", "host", "port", "community", "MIB", "OID"]
+
+# Valid ranges for the link metadata
+MIN_FREQUENCY = 1.0  # GHz
+MAX_FREQUENCY = 100.0  # GHz
+MAX_LENGTH = 100000  # m
+LENGTH_TOLERANCE = 0.1  # relative difference to the path length in the inventory
+
+
+def read_csv(file_path: Path, sep: str) -> pd.DataFrame:
+    """
+    Read a CSV inventory with one row per link, or one row per observation as in the 4TU files
+
+    Args:
+        file_path (Path): Inventory file
+        sep (str): Column separator
+
+    Returns:
+        pd.DataFrame: One row per link
+    """
+    df = pd.read_csv(file_path, sep=sep, header=0)
+    df = df.rename(columns=CSV_COLUMNS)
+    return df.drop_duplicates(subset=["link_id"], keep="last")
+
+
+def read_geojson(file_path: Path) -> pd.DataFrame:
+    """
+    Read a GeoJSON FeatureCollection of LineString features
+
+    Args:
+        file_path (Path): Inventory file
+
+    Returns:
+        pd.DataFrame: One row per link
+    """
+    with open(file_path) as f:
+        collection = json.load(f)
+
+    rows = []
+    for feature in collection["features"]:
+        props = feature.get("properties", {})
+        coords = feature.get("geometry", {}).get("coordinates", [])
+        frequency = props.get("frequency")
+        if isinstance(frequency, dict):
+            frequency = frequency.get("value")
+        row = {
+            "link_id": props.get("link_id"),
+            "lon1": coords[0][0] if len(coords) == 2 else np.nan,
+            "lat1": coords[0][1] if len(coords) == 2 else np.nan,
+            "lon2": coords[1][0] if len(coords) == 2 else np.nan,
+            "lat2": coords[1][1] if len(coords) == 2 else np.nan,
+            "frequency": frequency,
+        }
+        for name in EXTRA_PROPERTIES:
+            if name in props:
+                row[name] = props[name]
+        rows.append(row)
+    return pd.DataFrame(rows).drop_duplicates(subset=["link_id"], keep="last")
+
+
+def prepare_links(df: pd.DataFrame) -> tuple:
+    """
+    Calculate the mid-points and path lengths and reject the links that are not valid
+
+    Args:
+        df (pd.DataFrame): Links from read_csv or read_geojson
+
+    Returns:
+        tuple: (valid links, list of rejected links with the reason)
+    """
+    df = df.copy()
+    df["link_id"] = pd.to_numeric(df["link_id"], errors="coerce")
+    for col in ["lon1", "lat1", "lon2", "lat2", "frequency"]:
+        df[col] = pd.to_numeric(df[col], errors="coerce")
+
+    # Vectorized midpoint and path length calculations
+    df["mid_lon"] = np.round((df["lon1"] + df["lon2"]) / 2, 4)
+    df["mid_lat"] = np.round((df["lat1"] + df["lat2"]) / 2, 4)
+    df["length"] = np.round(haversine(df["lon1"], df["lat1"], df["lon2"], df["lat2"]))
+
+    reasons = pd.Series("", index=df.index)
+    reasons[df["link_id"].isna()] = "link_id is not a number"
+    bad_coords = (
+        df[["lon1", "lat1", "lon2", "lat2"]].isna().any(axis=1)
+        | (df[["lon1", "lon2"]].abs() > 180).any(axis=1)
+        | (df[["lat1", "lat2"]].abs() > 90).any(axis=1)
+    )
+    reasons[(reasons == "") & bad_coords] = "invalid coordinates"
+    bad_freq = df["frequency"].isna() | (df["frequency"] < MIN_FREQUENCY) | (df["frequency"] > MAX_FREQUENCY)
+    reasons[(reasons == "") & bad_freq] = "frequency out of range"
+    bad_length = (df["length"] <= 0) | (df["length"] > MAX_LENGTH)
+    reasons[(reasons == "") & bad_length] = "path length out of range"
+
+    # Check the calculated length against the length in the inventory
+    if "path_length_km" in df.columns:
+        given = pd.to_numeric(df["path_length_km"], errors="coerce") * 1000
+        mismatch = (df["length"] - given).abs() > LENGTH_TOLERANCE * given
+        reasons[(reasons == "") & mismatch] = "path length does not match the inventory"
+
+    rejected = [
+        {"link_id": None if pd.isna(link_id) else int(link_id), "reason": reason}
+        for link_id, reason in zip(df["link_id"][reasons != ""], reasons[reasons != ""])
+    ]
+    valid = df.loc[reasons == ""].copy()
+    valid["link_id"] = valid["link_id"].astype(int)
+    valid["length"] = valid["length"].astype(int)
+    return valid, rejected
+
+
+def make_feature(row: dict) -> dict:
+    """
+    Make the geoJSON document for a link, with the fields that get_cmls needs
+
+    Args:
+        row (dict): Link from prepare_links
+
+    Returns:
+        dict: geoJSON feature
+    """
+    properties = {
+        "link_id": int(row["link_id"]),
+        "frequency": {"value": float(row["frequency"]), "units": "GHz"},
+        "midpoint": {
+            "type": "Point",
+            "coordinates": [float(row["mid_lon"]), float(row["mid_lat"])],
+        },
+        "length": {"value": int(row["length"]), "units": "m"},
+    }
+    for name in EXTRA_PROPERTIES:
+        value = row.get(name)
+        if isinstance(value, list) or (value is not None and not pd.isna(value)):
+            properties[name] = value
+
+    return {
+        "type": "Feature",
+        "geometry": {
+            "type": "LineString",
+            "coordinates": [
+                [float(row["lon1"]), float(row["lat1"])],
+                [float(row["lon2"]), float(row["lat2"])],
+            ],
+        },
+        "properties": properties,
+    }
+
+
+def upsert_links(cml_col: pymongo.collection.Collection, links: pd.DataFrame, batch_size: int = 1000) -> dict:
+    """
+    Write the links that are new or have changed
+
+    Args:
+        cml_col (pymongo.collection.Collection): Link metadata
+        links (pd.DataFrame): Valid links from prepare_links
+        batch_size (int): Maximum number of operations in one bulk write
+
+    Returns:
+        dict: Lists of the link ids that were added, changed and unchanged
+    """
+    features = [make_feature(row) for row in links.to_dict("records")]
+
+    # Read the existing documents in chunks rather than one find_one per link
+    existing = {}
+    link_ids = [feature["properties"]["link_id"] for feature in features]
+    for ia in range(0, len(link_ids), 10000):
+        query = {"properties.link_id": {"$in": link_ids[ia:ia + 10000]}}
+        for doc in cml_col.find(query, projection={"_id": 0}):
+            existing[doc["properties"]["link_id"]] = doc
+
+    report = {"added": [], "changed": [], "unchanged": []}
+    updates = []
+    for feature in features:
+        link_id = feature["properties"]["link_id"]
+        old = existing.get(link_id)
+        if old is None:
+            report["added"].append(link_id)
+        elif old.get("geometry") == feature["geometry"] and all(
+            old["properties"].get(key) == value for key, value in feature["properties"].items()
+        ):
+            report["unchanged"].append(link_id)
+            continue
+        else:
+            report["changed"].append(link_id)
+
+        fields = {"type": feature["type"], "geometry": feature["geometry"]}
+        fields.update({f"properties.{key}": value for key, value in feature["properties"].items()})
+        updates.append(pymongo.UpdateOne({"properties.link_id": link_id}, {"$set": fields}, upsert=True))
+        if len(updates) >= batch_size:
+            cml_col.bulk_write(updates, ordered=False)
+            updates = []
+
+    if updates:
+        cml_col.bulk_write(updates, ordered=False)
+    return report
+
+
+def main():
+    """Import link metadata from a CSV or GeoJSON inventory"""
+    parser = argparse.ArgumentParser(
+        description="Bulk import of link metadata into cml_metadata",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("inventory", type=Path, help="CSV or GeoJSON file")
+    parser.add_argument("--sep", default=",", help="Column separator for CSV files, use ' ' for the 4TU files")
+    parser.add_argument("--report", type=Path, help="JSON file for the added, changed and rejected links")
+    parser.add_argument("--dry-run", action="store_true", help="Validate the inventory without writing")
+    args = parser.parse_args()
+
+    if args.inventory.suffix.lower() in [".geojson", ".json"]:
+        df = read_geojson(args.inventory)
+    else:
+        df = read_csv(args.inventory, args.sep)
+    links, rejected = prepare_links(df)
+    logging.info(f"Read {len(df)} links, {len(links)} valid, {len(rejected)} rejected")
+
+    report = {"added": [], "changed": [], "unchanged": [], "rejected": rejected}
+    if not args.dry_run:
+        myclient = pymongo.MongoClient("mongodb://localhost:27017")
+        db = myclient["cml"]
+        cml_col = db["cml_metadata"]
+        apply_indexes(cml_col)
+
+        report.update(upsert_links(cml_col, links))
+        if report["added"] or report["changed"]:
+            report["version"] = bump_metadata_version(db["cml_state"])
+        logging.info(
+            f"Added {len(report['added'])}, changed {len(report['changed'])}, "
+            f"unchanged {len(report['unchanged'])} links"
+        )
+
+    if args.report is not None:
+        report.pop("unchanged")
+        with open(args.report, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
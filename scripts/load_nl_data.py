@@ -6,47 +6,41 @@ from pathlib import Path
 import pandas as pd
 from pymongo import MongoClient
 import numpy as np
-import pymongo
-import math
-from db_utils import is_valid_power 
+from db_utils import valid_power, dirty_flags, bump_metadata_version
+from db_indexes import apply_indexes
 
 def write_data_records(data_df, data_col):
     records = []
     batch_size = 10000       
-    for index, row in data_df.iterrows():
-        p_min = row["Pmin"]
-        if not is_valid_power(p_min):
-            p_min = float("nan")
-
-        p_max = row["Pmax"]
-        if not is_valid_power(p_max):
-            p_max = float("nan")
-
-        # Only append records where both p_min and p_max are valid
-        if not (math.isnan(p_max) or math.isnan(p_min)):
-            record = {
-                "link_id": row["ID"],
-                "time":{ 
-                    "start_time": row["DateTime"] - time_step,
-                    "end_time": row["DateTime"]
-                },
-                "power":{
-                    "p_min": p_min,  # Use computed p_min
-                    "p_max": p_max,  # Use computed p_max
-                },
-                "atten":{
-                    "p_ref": float("NaN"),
-                    "has_rain": False,
-                    "atten": float("NaN"),
-                    "s_atten": float("NaN")
-                }
-            }
-            records.append(record) 
-
-            # Insert in batches of batch_size
-            if len(records) >= batch_size:
-                data_col.insert_many(records)
-                records = []  # Clear after batch insert
+
+    # Only append records where both p_min and p_max are valid
+    valid = valid_power(data_df["Pmin"].values) & valid_power(data_df["Pmax"].values)
+    for index, row in data_df[valid].iterrows():
+        record = {
+            "link_id": row["ID"],
+            "time":{ 
+                "start_time": row["DateTime"] - time_step,
+                "end_time": row["DateTime"]
+            },
+            "power":{
+                "p_min": row["Pmin"],
+                "p_max": row["Pmax"],
+            },
+            "atten":{
+                "p_ref": float("NaN"),
+                "has_rain": False,
+                "atten": float("NaN"),
+                "s_atten": float("NaN")
+            },
+            "dirty": dirty_flags(),
+            "version": 1
+        }
+        records.append(record) 
+
+        # Insert in batches of batch_size
+        if len(records) >= batch_size:
+            data_col.insert_many(records)
+            records = []  # Clear after batch insert
 
     # Insert any remaining records
     if records:
@@ -110,6 +104,7 @@ links = data_df_unique.apply(
 
 # Insert the links into MongoDB
 link_col.insert_many(links) 
+bump_metadata_version(db["cml_state"])
 print(f"Found {len(links)} stations")
 
 # Write out the time series data
@@ -125,23 +120,5 @@ data_df["DateTime"] = pd.to_datetime(data_df["DateTime"], format="%Y%m%d%H%M")
 write_data_records(data_df, data_col)
 
 # Set up the indexes
-data_index_1 = pymongo.IndexModel(
-    [("link_id", pymongo.ASCENDING)], name="link_id")
-data_index_2 = pymongo.IndexModel(
-    [("link_id", pymongo.ASCENDING), ("time.end_time", pymongo.ASCENDING)], name="link_id_time"
-)
-data_index_3 = pymongo.IndexModel(
-    [("link_id", pymongo.ASCENDING), 
-    ("time.end_time", pymongo.ASCENDING),
-    ("atten.s_atten", pymongo.ASCENDING)]
-)
-
-data_col.create_indexes([data_index_1, data_index_2, data_index_3])
-
-link_index_id = pymongo.IndexModel(
-    [("properties.link_id", pymongo.ASCENDING)], name="link_id", unique=True
-)
-link_index_midpoint = pymongo.IndexModel(
-    [("properties.midpoint", pymongo.GEOSPHERE)], name="midpoint_location"
-)
-link_col.create_indexes([link_index_midpoint, link_index_id])
+apply_indexes(data_col)
+apply_indexes(link_col)
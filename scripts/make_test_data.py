@@ -1,34 +1,210 @@
-from datetime import datetime
+"""
+    Build a test data set from cml_data, optionally scaled up
+
+    The records for a date range are copied into cml_test_data on the server with
+    $match and $out, and the link metadata into cml_test_metadata. With --copies n the
+    network is cloned n - 1 times: each clone gets new link ids (the original id plus
+    a multiple of a power of 10 larger than any id), each link is moved by a random
+    offset of up to --jitter m, and each clone is shifted in time by a whole number of
+    time steps of up to --max-shift so that the rain does not arrive everywhere at once.
+    The new ids must fit in a 32 bit int, which limits the number of copies.
+    The offsets and shifts only depend on --seed, so a data set can be rebuilt exactly.
+
+"""
+import sys
+
+sys.path.append("../scripts")
+
+import argparse
+import logging
+from datetime import datetime, timedelta
 
 import numpy as np
 import pymongo
 import pymongo.collection
 
-uri_str = "mongodb://localhost:27017"
-
-myclient = pymongo.MongoClient(uri_str)
-db = myclient["cml"]
-cml_col = db["cml_metadata"]
-data_col = db["cml_data"]
-test_data_col = db["cml_test_data"]
-test_data_col.drop()
-
-start_time = datetime(year=2011, month=6,day=9) 
-end_time = datetime(year=2011, month=7,day=1)
-max_records = 1000
-records = []
-for doc in data_col.find(
-    filter={ "time.end_time":{"$gte":start_time, "$lte":end_time}},
-    projection={"_id":0}):
-    records.append(doc)
-    if len(records) > max_records:
-        test_data_col.insert_many(records)
-        records = []
-
-# Set up the indexes
-data_index_id = pymongo.IndexModel(
-    [("link_id", pymongo.ASCENDING)], name="link_id")
-data_index_id_time = pymongo.IndexModel(
-    [("link_id", pymongo.ASCENDING), ("time.end_time", pymongo.ASCENDING)], name="link_id_time"
-)
-test_data_col.create_indexes([data_index_id, data_index_id_time])
+from db_utils import dirty_flags, bump_metadata_version
+from db_indexes import apply_indexes
+
+logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
+
+# Length of the sampling period in the time series data
+TIME_STEP = timedelta(minutes=15)
+
+# Length of a degree of latitude in m
+DEGREE_LENGTH = 111195.0
+
+# Largest link id, cml_interpolate reads link_id as a 32 bit int
+MAX_LINK_ID = 2**31 - 1
+
+
+def valid_date(s: str) -> datetime:
+    """
+    Validate and parse a date string.
+
+    Args:
+        s (str): The date string to validate.
+
+    Returns:
+        datetime: The parsed datetime object.
+
+    Raises:
+        argparse.ArgumentTypeError: If the date string is not valid.
+    """
+    try:
+        return datetime.fromisoformat(s)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(f"Not a valid date: {s!r}") from e
+
+
+def copy_pipeline(start_time: datetime, end_time: datetime, offset: int, shift: timedelta, raw: bool) -> list:
+    """
+    Aggregation pipeline that copies the records for one copy of the network
+
+    Args:
+        start_time (datetime): First end_time in the test data
+        end_time (datetime): Last end_time in the test data
+        offset (int): Added to the link ids
+        shift (timedelta): Added to the times, the source records are read from the shifted range
+        raw (bool): Only copy the power, with the processing results cleared and flagged as dirty
+
+    Returns:
+        list: Pipeline for the source collection, without the output stage
+    """
+    shift_ms = int(shift.total_seconds() * 1000)
+    pipeline = [
+        {"$match": {"time.end_time": {"$gte": start_time - shift, "$lte": end_time - shift}}},
+        {"$project": {"_id": 0}},
+    ]
+    if offset != 0 or shift_ms != 0:
+        pipeline.append({"$set": {
+            "link_id": {"$toInt": {"$add": ["$link_id", offset]}},
+            "time.start_time": {"$add": ["$time.start_time", shift_ms]},
+            "time.end_time": {"$add": ["$time.end_time", shift_ms]},
+        }})
+    if raw:
+        pipeline.append({"$unset": "rain"})
+        pipeline.append({"$set": {
+            "atten": {
+                "p_ref": float("NaN"),
+                "has_rain": False,
+                "atten": float("NaN"),
+                "s_atten": float("NaN"),
+            },
+            "dirty": dirty_flags(),
+            "version": 1,
+        }})
+    return pipeline
+
+
+def clone_links(links: list, offset: int, jitter: float, rng: np.random.Generator) -> list:
+    """
+    Make a copy of the link metadata with new ids, each link moved by a random offset.
+    Both ends are moved together so the length and frequency are unchanged.
+
+    Args:
+        links (list): Link metadata documents, sorted by link_id
+        offset (int): Added to the link ids
+        jitter (float): Largest offset in m in each direction
+        rng (np.random.Generator): Random numbers for the offsets
+
+    Returns:
+        list: geoJSON documents for the clones
+    """
+    d_north = rng.uniform(-jitter, jitter, len(links))
+    d_east = rng.uniform(-jitter, jitter, len(links))
+
+    clones = []
+    for link, dn, de in zip(links, d_north, d_east):
+        props = link["properties"]
+        mid_lon, mid_lat = props["midpoint"]["coordinates"]
+        d_lat = dn / DEGREE_LENGTH
+        d_lon = de / (DEGREE_LENGTH * np.cos(np.radians(mid_lat)))
+
+        clone = {
+            "type": link.get("type", "Feature"),
+            "geometry": {
+                "type": "LineString",
+                "coordinates": [
+                    [round(lon + d_lon, 6), round(lat + d_lat, 6)]
+                    for lon, lat in link["geometry"]["coordinates"]
+                ],
+            },
+            "properties": {
+                **props,
+                "link_id": int(props["link_id"]) + offset,
+                "midpoint": {
+                    "type": "Point",
+                    "coordinates": [round(mid_lon + d_lon, 4), round(mid_lat + d_lat, 4)],
+                },
+            },
+        }
+        clones.append(clone)
+    return clones
+
+
+def main():
+    """Build a test data set from cml_data, optionally scaled up"""
+    parser = argparse.ArgumentParser(
+        description="Build a test data set from cml_data, optionally with clones of the network",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("-s", "--start", type=valid_date, default=datetime(2011, 6, 9), help="Start date yyyy-mm-dd")
+    parser.add_argument("-e", "--end", type=valid_date, default=datetime(2011, 7, 1), help="End date yyyy-mm-dd")
+    parser.add_argument("--copies", type=int, default=1, help="Size of the test network as a multiple of the source")
+    parser.add_argument("--jitter", type=float, default=5000.0, help="Largest offset of a cloned link in m")
+    parser.add_argument("--max-shift", type=int, default=8, help="Largest time shift of a clone in time steps")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the offsets and time shifts")
+    parser.add_argument("--raw", action="store_true",
+                        help="Only copy the power, with the processing results cleared and flagged as dirty")
+    parser.add_argument("--source", default="cml_data", help="Time series collection to copy")
+    parser.add_argument("--source-metadata", default="cml_metadata", help="Link metadata to copy")
+    parser.add_argument("--target", default="cml_test_data", help="Test time series collection")
+    parser.add_argument("--target-metadata", default="cml_test_metadata", help="Test link metadata collection")
+    args = parser.parse_args()
+
+    uri_str = "mongodb://localhost:27017"
+    myclient = pymongo.MongoClient(uri_str)
+    db = myclient["cml"]
+    cml_col = db[args.source_metadata]
+    data_col = db[args.source]
+    test_cml_col = db[args.target_metadata]
+    test_data_col = db[args.target]
+
+    # clone ids start at a power of 10 that is larger than any of the link ids
+    links = list(cml_col.find(projection={"_id": 0}, sort=[("properties.link_id", pymongo.ASCENDING)]))
+    max_id = max(int(link["properties"]["link_id"]) for link in links) if links else 0
+    id_step = 10 ** len(str(max_id))
+    if (args.copies - 1) * id_step + max_id > MAX_LINK_ID:
+        parser.error(f"--copies {args.copies} gives link ids above {MAX_LINK_ID}, "
+                     f"at most {(MAX_LINK_ID - max_id) // id_step + 1} copies are possible")
+
+    # the original network is copied on the server
+    data_col.aggregate(copy_pipeline(args.start, args.end, 0, timedelta(0), args.raw) + [{"$out": args.target}])
+    cml_col.aggregate([{"$project": {"_id": 0}}, {"$out": args.target_metadata}])
+    logging.info(f"Copied {test_data_col.estimated_document_count()} records from {args.source}")
+
+    rng = np.random.default_rng(args.seed)
+    for copy in range(1, args.copies):
+        offset = copy * id_step
+        shift = TIME_STEP * int(rng.integers(-args.max_shift, args.max_shift + 1))
+        clones = clone_links(links, offset, args.jitter, rng)
+        test_cml_col.insert_many(clones)
+
+        data_col.aggregate(copy_pipeline(args.start, args.end, offset, shift, args.raw) + [
+            {"$merge": {"into": args.target, "whenMatched": "replace", "whenNotMatched": "insert"}}
+        ])
+        logging.info(f"Added copy {copy} with ids from {offset} and a time shift of {shift}")
+
+    # Set up the same indexes as cml_data and cml_metadata
+    apply_indexes(test_data_col)
+    apply_indexes(test_cml_col)
+    bump_metadata_version(db["cml_state"])
+    logging.info(
+        f"{args.target} has {test_data_col.estimated_document_count()} records and "
+        f"{args.target_metadata} has {test_cml_col.estimated_document_count()} links"
+    )
+
+
+if __name__ == "__main__":
+    main()
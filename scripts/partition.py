@@ -0,0 +1,377 @@
+"""
+    Run the processing stages on spatial partitions of the network
+
+    The links from get_cmls are split into compact tiles with about the same number
+    of links in each, and each tile is processed by its own worker. A worker only
+    writes the results for the links that it owns, and reads the links within
+    RAIN_CLASS_RANGE of its tile (the halo) for the rain classification. The workers
+    wait for each other after each stage that is read by the neighbouring tiles, because
+    the rain classification at the edge of a tile needs the attenuation of the
+    neighbouring tile.
+
+    The barriers are documents in the cml_state collection, so the partitions can be
+    run as local processes, or on separate hosts with --partition-index
+    and the same --partitions and --run-id on every host. The last partition to
+    finish deletes the barriers for the run, and a partition that fails deletes them
+    so that the run can be started again. A partition that has already passed a
+    barrier of a run is not started again with the same --run-id, because the barriers
+    that are left by a crash would not hold it back.
+
+"""
+import sys
+
+sys.path.append("../scripts")
+
+import argparse
+import logging
+import multiprocessing
+import re
+import time
+import uuid
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import pymongo
+import pymongo.collection
+
+from db_utils import get_cmls, get_neighbours, get_dirty_times, set_watermark
+from db_utils import STAGES, RAIN_CLASS_RANGE
+from reference_power import calculate_ref_power
+from attenuation import calculate_attenuation
+from rain_class import classify_rain
+from rain import estimate_rain
+
+logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
+
+# Longest time that a worker waits for the other partitions to finish a stage
+BARRIER_TIMEOUT = 600.0  # s
+
+
+def valid_date(s: str) -> np.datetime64:
+    """
+    Validate and parse a date string.
+
+    Args:
+        s (str): The date string to validate.
+
+    Returns:
+        np.datetime64: The parsed datetime object.
+
+    Raises:
+        argparse.ArgumentTypeError: If the date string is not valid.
+    """
+    try:
+        return np.datetime64(s)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(f"Not a valid date: {s!r}") from e
+
+
+def partition_links(cmls: pd.DataFrame, n_parts: int) -> np.ndarray:
+    """
+    Split the links into compact tiles by recursive bisection of the mid-points
+    along the longer side, so that each tile has about the same number of links.
+    The result only depends on the links, so every host gets the same tiles.
+
+    Args:
+        cmls (pd.DataFrame): Link metadata from get_cmls
+        n_parts (int): Number of tiles
+
+    Returns:
+        np.ndarray: Tile index for each row in cmls
+    """
+    x = (cmls["mid_lon"].values * np.cos(np.radians(cmls["mid_lat"].values.mean())))
+    y = cmls["mid_lat"].values
+    link_ids = cmls["link_id"].values
+    part = np.zeros(len(cmls), dtype=int)
+
+    def bisect(rows: np.ndarray, first: int, count: int):
+        if count == 1 or len(rows) == 0:
+            part[rows] = first
+            return
+        # sort along the longer side, with the link id to break ties
+        if np.ptp(x[rows]) >= np.ptp(y[rows]):
+            order = rows[np.lexsort((link_ids[rows], x[rows]))]
+        else:
+            order = rows[np.lexsort((link_ids[rows], y[rows]))]
+        n_left = count // 2
+        split = int(round(len(order) * n_left / count))
+        bisect(order[:split], first, n_left)
+        bisect(order[split:], first + n_left, count - n_left)
+
+    bisect(np.arange(len(cmls)), 0, n_parts)
+    return part
+
+
+def get_partition(cmls: pd.DataFrame, n_parts: int, index: int) -> tuple:
+    """
+    Return the links owned by a partition and the links that it reads
+
+    Args:
+        cmls (pd.DataFrame): Link metadata from get_cmls
+        n_parts (int): Number of partitions
+        index (int): Partition to return
+
+    Returns:
+        tuple: (owned links, owned links and the halo within RAIN_CLASS_RANGE)
+    """
+    owned = cmls.loc[partition_links(cmls, n_parts) == index]
+    halo_ids = get_neighbours(cmls, owned["link_id"].values.tolist(), RAIN_CLASS_RANGE)
+    return owned, cmls.loc[cmls["link_id"].isin(halo_ids)]
+
+
+def get_run_times(
+    state_col: pymongo.collection.Collection,
+    run_id: str,
+    times: list,
+) -> list:
+    """
+    Store the time steps for a run, the first partition to start stores its list
+    and every partition uses that list so that they all meet at the same barriers
+
+    Args:
+        state_col (pymongo.collection.Collection): Processing state
+        run_id (str): Identifies the run
+        times (list): Time steps found by this partition
+
+    Returns:
+        list: Time steps for the run
+    """
+    doc = state_col.find_one_and_update(
+        {"_id": f"partition.{run_id}"},
+        {"$setOnInsert": {"times": list(times), "created": datetime.now()}},
+        upsert=True,
+        return_document=pymongo.ReturnDocument.AFTER,
+    )
+    return doc["times"]
+
+
+def wait_barrier(
+    state_col: pymongo.collection.Collection,
+    run_id: str,
+    key: str,
+    index: int,
+    n_parts: int,
+    timeout: float = BARRIER_TIMEOUT,
+):
+    """
+    Record that this partition has finished a stage and wait for the others
+
+    Args:
+        state_col (pymongo.collection.Collection): Processing state
+        run_id (str): Identifies the run
+        key (str): Identifies the stage and time step
+        index (int): This partition
+        n_parts (int): Number of partitions
+
+    Raises:
+        TimeoutError: If the other partitions do not finish within the timeout
+    """
+    barrier_id = f"partition.{run_id}.{key}"
+    state_col.update_one({"_id": barrier_id}, {"$addToSet": {"done": index}}, upsert=True)
+
+    deadline = time.monotonic() + timeout
+    delay = 0.01
+    while len(state_col.find_one({"_id": barrier_id})["done"]) < n_parts:
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"Partition {index} timed out waiting at {key}")
+        time.sleep(delay)
+        delay = min(2 * delay, 0.5)
+
+
+def run_query(run_id: str) -> dict:
+    """Query for the time steps and barriers of a run in cml_state"""
+    return {"_id": {"$regex": f"^partition\\.{re.escape(run_id)}(\\.|$)"}}
+
+
+def clear_run(state_col: pymongo.collection.Collection, run_id: str):
+    """Delete the time steps and barriers for a run"""
+    state_col.delete_many(run_query(run_id))
+
+
+def run_started(state_col: pymongo.collection.Collection, run_id: str, index: int = None) -> bool:
+    """
+    Check if a run has documents in cml_state, which are left if it did not finish
+
+    Args:
+        state_col (pymongo.collection.Collection): Processing state
+        run_id (str): Identifies the run
+        index (int, optional): Only the barriers that this partition has passed. Defaults to None.
+
+    Returns:
+        bool: True if the run (or the partition) has started
+    """
+    query = run_query(run_id)
+    if index is not None:
+        query["done"] = index
+    return state_col.count_documents(query, limit=1) > 0
+
+
+def finish_run(state_col: pymongo.collection.Collection, run_id: str, index: int, n_parts: int) -> bool:
+    """
+    Record that this partition has finished the run, the last partition to finish
+    deletes the time steps and barriers because the others have passed all of them
+
+    Args:
+        state_col (pymongo.collection.Collection): Processing state
+        run_id (str): Identifies the run
+        index (int): This partition
+        n_parts (int): Number of partitions
+
+    Returns:
+        bool: True if this partition cleared the run
+    """
+    doc = state_col.find_one_and_update(
+        {"_id": f"partition.{run_id}.finished"},
+        {"$addToSet": {"done": index}},
+        upsert=True,
+        return_document=pymongo.ReturnDocument.AFTER,
+    )
+    if len(doc["done"]) < n_parts:
+        return False
+    clear_run(state_col, run_id)
+    return True
+
+
+def run_partition(args: argparse.Namespace, index: int, times: list) -> dict:
+    """
+    Process the time steps for the links owned by one partition
+
+    Args:
+        args (argparse.Namespace): Command line arguments
+        index (int): Partition to process
+        times (list): Time steps found by the caller
+
+    Returns:
+        dict: Number of links owned and read, time steps processed and the time taken
+    """
+    start = time.perf_counter()
+    myclient = pymongo.MongoClient("mongodb://localhost:27017")
+    db = myclient["cml"]
+    cml_col = db["cml_metadata"]
+    data_col = db[args.data]
+    state_col = db["cml_state"]
+
+    cmls = get_cmls(cml_col, args.longitude, args.latitude, args.range)
+    owned, halo = get_partition(cmls, args.partitions, index)
+    links = owned["link_id"].values.astype(int).tolist()
+    logging.info(f"Partition {index} owns {len(owned)} links and reads {len(halo)}")
+
+    incremental = not args.all
+    try:
+        times = get_run_times(state_col, args.run_id, times)
+        for ref_time in times:
+            # the attenuation only reads the reference power of the links owned by this partition
+            calculate_ref_power(ref_time, links, data_col, incremental)
+            calculate_attenuation(ref_time, owned, data_col, incremental, neighbour_cmls=halo)
+            wait_barrier(state_col, args.run_id, f"{ref_time.isoformat()}.atten", index, args.partitions)
+            classify_rain(ref_time, owned, cml_col, data_col, incremental, neighbour_cmls=halo)
+            wait_barrier(state_col, args.run_id, f"{ref_time.isoformat()}.has_rain", index, args.partitions)
+            estimate_rain(ref_time, owned, data_col, incremental)
+            wait_barrier(state_col, args.run_id, f"{ref_time.isoformat()}.rain", index, args.partitions)
+
+            # every partition has finished this time step
+            if index == 0 and args.data == "cml_data":
+                for stage in STAGES:
+                    set_watermark(state_col, stage, ref_time)
+    except Exception:
+        # the other partitions time out at the next barrier, and the run can be started again
+        clear_run(state_col, args.run_id)
+        raise
+
+    finish_run(state_col, args.run_id, index, args.partitions)
+    return {
+        "partition": index,
+        "owned": len(owned),
+        "read": len(halo),
+        "time_steps": len(times),
+        "seconds": round(time.perf_counter() - start, 1),
+    }
+
+
+def find_times(args: argparse.Namespace) -> list:
+    """
+    Find the time steps to process, every time step with --all or otherwise
+    the time steps with records flagged for any stage
+
+    Args:
+        args (argparse.Namespace): Command line arguments
+
+    Returns:
+        list: Sorted time steps
+    """
+    start_time = None if args.start is None else pd.to_datetime(args.start).to_pydatetime()
+    end_time = None if args.end is None else pd.to_datetime(args.end).to_pydatetime()
+    if args.all:
+        return [t.to_pydatetime() for t in pd.date_range(start=start_time, end=end_time, freq="15min")]
+
+    myclient = pymongo.MongoClient("mongodb://localhost:27017")
+    db = myclient["cml"]
+    cmls = get_cmls(db["cml_metadata"], args.longitude, args.latitude, args.range)
+    links = cmls["link_id"].values.astype(int).tolist()
+    times = set()
+    for stage in STAGES:
+        times.update(get_dirty_times(db[args.data], stage, links, start_time, end_time))
+    return sorted(times)
+
+
+def main():
+    """Run the processing stages on spatial partitions of the network"""
+    parser = argparse.ArgumentParser(
+        description="Run the processing stages on spatial partitions of the network",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("-s", "--start", type=valid_date,
+                        help="Start date yyyy-mm-dd, default is the first dirty record")
+    parser.add_argument("-e", "--end", type=valid_date,
+                        help="End date yyyy-mm-dd, default is the last dirty record")
+    parser.add_argument("-a", "--all", action="store_true",
+                        help="Process every time step between start and end, not just the dirty records")
+    parser.add_argument("-p", "--partitions", type=int, default=4,
+                        help="Number of spatial partitions, each runs in its own process")
+    parser.add_argument("--partition-index", type=int,
+                        help="Run only this partition, e.g. one per host, needs --run-id")
+    parser.add_argument("--run-id", help="Same on every host so that the partitions meet at the barriers")
+    parser.add_argument("--data", default="cml_data", help="Time series collection")
+    parser.add_argument("--longitude", type=float, default=4.0, help="Centre of the domain")
+    parser.add_argument("--latitude", type=float, default=52.0, help="Centre of the domain")
+    parser.add_argument("--range", type=float, default=250000, help="Radius of the domain in m")
+    args = parser.parse_args()
+
+    if args.all and (args.start is None or args.end is None):
+        parser.error("--all needs --start and --end")
+    if args.partition_index is not None and args.run_id is None:
+        parser.error("--partition-index needs --run-id")
+
+    # the barriers left by a run that did not finish would let a partition run ahead
+    state_col = pymongo.MongoClient("mongodb://localhost:27017")["cml"]["cml_state"]
+    if args.run_id is not None:
+        if args.partition_index is not None and run_started(state_col, args.run_id, args.partition_index):
+            parser.error(f"Partition {args.partition_index} has already run with --run-id {args.run_id}, use a new run id")
+        if args.partition_index is None and run_started(state_col, args.run_id):
+            parser.error(f"--run-id {args.run_id} has already been used, use a new run id")
+
+    times = find_times(args)
+    logging.info(f"Processing {len(times)} time steps on {args.partitions} partitions")
+
+    # one partition on this host, the other hosts run the other partitions
+    if args.partition_index is not None:
+        result = run_partition(args, args.partition_index, times)
+        logging.info(f"Finished {result}")
+        return
+
+    # all the partitions as local processes
+    args.run_id = args.run_id or uuid.uuid4().hex
+    get_run_times(state_col, args.run_id, times)
+
+    start = time.perf_counter()
+    with multiprocessing.Pool(args.partitions) as pool:
+        results = pool.starmap(run_partition, [(args, index, times) for index in range(args.partitions)])
+
+    for result in results:
+        logging.info(f"Partition {result['partition']}: {result}")
+    logging.info(f"Processed {len(times)} time steps in {time.perf_counter() - start:.1f} s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,334 @@
+"""
+    Quality control of the link power
+
+    The power for all the links over a day is read as time x link matrices with
+    get_link_series, with NaN rows for the time steps without any records (e.g. an
+    outage of the network), and checked with array operations:
+
+    - range: p_min or p_max outside the valid range, or p_min above p_max
+    - flat line: p_min and p_max have not changed for --flat-steps time steps, a stuck link
+    - jump: p_min or p_max is more than --jump dB above the time steps either side,
+      rain only lowers the received power so this is an error
+    - climatology: p_max more than --margin dB above the 99th percentile of the link
+      over the previous --history days, or p_min more than --max-fade dB below its median
+
+    The result is written to the records as a bitmask in the qc field (QC_* in
+    db_utils.py), only where it has changed. Records that have not been checked do not
+    have the field. The reference power and attenuation skip the records with any of
+    the QC_REJECT bits set, and are flagged as dirty where the result changes.
+
+"""
+import sys
+
+sys.path.append("../scripts")
+
+import argparse
+import logging
+import warnings
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+import pymongo
+import pymongo.collection
+
+from db_utils import get_cmls, get_link_series, get_watermark, set_watermark, mark_dirty, valid_power
+from db_utils import P_REF_WINDOW, QC_RANGE, QC_FLAT, QC_JUMP, QC_CLIMATOLOGY
+
+logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
+
+# Length of the sampling period in the time series data
+TIME_STEP = timedelta(minutes=15)
+
+# Defaults for the checks
+FLAT_STEPS = 24  # 6 h
+JUMP_DB = 10.0
+HISTORY_DAYS = 7
+CLIMATOLOGY_MARGIN = 5.0  # dB
+MAX_FADE = 40.0  # dB
+MIN_HISTORY = 96  # time steps needed for the climatological bounds
+
+
+def valid_date(s: str) -> datetime:
+    """
+    Validate and parse a date string.
+
+    Args:
+        s (str): The date string to validate.
+
+    Returns:
+        datetime: The parsed datetime object.
+
+    Raises:
+        argparse.ArgumentTypeError: If the date string is not valid.
+    """
+    try:
+        return datetime.fromisoformat(s)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(f"Not a valid date: {s!r}") from e
+
+
+def flat_lines(p_min: np.ndarray, p_max: np.ndarray, flat_steps: int) -> np.ndarray:
+    """
+    Find the runs of at least flat_steps time steps where p_min and p_max do not change
+
+    Args:
+        p_min (np.ndarray): time x link matrix, NaN where there is no data
+        p_max (np.ndarray): time x link matrix, NaN where there is no data
+        flat_steps (int): Shortest run that is flagged, at least 2
+
+    Returns:
+        np.ndarray: True for the time steps in a run
+    """
+    n_times = p_min.shape[0]
+    n_diffs = flat_steps - 1
+
+    # same[t] is True if the power at t is the same as at t - 1, NaN is never the same
+    same = np.zeros(p_min.shape, dtype=bool)
+    same[1:] = (p_min[1:] == p_min[:-1]) & (p_max[1:] == p_max[:-1])
+
+    # a run of flat_steps values ends at t if the n_diffs differences up to t are all the same
+    counts = np.zeros((n_times + 1, p_min.shape[1]), dtype=np.int64)
+    np.cumsum(same, axis=0, out=counts[1:])
+    run_end = np.zeros(p_min.shape, dtype=bool)
+    if n_times > n_diffs:
+        run_end[n_diffs:] = counts[n_diffs + 1:] - counts[1:-n_diffs] == n_diffs
+
+    # a time step is in a run if one ends within n_diffs steps after it
+    ends = np.zeros((n_times + 1, p_min.shape[1]), dtype=np.int64)
+    np.cumsum(run_end, axis=0, out=ends[1:])
+    last = np.minimum(np.arange(n_times) + n_diffs + 1, n_times)
+    return ends[last] - ends[:-1] > 0
+
+
+def jumps(power: np.ndarray, jump_db: float) -> np.ndarray:
+    """
+    Find the time steps where the power is more than jump_db above the steps either side
+
+    Args:
+        power (np.ndarray): time x link matrix, NaN where there is no data
+        jump_db (float): Smallest jump that is flagged, in dB
+
+    Returns:
+        np.ndarray: True for the jumps
+    """
+    jump = np.zeros(power.shape, dtype=bool)
+    jump[1:-1] = (power[1:-1] - power[:-2] > jump_db) & (power[1:-1] - power[2:] > jump_db)
+    return jump
+
+
+def climatology_bounds(
+    p_min: np.ndarray,
+    p_max: np.ndarray,
+    margin: float = CLIMATOLOGY_MARGIN,
+    max_fade: float = MAX_FADE,
+    min_history: int = MIN_HISTORY,
+) -> tuple:
+    """
+    Bounds for the power of each link from its history
+
+    Args:
+        p_min (np.ndarray): time x link matrix over the history, NaN where there is no data
+        p_max (np.ndarray): time x link matrix over the history, NaN where there is no data
+        margin (float, optional): Added to the 99th percentile of p_max. Defaults to CLIMATOLOGY_MARGIN.
+        max_fade (float, optional): Subtracted from the median of p_min. Defaults to MAX_FADE.
+        min_history (int, optional): Time steps needed for a link to have bounds. Defaults to MIN_HISTORY.
+
+    Returns:
+        tuple: lower bound for p_min and upper bound for p_max for each link, NaN for no bounds
+    """
+    if p_min.shape[0] < min_history:
+        no_bounds = np.full(p_min.shape[1], np.nan)
+        return no_bounds, no_bounds.copy()
+    ok = valid_power(p_min) & valid_power(p_max)
+    p_min = np.where(ok, p_min, np.nan)
+    p_max = np.where(ok, p_max, np.nan)
+
+    # links without any valid data give all-NaN slices
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        lower = np.nanmedian(p_min, axis=0) - max_fade
+        upper = np.nanpercentile(p_max, 99, axis=0) + margin
+
+    short = ok.sum(axis=0) < min_history
+    lower[short] = np.nan
+    upper[short] = np.nan
+    return lower, upper
+
+
+def qc_flags(
+    p_min: np.ndarray,
+    p_max: np.ndarray,
+    lower: np.ndarray,
+    upper: np.ndarray,
+    flat_steps: int = FLAT_STEPS,
+    jump_db: float = JUMP_DB,
+) -> np.ndarray:
+    """
+    QC bits for each record
+
+    Args:
+        p_min (np.ndarray): time x link matrix, NaN where there is no data
+        p_max (np.ndarray): time x link matrix, NaN where there is no data
+        lower (np.ndarray): Lower bound for p_min for each link, NaN for no bound
+        upper (np.ndarray): Upper bound for p_max for each link, NaN for no bound
+        flat_steps (int, optional): Shortest flat line that is flagged. Defaults to FLAT_STEPS.
+        jump_db (float, optional): Smallest jump that is flagged in dB. Defaults to JUMP_DB.
+
+    Returns:
+        np.ndarray: time x link matrix of QC bits, 0 for the records that pass
+    """
+    has_data = ~(np.isnan(p_min) & np.isnan(p_max))
+    bad_range = ~(valid_power(p_min) & valid_power(p_max)) | (p_min > p_max)
+    bad_clim = (p_min < lower[None, :]) | (p_max > upper[None, :])
+
+    flags = np.zeros(p_min.shape, dtype=np.int64)
+    flags[has_data & bad_range] |= QC_RANGE
+    flags[flat_lines(p_min, p_max, flat_steps)] |= QC_FLAT
+    flags[jumps(p_min, jump_db) | jumps(p_max, jump_db)] |= QC_JUMP
+    flags[has_data & bad_clim] |= QC_CLIMATOLOGY
+    return flags
+
+
+def fill_gaps(series: dict, fields: list) -> dict:
+    """
+    Put the matrices from get_link_series onto consecutive time steps, so that the
+    flat line and jump checks do not compare the power across a step without any records
+
+    Args:
+        series (dict): Output of get_link_series with at least one time
+        fields (list): Names of the matrices in the series
+
+    Returns:
+        dict: Series with a row for every TIME_STEP from the first to the last time,
+        NaN in the rows that were missing
+    """
+    times = series["times"]
+    steps = pd.date_range(times[0], times[-1], freq=TIME_STEP).values.astype(times.dtype)
+    all_times = np.union1d(steps, times)
+    rows = np.searchsorted(all_times, times)
+
+    filled = {"times": all_times, "link_ids": series["link_ids"]}
+    for name in fields:
+        filled[name] = np.full((len(all_times), series[name].shape[1]), np.nan)
+        filled[name][rows] = series[name]
+    return filled
+
+
+def check_period(
+    data_col: pymongo.collection.Collection,
+    links: list,
+    start_time: datetime,
+    end_time: datetime,
+    args: argparse.Namespace,
+) -> int:
+    """
+    Run the checks for the records after start_time up to end_time and write the QC bits
+
+    Args:
+        data_col (pymongo.collection.Collection): Time series CML data
+        links (list): Links to be checked
+        start_time (datetime): The records after this time are written
+        end_time (datetime): Last time to be checked
+        args (argparse.Namespace): Settings for the checks
+
+    Returns:
+        int: Number of records where the QC bits changed
+    """
+    # the history gives the climatology and the runs and jumps that start before start_time
+    history_start = start_time - timedelta(days=args.history)
+    fields = ["p_min", "p_max", "qc"]
+    series = get_link_series(data_col, links, history_start, end_time, fields=fields)
+    if len(series["times"]) == 0:
+        return 0
+    series = fill_gaps(series, fields)
+
+    times = pd.to_datetime(series["times"]).to_pydatetime()
+    in_history = series["times"] <= np.datetime64(start_time)
+    lower, upper = climatology_bounds(series["p_min"][in_history], series["p_max"][in_history],
+                                      args.margin, args.max_fade)
+    flags = qc_flags(series["p_min"], series["p_max"], lower, upper, args.flat_steps, args.jump)
+
+    # a flat line that ended in the previous period can extend back over the steps
+    # that were already written, and the last step could not be checked for a jump
+    first_row = np.searchsorted(series["times"], np.datetime64(start_time - TIME_STEP * args.flat_steps), side="right")
+    has_record = ~(np.isnan(series["p_min"]) & np.isnan(series["p_max"]) & np.isnan(series["qc"]))
+    old_flags = np.nan_to_num(series["qc"], nan=0).astype(np.int64)
+    changed = has_record & (flags != old_flags)
+    changed[:first_row] = False
+
+    rows, cols = np.nonzero(changed)
+    if len(rows) == 0:
+        return 0
+
+    # the attenuation changes at the record and the reference power over the next 24 h
+    updates = [
+        pymongo.UpdateOne(
+            {"link_id": int(series["link_ids"][col]), "time.end_time": times[row]},
+            {"$set": {"qc": int(flags[row, col]), "dirty.atten": True}},
+        )
+        for row, col in zip(rows, cols)
+    ]
+    max_updates = 1000
+    for ia in range(0, len(updates), max_updates):
+        data_col.bulk_write(updates[ia:ia + max_updates], ordered=False)
+    changed_links = np.unique(series["link_ids"][cols]).tolist()
+    mark_dirty(data_col, changed_links, times[rows.min()], times[rows.max()] + P_REF_WINDOW, ["p_ref"])
+    return len(rows)
+
+
+def main():
+    """Quality control of the link power"""
+    parser = argparse.ArgumentParser(
+        description="Set the QC bits of the link power records",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("-s", "--start", type=valid_date, help="Start date yyyy-mm-dd, default is the qc watermark")
+    parser.add_argument("-e", "--end", type=valid_date, help="End date yyyy-mm-dd, default is the last record")
+    parser.add_argument("--flat-steps", type=int, default=FLAT_STEPS, help="Time steps without a change that are flagged")
+    parser.add_argument("--jump", type=float, default=JUMP_DB, help="Jump in dB above the steps either side that is flagged")
+    parser.add_argument("--history", type=int, default=HISTORY_DAYS, help="Days of history for the climatological bounds")
+    parser.add_argument("--margin", type=float, default=CLIMATOLOGY_MARGIN,
+                        help="dB above the 99th percentile of p_max that is flagged")
+    parser.add_argument("--max-fade", type=float, default=MAX_FADE, help="dB below the median of p_min that is flagged")
+    args = parser.parse_args()
+    if args.flat_steps < 2:
+        parser.error("--flat-steps must be at least 2")
+
+    uri_str = "mongodb://localhost:27017"
+    myclient = pymongo.MongoClient(uri_str)
+    db = myclient["cml"]
+    cml_col = db["cml_metadata"]
+    data_col = db["cml_data"]
+    state_col = db["cml_state"]
+
+    # get the list of cmls in the area that we are working with
+    longitude = 4.0
+    latitude = 52.0
+    max_range = 250000
+    cmls = get_cmls(cml_col, longitude, latitude, max_range)
+    links = cmls["link_id"].values.astype(int).tolist()
+
+    start_time = args.start if args.start is not None else get_watermark(state_col, "qc")
+    if start_time is None:
+        parser.error("--start is needed for the first run")
+    end_time = args.end
+    if end_time is None:
+        last = data_col.find_one(projection={"time.end_time": 1}, sort=[("time.end_time", pymongo.DESCENDING)])
+        if last is None:
+            return
+        end_time = last["time"]["end_time"]
+    logging.info(f"Checking {len(links)} links from {start_time} to {end_time}")
+
+    # one day at a time so that the matrices stay small
+    period_start = start_time
+    while period_start < end_time:
+        period_end = min(period_start + timedelta(days=1), end_time)
+        number_changed = check_period(data_col, links, period_start, period_end, args)
+        set_watermark(state_col, "qc", period_end)
+        logging.info(f"Changed the QC of {number_changed} records up to {period_end}")
+        period_start = period_end
+
+
+if __name__ == "__main__":
+    main()
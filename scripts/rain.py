@@ -21,7 +21,7 @@ import pandas as pd
 import math
 import itur
 import astropy.units as u
-from db_utils import get_cmls
+from db_utils import get_cmls, get_dirty_times, get_watermark, set_watermark
 import sys
 
 sys.path.append("../scripts")
@@ -52,7 +52,8 @@ def valid_date(s: str) -> np.datetime64:
 def estimate_rain(
         ref_time: datetime,
         cmls: pd.DataFrame,
-        data_col: pymongo.collection.Collection):
+        data_col: pymongo.collection.Collection,
+        incremental: bool = True):
     """
     Use specific attenuation to estimate rain rate
 
@@ -61,9 +62,12 @@ def estimate_rain(
         cmls (pd.DataFrame): _description_
         cml_col (pymongo.collection.Collection): _description_
         data_col (pymongo.collection.Collection): _description_
+        incremental (bool): Only process the records flagged with dirty.rain
     """
     links = cmls["link_id"].values.astype(int).tolist()
     query = {"link_id": {"$in": links}, "time.end_time": ref_time}
+    if incremental:
+        query["dirty.rain"] = True
     projection = {"link_id": 1, "atten": 1, "_id": 0}
     number_links = data_col.count_documents(filter=query)
 
@@ -88,18 +92,20 @@ def estimate_rain(
             rain_rate = np.pow(gamma/k,1/alpha)
             rain_rate = np.round(rain_rate,decimals=2)
 
+        # clear the flag even if the rain rate could not be estimated
+        rain_doc = {"dirty.rain": False}
         if not math.isnan(rain_rate):
-            rain_doc = {"rain": float(rain_rate)}
-
-            # Prepare bulk update
-            updates.append(pymongo.UpdateOne(
-                {"link_id": link_id, "time.end_time": ref_time},
-                {"$set": rain_doc},
-                upsert=True
-            ))
-            if len(updates) > max_updates:
-                data_col.bulk_write(updates)
-                updates = []
+            rain_doc["rain"] = float(rain_rate)
+
+        # Prepare bulk update
+        updates.append(pymongo.UpdateOne(
+            {"link_id": link_id, "time.end_time": ref_time},
+            {"$set": rain_doc},
+            upsert=True
+        ))
+        if len(updates) > max_updates:
+            data_col.bulk_write(updates)
+            updates = []
 
     # Perform bulk write operation if there are updates
     if updates:
@@ -116,9 +122,11 @@ def main():
         formatter_class=argparse.ArgumentDefaultsHelpFormatter,
     )
     parser.add_argument("-s", "--start", type=valid_date,
-                        help="Start date yyyy-mm-dd")
+                        help="Start date yyyy-mm-dd, default is the first dirty record")
     parser.add_argument("-e", "--end", type=valid_date,
-                        help="End date yyyy-mm-dd")
+                        help="End date yyyy-mm-dd, default is the has_rain watermark")
+    parser.add_argument("-a", "--all", action="store_true",
+                        help="Process every time step between start and end, not just the dirty records")
     args = parser.parse_args()
 
     # set up the database
@@ -138,6 +146,7 @@ def main():
     db = myclient["cml"]
     cml_col = db["cml_metadata"]
     data_col = db["cml_data"]
+    state_col = db["cml_state"]
 
     # get a list of the cmls in the area that we are working with
     longitude = 4.0
@@ -150,11 +159,23 @@ def main():
     logging.info(f"Start date = {start_time}")
     logging.info(f"End date = {end_time}")
 
-    start_time_dt = pd.to_datetime(start_time).to_pydatetime()
-    end_time_dt = pd.to_datetime(end_time).to_pydatetime()
-    times = pd.date_range(start=start_time_dt, end=end_time_dt, freq="15min")
+    start_time_dt = None if start_time is None else pd.to_datetime(start_time).to_pydatetime()
+    end_time_dt = None if end_time is None else pd.to_datetime(end_time).to_pydatetime()
+    if args.all:
+        if start_time_dt is None or end_time_dt is None:
+            parser.error("--all needs --start and --end")
+        times = pd.date_range(start=start_time_dt, end=end_time_dt, freq="15min")
+    else:
+        # do not go past the time steps that have been classified
+        if end_time_dt is None:
+            end_time_dt = get_watermark(state_col, "has_rain")
+        links = cmls["link_id"].values.astype(int).tolist()
+        times = get_dirty_times(data_col, "rain", links, start_time_dt, end_time_dt)
+    logging.info(f"Processing {len(times)} time steps")
+
     for ref_time in times:
-        estimate_rain(ref_time, cmls, data_col)
+        estimate_rain(ref_time, cmls, data_col, incremental=not args.all)
+        set_watermark(state_col, "rain", ref_time)
 
 
 if __name__ == "__main__":
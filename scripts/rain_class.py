@@ -12,7 +12,9 @@ import numpy as np
 import pymongo
 import pymongo.collection
 import pandas as pd
-from db_utils import get_cmls
+from db_utils import get_cmls, get_dirty_times, get_watermark, set_watermark, mark_dirty, get_neighbours
+from db_utils import P_REF_WINDOW, RAIN_CLASS_RANGE
+from datetime import timedelta
 import sys
 
 sys.path.append("../scripts")
@@ -97,8 +99,9 @@ def classify_rain(
     ref_time: datetime,
     cmls: pd.DataFrame,
     cml_col: pymongo.collection.Collection,
-    data_col: pymongo.collection.Collection
-
+    data_col: pymongo.collection.Collection,
+    incremental: bool = True,
+    neighbour_cmls: pd.DataFrame = None
 ):
     """
     Use a RAINLINK adjacent algorithm to classify a link with rain based on a neighbourhood search
@@ -110,11 +113,16 @@ def classify_rain(
         cml_col: (pymongo.collection.Collection): CML metadata
         data_col: (pymongo.collection.Collection): Time series CML data
         ref_time (datetime): Time for processing
+        incremental (bool): Only process the records flagged with dirty.has_rain
+        neighbour_cmls (pd.DataFrame): Links to search for neighbours in memory, e.g. a partition
+            and its halo. Defaults to a spatial query on cml_col for each link.
     """
 
     links = cmls["link_id"].values.astype(int).tolist()
     query = {"link_id": {"$in": links}, "time.end_time": ref_time}
-    projection = {"link_id": 1, "_id": 0}
+    if incremental:
+        query["dirty.has_rain"] = True
+    projection = {"link_id": 1, "atten.has_rain": 1, "_id": 0}
     number_links = data_col.count_documents(filter=query)
 
     # no links found so return
@@ -124,6 +132,7 @@ def classify_rain(
     max_updates = 1000
     updates = []
     number_rain = 0
+    changed_links = []
     for doc in data_col.find(filter=query, projection=projection):
         link_id = doc.get("link_id")
         if link_id is not None:
@@ -131,44 +140,57 @@ def classify_rain(
 
             # Get the list of nearest neighbour cmls, including the target cml
             neighbours = []
-            max_range = 10000
-            mid_lon = float(cmls.loc[cmls["link_id"] == link_id, "mid_lon"].iloc[0])
-            mid_lat = float(cmls.loc[cmls["link_id"] == link_id, "mid_lat"].iloc[0])
-            n_query = {
-                "properties.midpoint": {
-                    "$nearSphere": {
-                        "$geometry": {"type": "Point", "coordinates": [mid_lon, mid_lat]},
-                        "$maxDistance": max_range,
+            max_range = RAIN_CLASS_RANGE
+            if neighbour_cmls is not None:
+                neighbours = get_neighbours(neighbour_cmls, [link_id], max_range)
+            else:
+                mid_lon = float(cmls.loc[cmls["link_id"] == link_id, "mid_lon"].iloc[0])
+                mid_lat = float(cmls.loc[cmls["link_id"] == link_id, "mid_lat"].iloc[0])
+                n_query = {
+                    "properties.midpoint": {
+                        "$nearSphere": {
+                            "$geometry": {"type": "Point", "coordinates": [mid_lon, mid_lat]},
+                            "$maxDistance": max_range,
+                        }
                     }
                 }
-            }
-            n_projection = {"properties.link_id": 1, "_id": 0}
+                n_projection = {"properties.link_id": 1, "_id": 0}
 
-            for n_doc in cml_col.find(filter=n_query, projection=n_projection):
-                if n_doc:
-                    neighbours.append(int(n_doc["properties"]["link_id"]))
+                for n_doc in cml_col.find(filter=n_query, projection=n_projection):
+                    if n_doc:
+                        neighbours.append(int(n_doc["properties"]["link_id"]))
 
             has_rain = is_raining(link_id, neighbours, ref_time, data_col)
-
-            # assume that the default value for has_rain in the timeseries data is False
             if has_rain:
                 number_rain += 1
-                atten_doc = {"atten.has_rain": has_rain}
-
-                # Prepare bulk update
-                updates.append(pymongo.UpdateOne(
-                    {"link_id": link_id, "time.end_time": ref_time},
-                    {"$set": atten_doc},
-                    upsert=True
-                ))
-                if len(updates) > max_updates:
-                    data_col.bulk_write(updates)
-                    updates = []
+
+            # The classification is written for every record so that a rerun can
+            # change a link back to dry. A change in the classification changes the
+            # dry periods used for the reference power over the next 24 h
+            old_has_rain = doc.get("atten", {}).get("has_rain", False)
+            if has_rain != old_has_rain:
+                changed_links.append(link_id)
+            atten_doc = {"atten.has_rain": has_rain, "dirty.has_rain": False}
+
+            # Prepare bulk update
+            updates.append(pymongo.UpdateOne(
+                {"link_id": link_id, "time.end_time": ref_time},
+                {"$set": atten_doc},
+                upsert=True
+            ))
+            if len(updates) > max_updates:
+                data_col.bulk_write(updates)
+                updates = []
 
     # Perform bulk write operation if there are updates
     if updates:
         data_col.bulk_write(updates)
 
+    # Only flag the following time steps so that a link cannot flip between rain and
+    # no-rain at the same time step, the effect of one record on the median is small
+    next_time = ref_time + timedelta(minutes=15)
+    mark_dirty(data_col, changed_links, next_time, ref_time + P_REF_WINDOW, ["p_ref"])
+
     logging.info(f"Classified rain at {number_rain} links at {ref_time}")
     return
 
@@ -180,9 +202,11 @@ def main():
         formatter_class=argparse.ArgumentDefaultsHelpFormatter,
     )
     parser.add_argument("-s", "--start", type=valid_date,
-                        help="Start date yyyy-mm-dd")
+                        help="Start date yyyy-mm-dd, default is the first dirty record")
     parser.add_argument("-e", "--end", type=valid_date,
-                        help="End date yyyy-mm-dd")
+                        help="End date yyyy-mm-dd, default is the atten watermark")
+    parser.add_argument("-a", "--all", action="store_true",
+                        help="Process every time step between start and end, not just the dirty records")
     args = parser.parse_args()
 
     # print out some info
@@ -206,6 +230,7 @@ def main():
     db = myclient["cml"]
     cml_col = db["cml_metadata"]
     data_col = db["cml_data"]
+    state_col = db["cml_state"]
 
     # get a list of the cmls in the area that we are working with
     longitude = 4.0
@@ -218,11 +243,23 @@ def main():
     logging.info(f"Start date = {start_time}")
     logging.info(f"End date = {end_time}")
 
-    start_time_dt = pd.to_datetime(start_time).to_pydatetime()
-    end_time_dt = pd.to_datetime(end_time).to_pydatetime()
-    times = pd.date_range(start=start_time_dt, end=end_time_dt, freq="15min")
+    start_time_dt = None if start_time is None else pd.to_datetime(start_time).to_pydatetime()
+    end_time_dt = None if end_time is None else pd.to_datetime(end_time).to_pydatetime()
+    if args.all:
+        if start_time_dt is None or end_time_dt is None:
+            parser.error("--all needs --start and --end")
+        times = pd.date_range(start=start_time_dt, end=end_time_dt, freq="15min")
+    else:
+        # do not go past the time steps that have an attenuation
+        if end_time_dt is None:
+            end_time_dt = get_watermark(state_col, "atten")
+        links = cmls["link_id"].values.astype(int).tolist()
+        times = get_dirty_times(data_col, "has_rain", links, start_time_dt, end_time_dt)
+    logging.info(f"Processing {len(times)} time steps")
+
     for ref_time in times:
-        classify_rain(ref_time, cmls, cml_col, data_col)
+        classify_rain(ref_time, cmls, cml_col, data_col, incremental=not args.all)
+        set_watermark(state_col, "has_rain", ref_time)
 
 
 if __name__ == "__main__":
@@ -19,7 +19,7 @@ import pymongo.collection
 import pandas as pd
 import time 
 
-from db_utils import get_cmls, calc_p_ref
+from db_utils import get_cmls, calc_p_ref, get_dirty_times, get_watermark, set_watermark, is_same
 
 import logging
 logging.basicConfig(level=logging.INFO)
@@ -43,18 +43,21 @@ def valid_date(s: str) -> np.datetime64:
         raise argparse.ArgumentTypeError(f"Not a valid date: {s!r}") from e
 
 
-def calculate_ref_power(ref_time:datetime, links:int, data_col:pymongo.collection.Collection):
+def calculate_ref_power(ref_time:datetime, links:int, data_col:pymongo.collection.Collection, incremental:bool=True):
     """Calculate reference power for a set of links at ref_time
 
     Args:
         ref_time (datetime): Time
         links ([int]): List of links to be processed
         data_col (pymongo.collection.Collection): data collection 
+        incremental (bool): Only process the records flagged with dirty.p_ref
     """    
 
     # get the links with data at this time step 
     query = {"link_id":{"$in":links}, "time.end_time":ref_time}
-    projection = {"link_id":1, "_id":0}
+    if incremental:
+        query["dirty.p_ref"] = True
+    projection = {"link_id":1, "atten.p_ref":1, "_id":0}
     number_links = data_col.count_documents(filter=query)
 
     # no links found so return 
@@ -68,7 +71,11 @@ def calculate_ref_power(ref_time:datetime, links:int, data_col:pymongo.collectio
 
         # Calculate the reference power
         p_ref = calc_p_ref(link_id, data_col, ref_time)
-        p_ref_doc = {"atten.p_ref": p_ref}
+        p_ref_doc = {"atten.p_ref": p_ref, "dirty.p_ref": False}
+
+        # the attenuation only needs to be recalculated if p_ref has changed
+        if not is_same(doc.get("atten", {}).get("p_ref"), p_ref):
+            p_ref_doc["dirty.atten"] = True
 
         # Prepare bulk update
         updates.append(pymongo.UpdateOne(
@@ -92,8 +99,9 @@ def main():
         description="Calculate the maximum valid Pmin over 24 h",
         formatter_class=argparse.ArgumentDefaultsHelpFormatter,
     )
-    parser.add_argument("-s", "--start", type=valid_date, help="Start date yyyy-mm-dd")
-    parser.add_argument("-e", "--end", type=valid_date, help="End date yyyy-mm-dd")
+    parser.add_argument("-s", "--start", type=valid_date, help="Start date yyyy-mm-dd, default is the first dirty record")
+    parser.add_argument("-e", "--end", type=valid_date, help="End date yyyy-mm-dd, default is the last dirty record")
+    parser.add_argument("-a", "--all", action="store_true", help="Process every time step between start and end, not just the dirty records")
     args = parser.parse_args()
 
     # print out some info
@@ -120,6 +128,7 @@ def main():
     db = myclient["cml"]
     cml_col = db["cml_metadata"]
     data_col = db["cml_data"]
+    state_col = db["cml_state"]
 
     # get the list of cmls in the links dictionary in the area that we are working with
     longitude = 4.0
@@ -129,11 +138,19 @@ def main():
     links = cmls["link_id"].values.tolist() 
 
     # make the list of 15 min times to be processed 
-    start_time_dt = pd.to_datetime(start_time).to_pydatetime()
-    end_time_dt = pd.to_datetime(end_time).to_pydatetime()
-    times = pd.date_range(start=start_time_dt, end=end_time_dt, freq="15min")
+    start_time_dt = None if start_time is None else pd.to_datetime(start_time).to_pydatetime()
+    end_time_dt = None if end_time is None else pd.to_datetime(end_time).to_pydatetime()
+    if args.all:
+        if start_time_dt is None or end_time_dt is None:
+            parser.error("--all needs --start and --end")
+        times = pd.date_range(start=start_time_dt, end=end_time_dt, freq="15min")
+    else:
+        times = get_dirty_times(data_col, "p_ref", links, start_time_dt, end_time_dt)
+    logging.info(f"Processing {len(times)} time steps, watermark = {get_watermark(state_col, 'p_ref')}")
+
     for ref_time in times:
-        calculate_ref_power(ref_time, links, data_col)
+        calculate_ref_power(ref_time, links, data_col, incremental=not args.all)
+        set_watermark(state_col, "p_ref", ref_time)
 
 if __name__ == "__main__":
     main()
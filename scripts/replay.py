@@ -0,0 +1,305 @@
+"""
+    Replay historical data through the processing chain in real time
+
+    The records for each 15 min time step are copied from a source collection into a
+    fresh replay collection at the time that they would have arrived, scaled by
+    --speed, and each time step is then run through the reference power, attenuation,
+    rain classification and rain estimation, and optionally cml_interpolate. The
+    latency from a time step arriving to its map being written, the time in each
+    stage and the backlog of time steps waiting to be processed are written as a JSON
+    line per step, with a summary of the latency percentiles at the end.
+
+    The latency and the wait are from the time that a step was due, so the time that a
+    step was held back by a slow step is counted. The replay is keeping up if the
+    backlog stays at zero, increase --speed or use a larger source (see
+    make_test_data.py) to find where it falls behind. With --speed 0 all the steps
+    are copied at the start and the throughput is reported instead.
+
+"""
+import sys
+
+sys.path.append("../scripts")
+
+import argparse
+import json
+import logging
+import os
+import subprocess
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+import pymongo
+import pymongo.collection
+
+from db_utils import get_cmls, dirty_flags, mark_ingested
+from db_indexes import apply_indexes
+from reference_power import calculate_ref_power
+from attenuation import calculate_attenuation
+from rain_class import classify_rain
+from rain import estimate_rain
+
+logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
+
+# Length of the sampling period in the time series data
+TIME_STEP = timedelta(minutes=15)
+
+
+def valid_date(s: str) -> np.datetime64:
+    """
+    Validate and parse a date string.
+
+    Args:
+        s (str): The date string to validate.
+
+    Returns:
+        np.datetime64: The parsed datetime object.
+
+    Raises:
+        argparse.ArgumentTypeError: If the date string is not valid.
+    """
+    try:
+        return np.datetime64(s)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(f"Not a valid date: {s!r}") from e
+
+
+def emit_step(
+    source_col: pymongo.collection.Collection,
+    replay_col: pymongo.collection.Collection,
+    ref_time: datetime,
+) -> int:
+    """
+    Copy the power records for a time step into the replay collection on the server,
+    as they would arrive from the collector without any of the processing results
+
+    Args:
+        source_col (pymongo.collection.Collection): Historical time series data
+        replay_col (pymongo.collection.Collection): Replay time series data
+        ref_time (datetime): Time step to copy
+
+    Returns:
+        int: Number of records copied
+    """
+    source_col.aggregate([
+        {"$match": {"time.end_time": ref_time}},
+        {"$project": {"_id": 0, "link_id": 1, "time": 1, "power": 1}},
+        {"$set": {
+            "atten": {
+                "p_ref": float("NaN"),
+                "has_rain": False,
+                "atten": float("NaN"),
+                "s_atten": float("NaN"),
+            },
+            "dirty": dirty_flags(),
+            "version": 1,
+        }},
+        {"$merge": {"into": replay_col.name, "whenMatched": "replace", "whenNotMatched": "insert"}},
+    ])
+    link_ids = replay_col.distinct("link_id", {"time.end_time": ref_time})
+    mark_ingested(replay_col, link_ids, ref_time, ref_time)
+    return len(link_ids)
+
+
+def process_step(
+    ref_time: datetime,
+    cmls: pd.DataFrame,
+    cml_col: pymongo.collection.Collection,
+    replay_col: pymongo.collection.Collection,
+    interp_cmd: list,
+) -> dict:
+    """
+    Run a time step through the processing chain
+
+    Args:
+        ref_time (datetime): Time step to process
+        cmls (pd.DataFrame): Links in the domain
+        cml_col (pymongo.collection.Collection): Link metadata
+        replay_col (pymongo.collection.Collection): Replay time series data
+        interp_cmd (list): cml_interpolate command without the times, None to skip the maps
+
+    Returns:
+        dict: Time in s for each stage
+    """
+    links = cmls["link_id"].values.astype(int).tolist()
+    stages = [
+        ("p_ref", lambda: calculate_ref_power(ref_time, links, replay_col)),
+        ("atten", lambda: calculate_attenuation(ref_time, cmls, replay_col)),
+        ("has_rain", lambda: classify_rain(ref_time, cmls, cml_col, replay_col, neighbour_cmls=cmls)),
+        ("rain", lambda: estimate_rain(ref_time, cmls, replay_col)),
+    ]
+    if interp_cmd is not None:
+        iso_time = ref_time.strftime("%Y-%m-%dT%H:%M:%SZ")
+        command = interp_cmd + ["--start", iso_time, "--end", iso_time]
+        stages.append(("interp", lambda: subprocess.run(command, check=True, capture_output=True)))
+
+    timings = {}
+    for name, stage in stages:
+        start = time.perf_counter()
+        stage()
+        timings[name] = round(time.perf_counter() - start, 3)
+    return timings
+
+
+def summarise(steps: list, elapsed: float, real_time: bool) -> dict:
+    """
+    Latency percentiles and backlog for the replay, or the throughput if the time
+    steps were replayed as fast as possible
+
+    Args:
+        steps (list): Metrics for each time step
+        elapsed (float): Time for the replay in s
+        real_time (bool): The time steps were copied at their due times
+
+    Returns:
+        dict: Summary of the replay
+    """
+    if not steps:
+        return {"time_steps": 0}
+    number_records = int(sum(step["records"] for step in steps))
+    summary = {
+        "time_steps": len(steps),
+        "records": number_records,
+    }
+    if real_time:
+        latency = np.array([step["latency_s"] for step in steps])
+        summary.update({
+            "latency_p50_s": round(float(np.percentile(latency, 50)), 3),
+            "latency_p95_s": round(float(np.percentile(latency, 95)), 3),
+            "latency_p99_s": round(float(np.percentile(latency, 99)), 3),
+            "latency_max_s": round(float(latency.max()), 3),
+            "max_backlog": int(max(step["backlog"] for step in steps)),
+            "max_wait_s": round(float(max(step["wait_s"] for step in steps)), 3),
+        })
+    else:
+        summary.update({
+            "elapsed_s": round(elapsed, 3),
+            "steps_per_s": round(len(steps) / elapsed, 3) if elapsed > 0 else None,
+            "records_per_s": round(number_records / elapsed, 1) if elapsed > 0 else None,
+        })
+    for name in steps[0]["stages"]:
+        summary[f"{name}_mean_s"] = round(float(np.mean([step["stages"][name] for step in steps])), 3)
+    if real_time:
+        summary["kept_up"] = summary["max_backlog"] == 0
+    return summary
+
+
+def main():
+    """Replay historical data through the processing chain and measure the latency"""
+    parser = argparse.ArgumentParser(
+        description="Replay historical data through the processing chain in real time",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("-s", "--start", type=valid_date, required=True, help="Start date yyyy-mm-ddTHH:MM")
+    parser.add_argument("-e", "--end", type=valid_date, required=True, help="End date yyyy-mm-ddTHH:MM")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="Replay speed-up, 1 is real time and 0 is as fast as possible")
+    parser.add_argument("--source", default="cml_data", help="Collection to replay")
+    parser.add_argument("--replay", default="cml_replay", help="Collection for the replay, it is dropped first")
+    parser.add_argument("--metadata", default="cml_metadata", help="Link metadata collection")
+    parser.add_argument("--interp", help="cml_interpolate executable, the maps are not made if not given")
+    parser.add_argument("--interp-config", help="cml_interpolate config, data_collection is set to the replay")
+    parser.add_argument("--metrics-file", help="File for a JSON line per time step and the summary")
+    args = parser.parse_args()
+
+    # the replay collection is dropped, so it must not be the data being replayed
+    if args.replay in (args.source, "cml_data"):
+        parser.error(f"--replay {args.replay} would drop the source data, use another collection")
+
+    uri_str = "mongodb://localhost:27017"
+    myclient = pymongo.MongoClient(uri_str)
+    db = myclient["cml"]
+    cml_col = db[args.metadata]
+    source_col = db[args.source]
+    replay_col = db[args.replay]
+    replay_col.drop()
+    apply_indexes(replay_col)
+
+    # get a list of the cmls in the area that we are working with
+    longitude = 4.0
+    latitude = 52.0
+    max_range = 250000
+    cmls = get_cmls(cml_col, longitude, latitude, max_range)
+
+    # point cml_interpolate at the replay collection
+    interp_cmd = None
+    config_path = None
+    if args.interp is not None:
+        if args.interp_config is None:
+            parser.error("--interp needs --interp-config")
+        with open(args.interp_config) as f:
+            config = json.load(f)
+        config["data_collection"] = args.replay
+        config["metadata_collection"] = args.metadata
+        config_file = tempfile.NamedTemporaryFile("w", suffix=".json", delete=False)
+        json.dump(config, config_file)
+        config_file.close()
+        config_path = config_file.name
+        interp_cmd = [args.interp, "--config", config_path]
+
+    # the config file for cml_interpolate is removed however the replay ends
+    try:
+        start_time = pd.to_datetime(args.start).to_pydatetime()
+        end_time = pd.to_datetime(args.end).to_pydatetime()
+        times = [t.to_pydatetime() for t in pd.date_range(start=start_time, end=end_time, freq="15min")]
+        real_time = args.speed > 0
+        step_seconds = TIME_STEP.total_seconds() / args.speed if real_time else 0.0
+        logging.info(f"Replaying {len(times)} time steps from {args.source} with a step every {step_seconds:.1f} s")
+
+        metrics_file = open(args.metrics_file, "w") if args.metrics_file else None
+        replay_start = time.perf_counter()
+        steps = []
+        pending = []
+        number_emitted = 0
+        while number_emitted < len(times) or pending:
+            # emit every time step that is due, the ones that are not processed yet are the backlog,
+            # a step arrives at the time it was due even if it is emitted late
+            now = time.perf_counter() - replay_start
+            while number_emitted < len(times) and number_emitted * step_seconds <= now:
+                ref_time = times[number_emitted]
+                records = emit_step(source_col, replay_col, ref_time)
+                pending.append((ref_time, number_emitted * step_seconds, records))
+                number_emitted += 1
+
+            if not pending:
+                time.sleep(max(0.0, number_emitted * step_seconds - now))
+                continue
+
+            # process the oldest time step
+            ref_time, arrival, records = pending.pop(0)
+            backlog = len(pending)
+            started = time.perf_counter() - replay_start
+            stages = process_step(ref_time, cmls, cml_col, replay_col, interp_cmd)
+            done = time.perf_counter() - replay_start
+            step = {"time": ref_time.isoformat(), "records": records}
+            if real_time:
+                step.update({
+                    "latency_s": round(done - arrival, 3),
+                    "wait_s": round(started - arrival, 3),
+                    "backlog": backlog,
+                })
+                message = f"latency {step['latency_s']} s, backlog {backlog} steps"
+            else:
+                step["process_s"] = round(done - started, 3)
+                message = f"processed in {step['process_s']} s"
+            step["stages"] = stages
+            steps.append(step)
+            logging.info(f"{step['time']} {records} records, {message}")
+            if metrics_file is not None:
+                metrics_file.write(json.dumps(step) + "\n")
+                metrics_file.flush()
+
+        summary = summarise(steps, time.perf_counter() - replay_start, real_time)
+        logging.info(f"Summary {json.dumps(summary)}")
+        if metrics_file is not None:
+            metrics_file.write(json.dumps({"summary": summary}) + "\n")
+            metrics_file.close()
+    finally:
+        if config_path is not None:
+            os.unlink(config_path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,430 @@
+"""
+    Compact the old time series data into daily summaries
+
+    The records in cml_data that are older than --age days are summarised by link
+    and day into the cml_daily collection, written to a compressed BSON archive
+    (a file per day and run, readable with bson.decode_file_iter or mongorestore after
+    gunzip), and then deleted. The records are marked with a run id first, so the
+    summary, archive and delete all see the same records even if late data arrive
+    while a day is compacted. Late records for a day that was compacted before are
+    merged into its summary and written to a new part file, so nothing that has been
+    archived is overwritten. A run that stops part way is finished by the next one
+    with the same run id: the part file of the run is only written once and the
+    summary keeps the run ids that have been merged into it, so no record is counted
+    twice. The summaries expire through a TTL index and the archives older than
+    --keep-archive days are deleted, so the hot collection and its indexes stay a
+    bounded size.
+
+    The summaries keep the statistics needed to start the reference power without
+    the raw data (the median and number of the dry (p_min+p_max)/2 values, as used by
+    calc_p_ref) and for climatology (power range, attenuation and rain totals).
+
+"""
+import sys
+
+sys.path.append("../scripts")
+
+import argparse
+import gzip
+import logging
+import os
+import uuid
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import pymongo
+import pymongo.collection
+
+from db_indexes import apply_indexes
+
+logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
+
+# Length of the sampling period, used to convert the rain rates into depths
+TIME_STEP_HOURS = 0.25
+
+
+def is_null(value) -> dict:
+    """
+    Expression that is true if a value is null or missing
+
+    Args:
+        value: Field path or expression
+
+    Returns:
+        dict: Aggregation expression
+    """
+    return {"$eq": [{"$ifNull": [value, None]}, None]}
+
+
+def weighted_mean(field: str, weight: str) -> dict:
+    """
+    Expression for the $merge pipeline that combines the mean of a field in the
+    existing summary with the mean in the new summary
+
+    Args:
+        field (str): Name of the mean
+        weight (str): Name of the count for the mean
+
+    Returns:
+        dict: Aggregation expression, the mean that is not null if one of them is null
+    """
+    old, new = f"${field}", f"$$new.{field}"
+    w_old, w_new = f"${weight}", f"$$new.{weight}"
+    return {"$switch": {
+        "branches": [
+            {"case": is_null(old), "then": new},
+            {"case": is_null(new), "then": old},
+            {"case": {"$eq": [{"$add": [w_old, w_new]}, 0]}, "then": None},
+        ],
+        "default": {"$divide": [
+            {"$add": [{"$multiply": [old, w_old]}, {"$multiply": [new, w_new]}]},
+            {"$add": [w_old, w_new]},
+        ]},
+    }}
+
+
+def merge_summaries(run_id: str) -> list:
+    """
+    Pipeline for $merge that adds the summary of late records to the existing
+    summary for the link and day. The counts, sums and extremes are exact, the
+    standard deviation is pooled from the means, and the means and the dry median
+    are weighted by the counts, so the median is an approximation. A summary that
+    already has the run is left as it is, so a run can be merged again after a crash.
+
+    Args:
+        run_id (str): Run that made the new summary
+
+    Returns:
+        list: whenMatched pipeline
+    """
+    # mean of (p_min+p_max)/2 in each summary, for the pooled standard deviation
+    m_old = {"$avg": ["$p_min_mean", "$p_max_mean"]}
+    m_new = {"$avg": ["$$new.p_min_mean", "$$new.p_max_mean"]}
+    pooled_std = {"$let": {
+        "vars": {"n1": "$count", "n2": "$$new.count", "m1": m_old, "m2": m_new},
+        "in": {"$let": {
+            "vars": {"m": {"$divide": [
+                {"$add": [{"$multiply": ["$$n1", "$$m1"]}, {"$multiply": ["$$n2", "$$m2"]}]},
+                {"$add": ["$$n1", "$$n2"]},
+            ]}},
+            "in": {"$sqrt": {"$divide": [
+                {"$add": [
+                    {"$multiply": ["$$n1", {"$add": [
+                        {"$pow": ["$p_ave_std", 2]}, {"$pow": [{"$subtract": ["$$m1", "$$m"]}, 2]}]}]},
+                    {"$multiply": ["$$n2", {"$add": [
+                        {"$pow": ["$$new.p_ave_std", 2]}, {"$pow": [{"$subtract": ["$$m2", "$$m"]}, 2]}]}]},
+                ]},
+                {"$add": ["$$n1", "$$n2"]},
+            ]}},
+        }},
+    }}
+    merged = {
+        "count": {"$add": ["$count", "$$new.count"]},
+        "p_min_min": {"$min": ["$p_min_min", "$$new.p_min_min"]},
+        "p_min_mean": weighted_mean("p_min_mean", "count"),
+        "p_max_max": {"$max": ["$p_max_max", "$$new.p_max_max"]},
+        "p_max_mean": weighted_mean("p_max_mean", "count"),
+        "p_ave_std": pooled_std,
+        "p_ref_mean": weighted_mean("p_ref_mean", "count"),
+        "atten_max": {"$max": ["$atten_max", "$$new.atten_max"]},
+        "rain_count": {"$add": ["$rain_count", "$$new.rain_count"]},
+        "rain_depth": {"$add": ["$rain_depth", "$$new.rain_depth"]},
+        "rain_max": {"$max": ["$rain_max", "$$new.rain_max"]},
+        "dry_count": {"$add": ["$dry_count", "$$new.dry_count"]},
+        "dry_p_ave_median": weighted_mean("dry_p_ave_median", "dry_count"),
+    }
+    runs = {"$ifNull": ["$runs", []]}
+    is_merged = {"$in": [run_id, runs]}
+    fields = {field: {"$cond": [is_merged, f"${field}", value]} for field, value in merged.items()}
+    fields["runs"] = {"$setUnion": [runs, [run_id]]}
+    return [{"$set": fields}]
+
+
+def day_query(day: datetime, run_id: str = None) -> dict:
+    """
+    Query for the records of one day
+
+    Args:
+        day (datetime): Start of the day (UTC)
+        run_id (str, optional): Only the records marked by this run. Defaults to None.
+
+    Returns:
+        dict: Query for cml_data
+    """
+    query = {"time.end_time": {"$gt": day, "$lte": day + timedelta(days=1)}}
+    if run_id is not None:
+        query["retention_run"] = run_id
+    return query
+
+
+def summary_pipeline(day: datetime, daily_name: str, run_id: str) -> list:
+    """
+    Aggregation pipeline that summarises one day of records per link and merges the
+    results into the daily collection, adding to any summary from an earlier run
+
+    Args:
+        day (datetime): Start of the day (UTC)
+        daily_name (str): Name of the daily summary collection
+        run_id (str): Only the records marked by this run are summarised
+
+    Returns:
+        list: Pipeline for cml_data
+    """
+    p_ave = {"$divide": [{"$add": ["$power.p_min", "$power.p_max"]}, 2]}
+    is_dry = {"$eq": ["$atten.has_rain", False]}
+    return [
+        {"$match": day_query(day, run_id)},
+        {"$group": {
+            "_id": {"link_id": "$link_id", "date": day},
+            "count": {"$sum": 1},
+            "p_min_min": {"$min": "$power.p_min"},
+            "p_min_mean": {"$avg": "$power.p_min"},
+            "p_max_max": {"$max": "$power.p_max"},
+            "p_max_mean": {"$avg": "$power.p_max"},
+            "p_ave_std": {"$stdDevPop": p_ave},
+            "dry_p_ave": {"$push": {"$cond": [is_dry, p_ave, "$$REMOVE"]}},
+            "p_ref_mean": {"$avg": {"$cond": [{"$eq": ["$atten.p_ref", float("NaN")]}, None, "$atten.p_ref"]}},
+            "atten_max": {"$max": {"$cond": [{"$eq": ["$atten.atten", float("NaN")]}, None, "$atten.atten"]}},
+            "rain_count": {"$sum": {"$cond": ["$atten.has_rain", 1, 0]}},
+            "rain_depth": {"$sum": {"$multiply": [{"$ifNull": ["$rain", 0]}, TIME_STEP_HOURS]}},
+            "rain_max": {"$max": "$rain"},
+        }},
+        {"$set": {
+            "link_id": "$_id.link_id",
+            "date": "$_id.date",
+            "dry_count": {"$size": "$dry_p_ave"},
+            "dry_p_ave_median": {"$median": {"input": "$dry_p_ave", "method": "approximate"}},
+            "runs": [run_id],
+        }},
+        {"$unset": "dry_p_ave"},
+        {"$merge": {"into": daily_name, "on": "_id", "whenMatched": merge_summaries(run_id), "whenNotMatched": "insert"}},
+    ]
+
+
+def archive_path(archive_dir: Path, data_name: str, day: datetime, run_id: str) -> Path:
+    """
+    Name of the archive file for the records of a day marked by a run, each run
+    writes its own part file so the earlier archives for the day are kept
+
+    Args:
+        archive_dir (Path): Directory for the archive files
+        data_name (str): Name of the time series collection
+        day (datetime): Start of the day (UTC)
+        run_id (str): Run that marked the records
+
+    Returns:
+        Path: Archive file, it exists if the run has already archived the records
+    """
+    return archive_dir / f"{data_name}_{day:%Y-%m-%d}.{run_id}.bson.gz"
+
+
+def archive_day(
+    data_col: pymongo.collection.Collection,
+    query: dict,
+    file_path: Path,
+) -> int:
+    """
+    Write the raw records for one day to a gzip compressed BSON file
+
+    Args:
+        data_col (pymongo.collection.Collection): Time series CML data
+        query (dict): Records to be archived
+        file_path (Path): Archive file
+
+    Returns:
+        int: Number of documents archived
+    """
+    tmp_path = file_path.with_suffix(".tmp")
+
+    # the raw batches are concatenated BSON documents, so they are written without
+    # decoding and counted from the length at the start of each document
+    number_docs = 0
+    with gzip.open(tmp_path, "wb") as f:
+        for batch in data_col.find_raw_batches(query, sort=[("link_id", 1), ("time.end_time", 1)]):
+            f.write(batch)
+            offset = 0
+            while offset < len(batch):
+                offset += int.from_bytes(batch[offset:offset + 4], "little")
+                number_docs += 1
+
+    os.replace(tmp_path, file_path)
+    return number_docs
+
+
+def prune_archives(archive_dir: Path, data_name: str, keep_until: datetime) -> list:
+    """
+    Delete the archive files for days before a date
+
+    Args:
+        archive_dir (Path): Directory for the archive files
+        data_name (str): Name of the time series collection
+        keep_until (datetime): Oldest day to keep
+
+    Returns:
+        list: Files that were deleted
+    """
+    deleted = []
+    for file_path in sorted(archive_dir.glob(f"{data_name}_*.bson.gz")):
+        # the date is followed by the run id of the part
+        try:
+            day = datetime.strptime(file_path.name[len(data_name) + 1:len(data_name) + 11], "%Y-%m-%d")
+        except ValueError:
+            continue
+        if day < keep_until:
+            file_path.unlink()
+            deleted.append(file_path.name)
+    return deleted
+
+
+def set_summary_ttl(daily_col: pymongo.collection.Collection, days: int):
+    """
+    Set the time that the daily summaries are kept
+
+    Args:
+        daily_col (pymongo.collection.Collection): Daily summaries
+        days (int): Days to keep the summaries
+    """
+    apply_indexes(daily_col)
+    seconds = int(days * 86400)
+    ttl = daily_col.index_information()["date_ttl"].get("expireAfterSeconds")
+    if ttl != seconds:
+        daily_col.database.command({
+            "collMod": daily_col.name,
+            "index": {"name": "date_ttl", "expireAfterSeconds": seconds},
+        })
+        logging.info(f"Daily summaries in {daily_col.name} now expire after {days} days")
+
+
+def compact_run(
+    data_col: pymongo.collection.Collection,
+    daily_col: pymongo.collection.Collection,
+    day: datetime,
+    run_id: str,
+    archive_dir: Path,
+) -> int:
+    """
+    Archive, summarise and delete the records of one day that are marked by a run.
+    Each step can be repeated if the run stopped part way: the archive is not
+    written again once it exists, and the summaries that have the run are not changed.
+
+    Args:
+        data_col (pymongo.collection.Collection): Time series CML data
+        daily_col (pymongo.collection.Collection): Daily summaries
+        day (datetime): Start of the day (UTC)
+        run_id (str): Run that marked the records
+        archive_dir (Path): Directory for the archive files, None to delete without archiving
+
+    Returns:
+        int: Number of records deleted
+    """
+    # the summaries are added to, so they are only merged once the archive is complete
+    query = day_query(day, run_id)
+    if archive_dir is not None:
+        file_path = archive_path(archive_dir, data_col.name, day, run_id)
+        if not file_path.exists():
+            number_docs = data_col.count_documents(query)
+            number_archived = archive_day(data_col, query, file_path)
+            if number_archived != number_docs:
+                file_path.unlink()
+                logging.warning(f"Archived {number_archived} of {number_docs} records for {day:%Y-%m-%d}, not deleted")
+                return 0
+    data_col.aggregate(summary_pipeline(day, daily_col.name, run_id))
+
+    # every marked record is in the archive
+    result = data_col.delete_many(query)
+    return result.deleted_count
+
+
+def compact_day(
+    data_col: pymongo.collection.Collection,
+    daily_col: pymongo.collection.Collection,
+    day: datetime,
+    archive_dir: Path,
+) -> int:
+    """
+    Summarise, archive and delete one day of records.
+    The records are marked with a run id first and only the marked records are
+    summarised, archived and deleted, so a record that arrives during the run is
+    left for the next one. Nothing is summarised or deleted unless the archive has
+    been written. Records that are still marked by a run that did not finish are
+    done first with the id of that run, and are not marked again.
+
+    Args:
+        data_col (pymongo.collection.Collection): Time series CML data
+        daily_col (pymongo.collection.Collection): Daily summaries
+        day (datetime): Start of the day (UTC)
+        archive_dir (Path): Directory for the archive files, None to delete without archiving
+
+    Returns:
+        int: Number of records deleted
+    """
+    run_ids = data_col.distinct("retention_run", day_query(day))
+    if run_ids:
+        logging.warning(f"Finishing {len(run_ids)} earlier runs for {day:%Y-%m-%d}")
+
+    run_id = uuid.uuid4().hex
+    query = day_query(day)
+    query["retention_run"] = {"$exists": False}
+    if data_col.update_many(query, {"$set": {"retention_run": run_id}}).matched_count > 0:
+        run_ids.append(run_id)
+
+    return sum(compact_run(data_col, daily_col, day, marked_by, archive_dir) for marked_by in run_ids)
+
+
+def main():
+    """Compact the old time series data into daily summaries"""
+    parser = argparse.ArgumentParser(
+        description="Summarise, archive and delete the old records in cml_data",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("--age", type=int, default=90, help="Days of raw records to keep")
+    parser.add_argument("--archive-dir", type=Path, default=Path("archive"),
+                        help="Directory for the compressed daily archives")
+    parser.add_argument("--no-archive", action="store_true", help="Delete the raw records without archiving them")
+    parser.add_argument("--keep-archive", type=int, default=730, help="Days to keep the archive files")
+    parser.add_argument("--keep-summary", type=int, default=3650, help="Days to keep the daily summaries")
+    parser.add_argument("--data", default="cml_data", help="Time series collection")
+    parser.add_argument("--daily", default="cml_daily", help="Daily summary collection")
+    parser.add_argument("--dry-run", action="store_true", help="List the days that would be compacted")
+    args = parser.parse_args()
+
+    uri_str = "mongodb://localhost:27017"
+    myclient = pymongo.MongoClient(uri_str)
+    db = myclient["cml"]
+    data_col = db[args.data]
+    daily_col = db[args.daily]
+
+    # whole days (end times in (day, day + 1]) that are older than the cutoff
+    today = datetime.combine(datetime.utcnow().date(), datetime.min.time())
+    cutoff = today - timedelta(days=args.age)
+    first_doc = data_col.find_one(sort=[("time.end_time", pymongo.ASCENDING)], projection={"time": 1})
+    days = []
+    if first_doc is not None:
+        day = datetime.combine((first_doc["time"]["end_time"] - timedelta(microseconds=1)).date(), datetime.min.time())
+        while day + timedelta(days=1) <= cutoff:
+            days.append(day)
+            day += timedelta(days=1)
+    logging.info(f"{len(days)} days in {args.data} before {cutoff:%Y-%m-%d}")
+    if args.dry_run:
+        for day in days:
+            logging.info(f"Would compact {day:%Y-%m-%d}")
+        return
+
+    set_summary_ttl(daily_col, args.keep_summary)
+    archive_dir = None if args.no_archive else args.archive_dir
+    if archive_dir is not None:
+        archive_dir.mkdir(parents=True, exist_ok=True)
+
+    for day in days:
+        number_deleted = compact_day(data_col, daily_col, day, archive_dir)
+        if number_deleted > 0:
+            logging.info(f"Compacted {number_deleted} records for {day:%Y-%m-%d}")
+
+    if archive_dir is not None:
+        deleted = prune_archives(archive_dir, args.data, today - timedelta(days=args.keep_archive))
+        if deleted:
+            logging.info(f"Deleted {len(deleted)} archive files")
+
+
+if __name__ == "__main__":
+    main()
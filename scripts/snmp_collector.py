@@ -0,0 +1,362 @@
+"""
+    Poll the received power of the links over SNMP
+
+    The links to be polled are the documents in cml_metadata with a host and a list
+    of OIDs, the first OID is the received signal level. The devices are polled
+    concurrently with a limit on the number of requests in flight, and the readings
+    are aggregated into the p_min and p_max for each 15 min period, which are written
+    to cml_data in bulk.
+
+    Test against a local simulator, e.g. snmpsim with
+    snmpsim-command-responder --agent-udpv4-endpoint=127.0.0.1:1161
+    snmp_collector.py --target 127.0.0.1:1161 --once
+
+"""
+import sys
+
+sys.path.append("../scripts")
+
+import argparse
+import asyncio
+import json
+import logging
+import time
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+import pymongo
+import pymongo.collection
+from pysnmp.hlapi.v3arch.asyncio import (
+    CommunityData,
+    ContextData,
+    ObjectIdentity,
+    ObjectType,
+    SnmpEngine,
+    UdpTransportTarget,
+    get_cmd,
+)
+
+from db_utils import is_valid_power, dirty_flags, mark_ingested
+
+logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
+
+# Length of the sampling period in the time series data
+TIME_STEP = timedelta(minutes=15)
+
+
+def get_devices(cml_col: pymongo.collection.Collection, target: str = None, community: str = "public") -> dict:
+    """
+    Group the links to be polled by device
+
+    Args:
+        cml_col (pymongo.collection.Collection): Link metadata
+        target (str, optional): host:port to poll for every link, e.g. a simulator. Defaults to None.
+        community (str, optional): Default SNMP community. Defaults to "public".
+
+    Returns:
+        dict: (name, host, port, community) -> list of (link_id, oid), the name is the
+        host:port of the device in the metadata and host and port are the address that
+        is polled, which is the target if one is given
+    """
+    query = {"properties.OID.0": {"$exists": True}}
+    if target is None:
+        query["properties.host"] = {"$exists": True}
+    projection = {"properties.link_id": 1, "properties.OID": 1, "properties.host": 1,
+                  "properties.port": 1, "properties.community": 1, "_id": 0}
+
+    devices = {}
+    for doc in cml_col.find(filter=query, projection=projection):
+        props = doc["properties"]
+        oid = str(props["OID"][0]).strip()
+        if not oid:
+            continue
+        # with a target the links keep their own devices, a link without a host is a device
+        port = int(props.get("port", 161))
+        name = f"{props['host']}:{port}" if "host" in props else f"link_{int(props['link_id'])}"
+        if target is not None:
+            host, target_port = target.split(":")
+            key = (name, host, int(target_port), community)
+        else:
+            key = (name, props["host"], port, props.get("community", community))
+        devices.setdefault(key, []).append((int(props["link_id"]), oid))
+    return devices
+
+
+async def poll_device(
+    engine: SnmpEngine,
+    device: tuple,
+    links: list,
+    semaphore: asyncio.Semaphore,
+    timeout: float,
+    retries: int,
+    max_oids: int,
+) -> dict:
+    """
+    Read the received power for the links on one device
+
+    Args:
+        engine (SnmpEngine): SNMP engine shared by all requests
+        device (tuple): (name, host, port, community)
+        links (list): (link_id, oid) for the links on the device
+        semaphore (asyncio.Semaphore): Limits the number of devices polled at once
+        timeout (float): Timeout for each request in seconds
+        retries (int): Number of retries for each request
+        max_oids (int): Maximum number of OIDs in one request
+
+    Returns:
+        dict: device name, values {link_id: float}, latency in s, and error message or None
+    """
+    name, host, port, community = device
+    values = {}
+    error = None
+    async with semaphore:
+        start = time.perf_counter()
+        try:
+            transport = await UdpTransportTarget.create((host, port), timeout=timeout, retries=retries)
+            for ia in range(0, len(links), max_oids):
+                chunk = links[ia:ia + max_oids]
+                error_indication, error_status, error_index, var_binds = await get_cmd(
+                    engine,
+                    CommunityData(community, mpModel=1),
+                    transport,
+                    ContextData(),
+                    *[ObjectType(ObjectIdentity(oid)) for _, oid in chunk],
+                )
+                if error_indication or error_status:
+                    error = str(error_indication or error_status.prettyPrint())
+                    continue
+                for (link_id, _), (_, value) in zip(chunk, var_binds):
+                    try:
+                        values[link_id] = float(value)
+                    except (ValueError, TypeError):
+                        continue
+        except Exception as e:
+            error = str(e)
+        latency = time.perf_counter() - start
+
+    return {"device": name, "values": values, "latency": latency, "error": error}
+
+
+class PowerAggregator:
+    """Minimum and maximum power for each link over the current 15 min period"""
+
+    def __init__(self):
+        self.period_end = None
+        self.p_min = {}
+        self.p_max = {}
+
+    def add(self, values: dict, poll_time: datetime) -> list:
+        """
+        Add the readings from a poll
+
+        Args:
+            values (dict): {link_id: power in dBm}
+            poll_time (datetime): Time of the poll (UTC)
+
+        Returns:
+            list: Records for the previous period if this poll is in a new period
+        """
+        period_end = period_end_time(poll_time)
+        records = []
+        if self.period_end is not None and period_end != self.period_end:
+            records = self.flush()
+        self.period_end = period_end
+
+        for link_id, power in values.items():
+            self.p_min[link_id] = min(power, self.p_min.get(link_id, power))
+            self.p_max[link_id] = max(power, self.p_max.get(link_id, power))
+        return records
+
+    def flush(self) -> list:
+        """
+        Return the records for the current period and start a new one
+
+        Returns:
+            list: Documents for cml_data
+        """
+        records = []
+        for link_id, p_min in self.p_min.items():
+            p_max = self.p_max[link_id]
+
+            # Only keep records where both p_min and p_max are valid
+            if not (is_valid_power(p_min) and is_valid_power(p_max)):
+                continue
+            records.append({
+                "link_id": link_id,
+                "time": {
+                    "start_time": self.period_end - TIME_STEP,
+                    "end_time": self.period_end,
+                },
+                "power": {"p_min": p_min, "p_max": p_max},
+            })
+        self.p_min = {}
+        self.p_max = {}
+        return records
+
+
+def period_end_time(poll_time: datetime) -> datetime:
+    """
+    Return the end of the 15 min period that a poll falls in
+
+    Args:
+        poll_time (datetime): Time of the poll (UTC)
+
+    Returns:
+        datetime: End of the period, naive UTC as stored in cml_data
+    """
+    step = int(TIME_STEP.total_seconds())
+    seconds = int(poll_time.timestamp())
+    end = (seconds // step + 1) * step
+    return datetime.fromtimestamp(end, tz=timezone.utc).replace(tzinfo=None)
+
+
+def write_records(data_col: pymongo.collection.Collection, records: list, batch_size: int) -> int:
+    """
+    Write the power records to cml_data with unordered bulk upserts so that a
+    restarted collector does not duplicate records. The p_min and p_max are combined
+    with the record already in cml_data, so a period that is written twice keeps
+    the readings from both parts
+
+    Args:
+        data_col (pymongo.collection.Collection): Time series CML data
+        records (list): Documents from PowerAggregator.flush
+        batch_size (int): Maximum number of operations in one bulk write
+
+    Returns:
+        int: Number of records written
+    """
+    if not records:
+        return 0
+
+    updates = []
+    for record in records:
+        updates.append(pymongo.UpdateOne(
+            {"link_id": record["link_id"], "time.end_time": record["time"]["end_time"]},
+            {
+                "$set": {"time": record["time"], "dirty": dirty_flags()},
+                "$min": {"power.p_min": record["power"]["p_min"]},
+                "$max": {"power.p_max": record["power"]["p_max"]},
+                "$setOnInsert": {
+                    "atten": {
+                        "p_ref": float("NaN"),
+                        "has_rain": False,
+                        "atten": float("NaN"),
+                        "s_atten": float("NaN"),
+                    },
+                },
+                "$inc": {"version": 1},
+            },
+            upsert=True,
+        ))
+        if len(updates) >= batch_size:
+            data_col.bulk_write(updates, ordered=False)
+            updates = []
+    if updates:
+        data_col.bulk_write(updates, ordered=False)
+
+    # the reference power for the next 24 h looks back over the new data
+    period_end = records[0]["time"]["end_time"]
+    link_ids = [record["link_id"] for record in records]
+    mark_ingested(data_col, link_ids, period_end, period_end)
+    return len(records)
+
+
+async def run(args: argparse.Namespace):
+    """Poll the devices every interval and write the 15 min records"""
+    myclient = pymongo.MongoClient("mongodb://localhost:27017")
+    db = myclient["cml"]
+    cml_col = db["cml_metadata"]
+    data_col = db["cml_data"]
+
+    devices = get_devices(cml_col, args.target, args.community)
+    number_links = sum(len(links) for links in devices.values())
+    logging.info(f"Polling {number_links} links on {len(devices)} devices")
+
+    metrics_file = open(args.metrics_file, "a") if args.metrics_file else None
+    engine = SnmpEngine()
+    semaphore = asyncio.Semaphore(args.max_parallel)
+    aggregator = PowerAggregator()
+    loop = asyncio.get_running_loop()
+    write_task = None
+
+    while True:
+        cycle_start = time.perf_counter()
+        poll_time = datetime.now(timezone.utc)
+
+        results = await asyncio.gather(*[
+            poll_device(engine, device, links, semaphore, args.timeout, args.retries, args.max_oids)
+            for device, links in devices.items()
+        ])
+
+        values = {}
+        for result in results:
+            for link_id, value in result["values"].items():
+                values[link_id] = value * args.scale
+
+        # write the completed period in a thread so that the polling is not delayed
+        records = aggregator.add(values, poll_time)
+        if args.once:
+            records = aggregator.flush()
+        if records:
+            if write_task is not None:
+                await write_task
+            write_task = loop.run_in_executor(None, write_records, data_col, records, args.batch_size)
+
+        latencies = np.array([result["latency"] for result in results]) if results else np.zeros(1)
+        number_errors = sum(result["error"] is not None for result in results)
+        cycle = {
+            "poll_time": poll_time.isoformat(),
+            "cycle_s": round(time.perf_counter() - cycle_start, 3),
+            "devices": len(results),
+            "errors": number_errors,
+            "links": len(values),
+            "latency_p50_s": round(float(np.percentile(latencies, 50)), 4),
+            "latency_p95_s": round(float(np.percentile(latencies, 95)), 4),
+            "latency_max_s": round(float(latencies.max()), 4),
+            "records_written": len(records),
+        }
+        logging.info(
+            f"Polled {cycle['links']} links on {cycle['devices']} devices in {cycle['cycle_s']} s, "
+            f"{number_errors} errors, p95 latency {cycle['latency_p95_s']} s"
+        )
+        if metrics_file is not None:
+            cycle["device_latency_s"] = {r["device"]: round(r["latency"], 4) for r in results}
+            metrics_file.write(json.dumps(cycle) + "\n")
+            metrics_file.flush()
+
+        if args.once:
+            break
+        if cycle["cycle_s"] > args.interval:
+            logging.warning(f"Poll cycle took {cycle['cycle_s']} s, longer than the {args.interval} s interval")
+        await asyncio.sleep(max(0.0, args.interval - (time.perf_counter() - cycle_start)))
+
+    if write_task is not None:
+        await write_task
+    if metrics_file is not None:
+        metrics_file.close()
+
+
+def main():
+    """Poll the link power over SNMP and write 15 min p_min and p_max"""
+    parser = argparse.ArgumentParser(
+        description="Poll the received power of the links over SNMP",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("-i", "--interval", type=float, default=10.0, help="Seconds between polls")
+    parser.add_argument("--max-parallel", type=int, default=500, help="Maximum devices polled at once")
+    parser.add_argument("--max-oids", type=int, default=20, help="Maximum OIDs in one SNMP request")
+    parser.add_argument("--timeout", type=float, default=2.0, help="Timeout for each request in seconds")
+    parser.add_argument("--retries", type=int, default=1, help="Retries for each request")
+    parser.add_argument("--scale", type=float, default=1.0, help="Scale the readings to dBm, e.g. 0.1 for tenths")
+    parser.add_argument("--batch-size", type=int, default=1000, help="Maximum operations in one bulk write")
+    parser.add_argument("--community", default="public", help="Default SNMP community")
+    parser.add_argument("--target", help="host:port to poll for every link, e.g. a local simulator")
+    parser.add_argument("--metrics-file", help="File for a JSON line with the timings of each poll cycle")
+    parser.add_argument("--once", action="store_true", help="Poll once, write the readings and stop")
+    args = parser.parse_args()
+
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
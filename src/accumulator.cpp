@@ -0,0 +1,101 @@
+#include "accumulator.h"
+#include <algorithm>
+#include <cmath>
+
+/// @brief Set up the ring buffer and running totals
+/// @param n_rows rows in the map
+/// @param n_cols columns in the map
+/// @param window_hours accumulation windows in hours
+/// @param time_step seconds between maps
+RainAccumulator::RainAccumulator(
+    int n_rows, int n_cols, std::vector<int> window_hours, int time_step)
+    : _n_rows(n_rows)
+    , _n_cols(n_cols)
+    , _time_step(time_step)
+    , _window_hours(window_hours)
+{
+    _step_hours = time_step / 3600.0;
+
+    int max_steps = 1;
+    for (int hours : _window_hours) {
+        int steps = std::max(1, hours * 3600 / time_step);
+        _window_steps.push_back(steps);
+        max_steps = std::max(max_steps, steps);
+    }
+    _ring.resize(max_steps);
+    reset();
+}
+
+/// @brief Empty the ring buffer and set the totals to zero
+void RainAccumulator::reset()
+{
+    for (auto& depth : _ring) {
+        depth.setConstant(_n_rows, _n_cols, NAN);
+    }
+    _sum.assign(_window_steps.size(), Eigen::MatrixXd::Zero(_n_rows, _n_cols));
+    _count.assign(_window_steps.size(), Eigen::MatrixXi::Zero(_n_rows, _n_cols));
+    _head = 0;
+    _number_pushed = 0;
+    _last_time = 0;
+}
+
+/// @brief Add the next map in the sequence
+/// Missing time steps are added as missing data
+/// @param rate rain rate map in mm/h
+/// @param m_time valid time of the map
+void RainAccumulator::push(const Eigen::MatrixXf& rate, time_t m_time)
+{
+    if (_number_pushed > 0) {
+        long n_missing = (m_time - _last_time) / _time_step - 1;
+
+        // out of order or a gap longer than all the windows so start again
+        if (n_missing < 0 || n_missing >= (long)_ring.size()) {
+            reset();
+        } else {
+            Eigen::MatrixXf missing = Eigen::MatrixXf::Constant(_n_rows, _n_cols, NAN);
+            for (long ia = 0; ia < n_missing; ++ia) {
+                add_depth(missing);
+            }
+        }
+    }
+
+    add_depth(rate * _step_hours);
+    _last_time = m_time;
+}
+
+/// @brief Update the running totals with a new depth map and store it in the ring
+/// @param depth rain depth (mm) for the time step
+void RainAccumulator::add_depth(const Eigen::MatrixXf& depth)
+{
+    int ring_size = _ring.size();
+    auto valid = depth.array().isFinite();
+    Eigen::ArrayXXd added = valid.select(depth.array(), 0.0f).cast<double>();
+
+    for (std::size_t iw = 0; iw < _window_steps.size(); ++iw) {
+        int steps = _window_steps[iw];
+
+        // remove the map that is dropping out of this window
+        if (_number_pushed >= steps) {
+            const Eigen::MatrixXf& old = _ring[(_head - steps + ring_size) % ring_size];
+            auto old_valid = old.array().isFinite();
+            _sum[iw].array() -= old_valid.select(old.array(), 0.0f).cast<double>();
+            _count[iw].array() -= old_valid.cast<int>();
+        }
+        _sum[iw].array() += added;
+        _count[iw].array() += valid.cast<int>();
+    }
+
+    _ring[_head] = depth;
+    _head = (_head + 1) % ring_size;
+    _number_pushed = std::min(_number_pushed + 1, ring_size);
+}
+
+/// @brief Rainfall accumulation for a window
+/// @param iw index of the window
+/// @return accumulation in mm, NaN where there are no valid maps
+Eigen::MatrixXf RainAccumulator::total(int iw) const
+{
+    return (_count[iw].array() > 0)
+        .select(_sum[iw].array().cast<float>(), NAN)
+        .matrix();
+}
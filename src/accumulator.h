@@ -0,0 +1,43 @@
+#ifndef ACCUMULATOR_H
+#define ACCUMULATOR_H
+// Rolling rainfall accumulations from a sequence of rain rate maps
+#include <Eigen/Dense>
+#include <ctime>
+#include <string>
+#include <vector>
+
+/// @brief Rolling accumulations over several windows that share a ring buffer
+/// of the most recent maps. Each new map is added to the running totals and the map
+/// that drops out of each window is subtracted, so the cost per step does not
+/// depend on the length of the windows.
+class RainAccumulator {
+public:
+    RainAccumulator(int n_rows, int n_cols, std::vector<int> window_hours, int time_step);
+    void push(const Eigen::MatrixXf& rate, time_t m_time);
+    int number_windows() const { return _window_steps.size(); };
+    int window_hours(int iw) const { return _window_hours[iw]; };
+    int window_steps(int iw) const { return _window_steps[iw]; };
+    Eigen::MatrixXf total(int iw) const;
+    const Eigen::MatrixXi& coverage(int iw) const { return _count[iw]; };
+
+private:
+    int _n_rows;
+    int _n_cols;
+    int _time_step; // seconds between maps
+    double _step_hours; // rain rate to depth for one map
+    std::vector<int> _window_hours;
+    std::vector<int> _window_steps;
+
+    std::vector<Eigen::MatrixXf> _ring; // rain depth (mm) for the last maps, NaN if missing
+    int _head; // index for the next map in the ring
+    int _number_pushed; // maps in the ring, up to the size of the ring
+    time_t _last_time;
+
+    std::vector<Eigen::MatrixXd> _sum; // running total in mm for each window
+    std::vector<Eigen::MatrixXi> _count; // number of valid maps at each pixel for each window
+
+    void add_depth(const Eigen::MatrixXf& depth);
+    void reset();
+};
+
+#endif // ACCUMULATOR_H
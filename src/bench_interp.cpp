@@ -0,0 +1,271 @@
+// Benchmark for the interpolation kernels in map_engine
+// Synthetic link rain is fed straight into the interpolators, so this only depends
+// on Eigen and does not need a database, PROJ or netCDF
+//
+// bench_interp [--quick] [--repeats n] [--method idw|ok|all] [--seed n]
+// writes a JSON line for each case to stdout
+#include <algorithm>
+#include <chrono>
+#include <cmath>
+#include <cstdlib>
+#include <iostream>
+#include <random>
+#include <sstream>
+#include <string>
+#include <vector>
+
+#include "map_engine.h"
+
+/// @brief Settings for one benchmark case
+struct BenchCase {
+    std::string sweep; // parameter that is varied
+    std::string method;
+    int n_links;
+    int grid_size;
+    int box_step;
+    float range;
+};
+
+/// @brief Make synthetic link rain over a square grid
+/// The rain is a few Gaussian cells so that the values vary in space
+/// @param n_links number of links
+/// @param grid_size rows and columns in the grid
+/// @param seed seed for the random numbers
+/// @return observations in image coordinates
+std::vector<Observations> make_links(int n_links, int grid_size, unsigned int seed)
+{
+    std::mt19937 gen(seed);
+    std::uniform_real_distribution<double> pos(0.0, grid_size);
+    std::uniform_real_distribution<double> rate(2.0, 50.0);
+
+    const int n_cells = 5;
+    std::vector<Observations> cells;
+    for (int ia = 0; ia < n_cells; ++ia) {
+        cells.push_back({ rate(gen), pos(gen), pos(gen) });
+    }
+    double cell_size = grid_size / 8.0;
+
+    std::vector<Observations> links;
+    links.reserve(n_links);
+    for (int ia = 0; ia < n_links; ++ia) {
+        Observations obs { 0.0, pos(gen), pos(gen) };
+        for (const auto& cell : cells) {
+            double dx = obs.x - cell.x;
+            double dy = obs.y - cell.y;
+            obs.value += cell.value * std::exp(-(dx * dx + dy * dy) / (2 * cell_size * cell_size));
+        }
+        links.push_back(obs);
+    }
+    return links;
+}
+
+/// @brief Median of a set of timings
+/// @param times timings, sorted in place
+/// @return median value
+double median(std::vector<double>& times)
+{
+    std::sort(times.begin(), times.end());
+    return times[times.size() / 2];
+}
+
+/// @brief Time the interpolation of one case
+/// @param bench case to run
+/// @param repeats number of times to run the case
+/// @param seed seed for the synthetic links
+/// @return JSON line with the timings
+std::string run_case(const BenchCase& bench, int repeats, unsigned int seed)
+{
+    std::vector<Observations> links = make_links(bench.n_links, bench.grid_size, seed);
+
+    InterpParams params;
+    params.n_rows = bench.grid_size;
+    params.n_cols = bench.grid_size;
+    params.box_step = bench.box_step;
+    params.range = bench.range;
+    MapWindow window { 0, 0, bench.grid_size, bench.grid_size };
+
+    Kriging krig;
+    krig.set_params(bench.range / 2.0, 15, 1);
+
+    std::vector<double> times;
+    Eigen::MatrixXf map;
+    for (int ia = 0; ia < repeats; ++ia) {
+        auto start = std::chrono::steady_clock::now();
+        if (bench.method == "ok")
+            map = interp_ok(links, params, window, krig);
+        else
+            map = interp_idw(links, params, window);
+        times.push_back(
+            std::chrono::duration<double, std::nano>(std::chrono::steady_clock::now() - start).count());
+    }
+
+    double n_pixels = double(bench.grid_size) * bench.grid_size;
+    double nan_fraction = map.array().isNaN().cast<double>().sum() / n_pixels;
+    double best = *std::min_element(times.begin(), times.end());
+
+    std::ostringstream line;
+    line << "{\"kernel\": \"" << bench.method << "\", \"sweep\": \"" << bench.sweep
+         << "\", \"n_links\": " << bench.n_links
+         << ", \"grid_size\": " << bench.grid_size << ", \"box_step\": " << bench.box_step
+         << ", \"range\": " << bench.range << ", \"repeats\": " << repeats
+         << ", \"ms_median\": " << median(times) / 1e6 << ", \"ms_min\": " << best / 1e6
+         << ", \"ns_per_pixel\": " << best / n_pixels << ", \"nan_fraction\": " << nan_fraction
+         << "}";
+    return line.str();
+}
+
+/// @brief Time building and solving the kriging system for a number of links
+/// @param n_links number of links in the system
+/// @param repeats number of systems to solve
+/// @param seed seed for the synthetic links
+/// @return JSON line with the timings
+std::string run_kriging_case(int n_links, int repeats, unsigned int seed)
+{
+    std::vector<Observations> links = make_links(n_links, 40, seed);
+    Kriging krig;
+    krig.set_params(10, 15, 1);
+
+    Eigen::VectorXd values(n_links);
+    for (int ia = 0; ia < n_links; ++ia)
+        values(ia) = krig.variogram(std::hypot(links[ia].x - 20.0, links[ia].y - 20.0));
+
+    std::vector<double> build_times, solve_times;
+    double check = 0;
+    for (int ia = 0; ia < repeats; ++ia) {
+        auto start = std::chrono::steady_clock::now();
+        Eigen::MatrixXd gamma = krig.buildGammaMatrix(links);
+        auto built = std::chrono::steady_clock::now();
+        Eigen::VectorXd weights = krig.solveWeights(gamma, values);
+        auto solved = std::chrono::steady_clock::now();
+        check += weights.head(n_links).sum(); // the last weight is the Lagrange multiplier
+        build_times.push_back(std::chrono::duration<double, std::nano>(built - start).count());
+        solve_times.push_back(std::chrono::duration<double, std::nano>(solved - built).count());
+    }
+
+    std::ostringstream line;
+    line << "{\"kernel\": \"kriging_system\", \"n_links\": " << n_links << ", \"repeats\": " << repeats
+         << ", \"build_ns\": " << median(build_times) << ", \"solve_ns\": " << median(solve_times)
+         << ", \"weight_sum\": " << check / repeats << "}";
+    return line.str();
+}
+
+/// @brief Time fitting the variogram to a number of links
+/// @param n_links number of links
+/// @param grid_size rows and columns in the grid
+/// @param repeats number of fits
+/// @param seed seed for the synthetic links
+/// @return JSON line with the timings and the fitted variogram
+std::string run_fit_case(int n_links, int grid_size, int repeats, unsigned int seed)
+{
+    std::vector<Observations> links = make_links(n_links, grid_size, seed);
+    VariogramFitParams fit;
+
+    std::vector<double> times;
+    VariogramParams params;
+    bool fitted = false;
+    for (int ia = 0; ia < repeats; ++ia) {
+        auto start = std::chrono::steady_clock::now();
+        fitted = fit_variogram(links, fit, params);
+        times.push_back(
+            std::chrono::duration<double, std::milli>(std::chrono::steady_clock::now() - start).count());
+    }
+
+    std::ostringstream line;
+    line << "{\"kernel\": \"variogram_fit\", \"n_links\": " << n_links
+         << ", \"grid_size\": " << grid_size << ", \"repeats\": " << repeats
+         << ", \"ms_median\": " << median(times) << ", \"fitted\": " << (fitted ? "true" : "false")
+         << ", \"range\": " << params.range << ", \"sill\": " << params.sill
+         << ", \"nugget\": " << params.nugget << "}";
+    return line.str();
+}
+
+int main(int argc, char** argv)
+{
+    bool quick = false;
+    int repeats = 5;
+    unsigned int seed = 42;
+    std::string method = "all";
+    for (int ia = 1; ia < argc; ++ia) {
+        std::string arg = argv[ia];
+        if (arg == "--quick")
+            quick = true;
+        else if (arg == "--repeats" && ia + 1 < argc)
+            repeats = std::atoi(argv[++ia]);
+        else if (arg == "--method" && ia + 1 < argc)
+            method = argv[++ia];
+        else if (arg == "--seed" && ia + 1 < argc)
+            seed = std::atoi(argv[++ia]);
+        else {
+            std::cerr << "Usage: bench_interp [--quick] [--repeats n] [--method idw|ok|all] [--seed n]"
+                      << std::endl;
+            return 1;
+        }
+    }
+    if (repeats < 1) {
+        std::cerr << "--repeats must be at least 1" << std::endl;
+        return 1;
+    }
+
+    // Sweep one parameter at a time around the base case to get the scaling curves
+    // The grid sweep keeps the density of the links the same as the base case
+    const BenchCase base { "", "idw", 1000, 200, 5, 20 };
+    std::vector<int> link_counts
+        = quick ? std::vector<int> { 250, 1000 } : std::vector<int> { 250, 500, 1000, 2000, 4000 };
+    std::vector<int> grid_sizes
+        = quick ? std::vector<int> { 100, 200 } : std::vector<int> { 100, 200, 400, 800 };
+    std::vector<int> box_steps = quick ? std::vector<int> { 3, 5 } : std::vector<int> { 1, 3, 5, 9 };
+    std::vector<float> ranges
+        = quick ? std::vector<float> { 10, 20 } : std::vector<float> { 10, 20, 40 };
+
+    std::vector<std::string> methods;
+    if (method == "all" || method == "idw")
+        methods.push_back("idw");
+    if (method == "all" || method == "ok")
+        methods.push_back("ok");
+
+    for (const auto& name : methods) {
+        BenchCase bench = base;
+        bench.method = name;
+        for (int n_links : link_counts) {
+            BenchCase sweep = bench;
+            sweep.sweep = "n_links";
+            sweep.n_links = n_links;
+            std::cout << run_case(sweep, repeats, seed) << std::endl;
+        }
+        for (int grid_size : grid_sizes) {
+            BenchCase sweep = bench;
+            sweep.sweep = "grid_size";
+            sweep.grid_size = grid_size;
+            sweep.n_links = bench.n_links * grid_size * grid_size / (base.grid_size * base.grid_size);
+            std::cout << run_case(sweep, repeats, seed) << std::endl;
+        }
+        for (int box_step : box_steps) {
+            BenchCase sweep = bench;
+            sweep.sweep = "box_step";
+            sweep.box_step = box_step;
+            std::cout << run_case(sweep, repeats, seed) << std::endl;
+        }
+        for (float range : ranges) {
+            BenchCase sweep = bench;
+            sweep.sweep = "range";
+            sweep.range = range;
+            std::cout << run_case(sweep, repeats, seed) << std::endl;
+        }
+    }
+
+    if (method == "all" || method == "ok") {
+        std::vector<int> system_sizes
+            = quick ? std::vector<int> { 10, 40 } : std::vector<int> { 10, 20, 40, 80, 160 };
+        for (int n_links : system_sizes)
+            std::cout << run_kriging_case(n_links, repeats * 20, seed) << std::endl;
+
+        // networks with the density of the base case
+        std::vector<int> fit_sizes
+            = quick ? std::vector<int> { 1000, 3000 } : std::vector<int> { 1000, 3000, 10000 };
+        for (int n_links : fit_sizes) {
+            int grid_size = base.grid_size * std::sqrt(double(n_links) / base.n_links);
+            std::cout << run_fit_case(n_links, grid_size, repeats, seed) << std::endl;
+        }
+    }
+    return 0;
+}
@@ -0,0 +1,175 @@
+#include "cml_daemon.h"
+#include <bsoncxx/builder/basic/document.hpp>
+#include <bsoncxx/builder/basic/kvp.hpp>
+#include <mongocxx/change_stream.hpp>
+#include <mongocxx/collection.hpp>
+#include <mongocxx/database.hpp>
+#include <mongocxx/exception/exception.hpp>
+#include <mongocxx/options/change_stream.hpp>
+#include <mongocxx/pipeline.hpp>
+
+#include <format>
+#include <iostream>
+#include <thread>
+
+using bsoncxx::builder::basic::kvp;
+using bsoncxx::builder::basic::make_array;
+using bsoncxx::builder::basic::make_document;
+
+/// @brief Set up the daemon from the "daemon" section of the configuration
+/// @param cml Interpolators that have been configured for the domains
+/// @param config JSON configuration
+CmlDaemon::CmlDaemon(CmlDomains& cml, json config)
+    : _cml(cml)
+{
+    json daemon = config.value("daemon", json::object());
+    _mode = daemon.value("mode", "poll");
+    _time_step = map_time_step(config);
+    _poll_interval = daemon.value("poll_interval", 10);
+    _max_wait = daemon.value("max_wait", 15 * 60);
+    _metadata_refresh = daemon.value("metadata_refresh", 3600);
+    _min_fraction = daemon.value("min_fraction", 1.0);
+    _latency_budget = daemon.value("latency_budget", 30.0);
+
+    std::string metrics_name = daemon.value("metrics_file", "");
+    if (!metrics_name.empty()) {
+        _metrics_file.open(metrics_name, std::ofstream::out | std::ofstream::app);
+        if (!_metrics_file.is_open())
+            std::cerr << std::format("Failed to open metrics file {}", metrics_name) << std::endl;
+    }
+}
+
+/// @brief Produce the maps as the rain estimates for each time step are completed
+/// @param start_time end_time of the first map
+void CmlDaemon::run(time_t start_time)
+{
+    // Align the start time with the time steps in the data
+    time_t m_time = start_time - (start_time % _time_step);
+    time_t last_refresh = std::time(nullptr);
+
+    std::cout << std::format("Daemon waiting for {} in {} mode\n", _cml.convertTimeToIso(m_time),
+        _mode);
+
+    while (true) {
+        // Keep the link metadata in memory but pick up any new links now and then
+        time_t now = std::time(nullptr);
+        if (now - last_refresh > _metadata_refresh) {
+            auto number_links = _cml.get_link_ids();
+            std::cout << std::format("Reloaded {} links in map area\n", number_links);
+            last_refresh = now;
+        }
+
+        bool skip = false;
+        if (!is_complete(m_time, skip)) {
+            if (skip) {
+                m_time += _time_step;
+                continue;
+            }
+            wait_for_update(m_time);
+            continue;
+        }
+
+        // Time from the end of the sampling period until the step was found to be complete
+        auto detected = std::chrono::system_clock::now();
+        double detect_latency = std::chrono::duration<double>(
+            detected - std::chrono::system_clock::from_time_t(m_time))
+                                    .count();
+
+        std::vector<StepMetrics> metrics;
+        _cml.process_step(m_time, metrics);
+
+        // The latency budget is for all the domains together
+        double step_ms = 0;
+        for (const auto& domain_metrics : metrics)
+            step_ms += domain_metrics.total_ms;
+        for (const auto& domain_metrics : metrics) {
+            json record = domain_metrics.to_json();
+            record["detect_latency_s"] = detect_latency;
+            record["over_budget"] = step_ms / 1000.0 > _latency_budget;
+            write_metrics(record);
+        }
+        if (step_ms / 1000.0 > _latency_budget) {
+            std::cerr << std::format("Maps for {} took {:.1f} s, latency budget is {:.1f} s",
+                _cml.convertTimeToIso(m_time), step_ms / 1000.0, _latency_budget)
+                      << std::endl;
+        }
+
+        m_time += _time_step;
+    }
+}
+
+/// @brief Check if the rain estimates for a time step are ready for mapping
+/// @param m_time valid time of the map
+/// @param skip set to true if the step has no rain data and has waited too long
+/// @return true if the map should be made
+bool CmlDaemon::is_complete(time_t m_time, bool& skip)
+{
+    skip = false;
+    int n_records = 0;
+    int n_rain = 0;
+    if (!_cml.count_step_records(m_time, n_records, n_rain))
+        return false;
+
+    if (n_records > 0 && n_rain >= _min_fraction * n_records)
+        return true;
+
+    // Give up waiting for the missing links and use what we have
+    time_t now = std::time(nullptr);
+    if (now - m_time > _max_wait) {
+        if (n_rain > 0) {
+            std::cout << std::format("Using {} of {} links at {}\n", n_rain, n_records,
+                _cml.convertTimeToIso(m_time));
+            return true;
+        }
+        std::cout << std::format("No rain data for {}, skipping\n", _cml.convertTimeToIso(m_time));
+        skip = true;
+    }
+    return false;
+}
+
+/// @brief Block until the rain stage may have written data for the time step
+/// @param m_time valid time of the map
+void CmlDaemon::wait_for_update(time_t m_time)
+{
+    if (_mode != "change_stream") {
+        std::this_thread::sleep_for(std::chrono::seconds(_poll_interval));
+        return;
+    }
+
+    // Change streams need a replica set, fall back to polling if it fails
+    try {
+        mongocxx::database db = MongoClientManager::get_client().database("cml");
+        mongocxx::collection cml_data = db.collection(_cml.data_collection());
+
+        mongocxx::pipeline pipeline;
+        pipeline.match(make_document(kvp("$or",
+            make_array(make_document(kvp("updateDescription.updatedFields.rain",
+                           make_document(kvp("$exists", true)))),
+                make_document(kvp("fullDocument.rain", make_document(kvp("$exists", true))))))));
+
+        mongocxx::options::change_stream options;
+        options.max_await_time(std::chrono::milliseconds(_poll_interval * 1000));
+
+        // Return on the first rain update, the completeness check is done by the caller
+        auto stream = cml_data.watch(pipeline, options);
+        for (const auto& event : stream) {
+            (void)event;
+            return;
+        }
+    } catch (const mongocxx::exception& e) {
+        std::cerr << "Change stream failed, polling instead: " << e.what() << std::endl;
+        _mode = "poll";
+        std::this_thread::sleep_for(std::chrono::seconds(_poll_interval));
+    }
+}
+
+/// @brief Write the metrics for a step as a line of JSON
+/// @param metrics JSON object with the metrics
+void CmlDaemon::write_metrics(const json& metrics)
+{
+    if (_metrics_file.is_open()) {
+        _metrics_file << metrics.dump() << std::endl;
+    } else {
+        std::cout << metrics.dump() << std::endl;
+    }
+}
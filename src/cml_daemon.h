@@ -0,0 +1,36 @@
+#ifndef CML_DAEMON_H
+#define CML_DAEMON_H
+#include <ctime>
+#include <fstream>
+#include <string>
+
+#include <nlohmann/json.hpp>
+using json = nlohmann::json;
+
+#include "cml_domains.h"
+
+/// @brief Long running map production that keeps the link metadata, the
+/// cached query arrays and the grid coordinates in memory between time steps
+/// The maps for all the domains are made from one read of the link rain
+class CmlDaemon {
+public:
+    CmlDaemon(CmlDomains& cml, json config);
+    void run(time_t start_time);
+
+private:
+    CmlDomains& _cml;
+    std::string _mode; // "poll" or "change_stream"
+    int _time_step; // seconds between maps
+    int _poll_interval; // seconds between checks for a complete time step
+    int _max_wait; // seconds after end_time to produce a map from incomplete data
+    int _metadata_refresh; // seconds between reloads of the link metadata
+    double _min_fraction; // fraction of records with rain for a complete step
+    double _latency_budget; // seconds from detection to the file being written
+    std::ofstream _metrics_file;
+
+    bool is_complete(time_t m_time, bool& skip);
+    void wait_for_update(time_t m_time);
+    void write_metrics(const json& metrics);
+};
+
+#endif // CML_DAEMON_H
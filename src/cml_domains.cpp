@@ -0,0 +1,95 @@
+#include "cml_domains.h"
+#include <mongocxx/collection.hpp>
+#include <mongocxx/database.hpp>
+
+#include <chrono>
+#include <format>
+#include <iostream>
+#include <stdexcept>
+
+/// @brief Set up an interpolator for each domain in the configuration
+/// @param config JSON configuration, with a "domains" list or a single domain
+/// @throws std::invalid_argument if "domains" is not a list with at least one domain
+CmlDomains::CmlDomains(json config)
+{
+    if (config.contains("domains") && (!config["domains"].is_array() || config["domains"].empty()))
+        throw std::invalid_argument(
+            "\"domains\" must be a list with at least one domain, leave it out for a single domain");
+    size_t number_domains = config.contains("domains") ? config["domains"].size() : 1;
+    for (size_t index = 0; index < number_domains; ++index) {
+        auto cml = std::make_unique<CmlInterp>();
+        cml->set_config(domain_config(config, index));
+        _domains.push_back(std::move(cml));
+    }
+}
+
+/// @brief Configuration for one domain
+/// Each entry in "domains" is merged over the rest of the configuration, so it only
+/// needs the keys that differ, e.g. "name", "directory", "domain" and "crs"
+/// @param config JSON configuration
+/// @param index domain in the "domains" list
+/// @return configuration for the domain
+json CmlDomains::domain_config(const json& config, size_t index)
+{
+    if (!config.contains("domains"))
+        return config;
+
+    json domain = config;
+    domain.erase("domains");
+    domain.merge_patch(config["domains"][index]);
+    return domain;
+}
+
+/// @brief Read the link metadata for each domain and make the list of links in any domain
+/// @return Number of links that are in at least one domain
+int CmlDomains::get_link_ids()
+{
+    _link_coordinates.clear();
+    _link_id_array.clear();
+    for (auto& cml : _domains) {
+        auto number_links = cml->get_link_ids();
+        std::cout << std::format("Found {} links in {}\n", number_links, cml->name());
+        for (const auto& link : cml->link_coordinates())
+            _link_coordinates.emplace(link);
+    }
+
+    for (const auto& link : _link_coordinates) {
+        _link_id_array.append(link.first);
+    }
+    return _link_coordinates.size();
+}
+
+/// @brief Count the records for the links in any domain at a time step
+/// @param m_time valid time
+/// @param n_records number of records at m_time
+/// @param n_rain number of these records that have a rain estimate
+/// @return false if the query failed
+bool CmlDomains::count_step_records(time_t m_time, int& n_records, int& n_rain)
+{
+    mongocxx::database db = MongoClientManager::get_client().database("cml");
+    mongocxx::collection cml_data = db.collection(data_collection());
+    return count_link_records(cml_data, _link_id_array.view(), m_time, n_records, n_rain);
+}
+
+/// @brief Read the link rain for a time step once and make the map for each domain
+/// @param m_time valid time for the maps
+/// @param metrics returns the timings for each domain, the time to read the link rain
+/// is counted in the first domain
+/// @return paths to the netCDF files
+std::vector<std::string> CmlDomains::process_step(time_t m_time, std::vector<StepMetrics>& metrics)
+{
+    auto t_start = std::chrono::steady_clock::now();
+    mongocxx::database db = MongoClientManager::get_client().database("cml");
+    mongocxx::collection cml_data = db.collection(data_collection());
+    auto link_rain = find_link_rain(cml_data, _link_id_array.view(), _link_coordinates, m_time);
+    double fetch_ms = elapsed_ms(t_start);
+
+    std::vector<std::string> files;
+    metrics.assign(_domains.size(), StepMetrics());
+    for (size_t index = 0; index < _domains.size(); ++index) {
+        files.push_back(_domains[index]->process_step(m_time, link_rain, metrics[index]));
+    }
+    metrics[0].fetch_ms = fetch_ms;
+    metrics[0].total_ms += fetch_ms;
+    return files;
+}
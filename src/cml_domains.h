@@ -0,0 +1,38 @@
+#ifndef CML_DOMAINS_H
+#define CML_DOMAINS_H
+#include <ctime>
+#include <memory>
+#include <string>
+#include <unordered_map>
+#include <vector>
+
+#include <nlohmann/json.hpp>
+using json = nlohmann::json;
+
+#include "cml_interp.h"
+
+/// @brief Maps for several domains, e.g. a national grid and some city grids,
+/// made from one read of the link rain for each time step
+class CmlDomains {
+public:
+    CmlDomains(json config);
+    static json domain_config(const json& config, size_t index);
+    int get_link_ids();
+    bool count_step_records(time_t m_time, int& n_records, int& n_rain);
+    std::vector<std::string> process_step(time_t m_time, std::vector<StepMetrics>& metrics);
+    size_t size() const { return _domains.size(); };
+    CmlInterp& domain(size_t index) { return *_domains[index]; };
+    time_t convertIsoToTime(const std::string& isoTime)
+    {
+        return _domains[0]->convertIsoToTime(isoTime);
+    };
+    std::string convertTimeToIso(const time_t ts) { return _domains[0]->convertTimeToIso(ts); };
+    std::string data_collection() const { return _domains[0]->data_collection(); };
+
+private:
+    std::vector<std::unique_ptr<CmlInterp>> _domains;
+    std::unordered_map<int, Coordinates> _link_coordinates; // links in any of the domains
+    bsoncxx::builder::basic::array _link_id_array; // link ids for the $in queries
+};
+
+#endif // CML_DOMAINS_H
@@ -12,23 +12,80 @@
 #include <mongocxx/stdx.hpp>
 #include <mongocxx/uri.hpp>
 
+#include <atomic>
 #include <cassert>
 #include <cmath> // for HUGE_VAL
+#include <filesystem>
 #include <iomanip> // for std::setprecision()
 #include <iostream>
+#include <exception>
+#include <mutex>
 #include <ncType.h>
 #include <netcdf>
+#include <stdexcept>
+#include <thread>
 
-/// @brief Set up the MongoDB client manager for this class
-CmlInterp::CmlInterp() { _client = &MongoClientManager::get_client(); }
+/// @brief The MongoDB client is not needed for maps from observations in memory
+CmlInterp::CmlInterp() { _client = nullptr; }
+/// @brief Get the MongoDB client, connecting on the first call
+mongocxx::client& CmlInterp::client()
+{
+    if (_client == nullptr)
+        _client = &MongoClientManager::get_client();
+    return *_client;
+}
 /// @brief Set up the map domain
 /// @param config JSON configuration
+/// @throws std::invalid_argument if the time step, or the tile size or number of threads in
+/// "tiling", is less than 1
 void CmlInterp::set_config(json config)
 {
+    if (map_time_step(config) < 1)
+        throw std::invalid_argument("\"time_step\" must be at least 1 s");
+    if (config.contains("tiling")) {
+        const json& tiling = config["tiling"];
+        if (tiling.value("tile_rows", 512) < 1 || tiling.value("tile_cols", 512) < 1
+            || tiling.value("n_threads", 1) < 1)
+            throw std::invalid_argument(
+                "\"tile_rows\", \"tile_cols\" and \"n_threads\" in \"tiling\" must be at least 1");
+    }
     _config = config;
     _pjn.set_projection(_config);
 
+    // the grid coordinates do not change between maps so calculate them once
+    _x_vals = _pjn.x_vals();
+    _y_vals = _pjn.y_vals();
+
+    // Rolling accumulations over the windows (hours) in the config
+    _accumulator.reset();
+    if (_config.contains("accumulations")) {
+        if (_config.contains("tiling")) {
+            std::cerr << "Accumulations are not available for tiled maps" << std::endl;
+        } else {
+            std::vector<int> window_hours = _config["accumulations"].get<std::vector<int>>();
+            _accumulator = std::make_unique<RainAccumulator>(
+                _pjn.ny(), _pjn.nx(), window_hours, map_time_step(_config));
+        }
+    }
+
     _prescale = 2.0;
+
+    // Variogram for kriging, the parameters are the starting point and the fallback
+    // when the fit fails, the range and max_lag are in pixels
+    json vg_config = _config.value("variogram", json::object());
+    VariogramModel model = vg_config.value("model", "spherical") == "exponential"
+        ? VariogramModel::exponential
+        : VariogramModel::spherical;
+    _variogram = { model, vg_config.value("range", 10.0), vg_config.value("sill", 15.0),
+        vg_config.value("nugget", 1.0) };
+    _fit_variogram = vg_config.value("fit", false);
+    _use_ihs = vg_config.value("transform", "none") == "ihs";
+    _variogram_fit = VariogramFitParams();
+    _variogram_fit.model = model;
+    _variogram_fit.max_lag = vg_config.value("max_lag", 2.0 * ok_params().range);
+    _variogram_fit.n_bins = vg_config.value("n_bins", _variogram_fit.n_bins);
+    _variogram_fit.max_pairs = vg_config.value("max_pairs", _variogram_fit.max_pairs);
+    _variogram_fit.min_links = vg_config.value("min_links", _variogram_fit.min_links);
 }
 /// @brief Function to convert ISO time string to time_t in UTC
 /// @param isoTime ISO date string
@@ -54,8 +111,8 @@ std::string CmlInterp::convertTimeToIso(const time_t ts)
 /// @return Number of links that have been found
 int CmlInterp::get_link_ids()
 {
-    mongocxx::database db = _client->database("cml");
-    mongocxx::collection cml_metadata = db.collection("cml_metadata");
+    mongocxx::database db = client().database("cml");
+    mongocxx::collection cml_metadata = db.collection(metadata_collection());
 
     double c_lat = _config["domain"]["centre_lat"].get<double>();
     double c_lon = _config["domain"]["centre_lon"].get<double>();
@@ -78,6 +135,7 @@ int CmlInterp::get_link_ids()
     auto query = query_builder.view();
 
     _link_coordinates.clear();
+    _link_id_array.clear();
     try {
         auto cursor = cml_metadata.find(query);
         for (const auto& doc : cursor) {
@@ -106,106 +164,228 @@ int CmlInterp::get_link_ids()
         _link_coordinates.clear();
     }
 
+    // Build the array of link ids once rather than for every time step
+    for (const auto& link : _link_coordinates) {
+        _link_id_array.append(link.first);
+    }
+
     return _link_coordinates.size();
 }
 
+/// @brief Count the records for a set of links at a time step
+/// @param cml_data time series collection
+/// @param link_ids array of link ids for the $in query
+/// @param m_time valid time
+/// @param n_records number of records at m_time
+/// @param n_rain number of these records that have a rain estimate
+/// @return false if the query failed
+bool count_link_records(mongocxx::collection& cml_data, bsoncxx::array::view link_ids,
+    time_t m_time, int& n_records, int& n_rain)
+{
+    const auto time_tp = std::chrono::system_clock::from_time_t(m_time);
+
+    bsoncxx::builder::stream::document all_builder;
+    all_builder << "link_id" << bsoncxx::builder::stream::open_document << "$in" << link_ids
+                << bsoncxx::builder::stream::close_document << "time.end_time"
+                << bsoncxx::types::b_date(time_tp);
+
+    bsoncxx::builder::stream::document rain_builder;
+    rain_builder << "link_id" << bsoncxx::builder::stream::open_document << "$in" << link_ids
+                 << bsoncxx::builder::stream::close_document << "time.end_time"
+                 << bsoncxx::types::b_date(time_tp) << "rain"
+                 << bsoncxx::builder::stream::open_document << "$exists" << true
+                 << bsoncxx::builder::stream::close_document;
+
+    try {
+        n_records = (int)cml_data.count_documents(all_builder.view());
+        n_rain = (int)cml_data.count_documents(rain_builder.view());
+    } catch (const mongocxx::query_exception& e) {
+        std::cerr << "Query execution error: " << e.what() << std::endl;
+        n_records = 0;
+        n_rain = 0;
+        return false;
+    }
+    return true;
+}
+
+/// @brief Count the records for the links in the domain at a time step
+/// @param m_time valid time
+/// @param n_records number of records at m_time
+/// @param n_rain number of these records that have a rain estimate
+/// @return false if the query failed
+bool CmlInterp::count_step_records(time_t m_time, int& n_records, int& n_rain)
+{
+    mongocxx::database db = client().database("cml");
+    mongocxx::collection cml_data = db.collection(data_collection());
+    return count_link_records(cml_data, _link_id_array.view(), m_time, n_records, n_rain);
+}
+
+/// @brief Make the map for a time step and write it to the output directory
+/// @param m_time valid time for the map
+/// @param metrics returns the timings for the step
+/// @return path to the netCDF file
+std::string CmlInterp::process_step(time_t m_time, StepMetrics& metrics)
+{
+    auto t_start = std::chrono::steady_clock::now();
+    auto link_rain = fetch_link_rain(m_time);
+    double fetch_ms = elapsed_ms(t_start);
+
+    std::string full_path = process_step(m_time, link_rain, metrics);
+    metrics.fetch_ms = fetch_ms;
+    metrics.total_ms = elapsed_ms(t_start);
+    return full_path;
+}
+
+/// @brief Make the map for a time step from link rain that has already been read
+/// @param m_time valid time for the map
+/// @param link_rain rain for the links, the links outside the domain are ignored
+/// @param metrics returns the timings for the step, without the time to read the link rain
+/// @return path to the netCDF file
+std::string CmlInterp::process_step(
+    time_t m_time, const std::vector<LinkRain>& link_rain, StepMetrics& metrics)
+{
+    auto t_start = std::chrono::steady_clock::now();
+    metrics = StepMetrics();
+    metrics.domain = name();
+    metrics.map_time = m_time;
+
+    auto link_obs = index_link_rain(link_rain);
+    metrics.number_obs = link_obs.size();
+
+    // Format the time as yyyy-mm-ddThh:mm:ss
+    char c_time[64] = { 0 };
+    tm* tm_time = gmtime(&m_time);
+    strftime(c_time, 64, "%Y-%m-%dT%H:%M:%S", tm_time);
+
+    // Construct the full path for the output file
+    std::string data_dir = _config["directory"];
+    std::string full_path = data_dir + std::string(c_time) + "_" + name() + ".nc";
+    std::cout << std::format("Writing {}\n", full_path);
+
+    // Large domains are interpolated and written a tile at a time
+    auto t_phase = std::chrono::steady_clock::now();
+    if (_config.contains("tiling")) {
+        write_tiled_netcdf(full_path, link_obs, m_time, &metrics);
+        metrics.interp_ms = elapsed_ms(t_phase) - metrics.write_ms;
+    } else {
+        Eigen::MatrixXf map = make_map(link_obs, &metrics.interp);
+        if (_accumulator)
+            _accumulator->push(map, m_time);
+        metrics.interp_ms = elapsed_ms(t_phase);
+
+        t_phase = std::chrono::steady_clock::now();
+        writeNetCDF(full_path, map, m_time, _accumulator.get());
+        metrics.write_ms = elapsed_ms(t_phase);
+    }
+    if (method() == "ok") {
+        metrics.variogram = { { "model", _variogram.model == VariogramModel::exponential
+                                      ? "exponential"
+                                      : "spherical" },
+            { "range", _variogram.range }, { "sill", _variogram.sill },
+            { "nugget", _variogram.nugget } };
+    }
+
+    std::error_code ec;
+    auto file_size = std::filesystem::file_size(full_path, ec);
+    metrics.bytes_written = ec ? 0 : (long)file_size;
+    metrics.total_ms = elapsed_ms(t_start);
+    metrics.file_name = full_path;
+    return full_path;
+}
+
+/// @brief Search parameters for the IDW interpolation
+InterpParams CmlInterp::idw_params()
+{
+    InterpParams params;
+    params.n_rows = _config["domain"]["n_rows"].get<int>();
+    params.n_cols = _config["domain"]["n_cols"].get<int>();
+    params.box_step = 5;
+    params.range = 20000 / _pjn.delta(); // distance in image coords
+    params.min_number_locals = 10;
+    return params;
+}
+
+/// @brief Search parameters for the ordinary kriging interpolation
+InterpParams CmlInterp::ok_params()
+{
+    InterpParams params;
+    params.n_rows = _config["domain"]["n_rows"].get<int>();
+    params.n_cols = _config["domain"]["n_cols"].get<int>();
+    params.box_step = 5;
+    params.range = 20; // distance in image coords
+    params.min_number_locals = 10;
+    return params;
+}
+
 /// @brief Generate the rainfall map using ordinary Kriging 
 /// @param m_time valid time for the map
 Eigen::MatrixXf CmlInterp::make_map_ok(time_t m_time)
 {
     // get the link rain for this time
     auto link_rain = get_link_rain(m_time);
+    return make_map_ok(link_rain);
+}
+
+/// @brief Generate the rainfall map using ordinary Kriging
+/// The variogram is fitted to the links for each map if "fit" is set in the "variogram"
+/// section of the config, and the last good variogram is used if the fit fails
+/// @param link_rain link rain observations in image coordinates
+/// @param stats returns the counts and timings if not null
+Eigen::MatrixXf CmlInterp::make_map_ok(const std::vector<Observations>& link_rain, InterpStats* stats)
+{
     std::cout << std::format("Found {} links with data", link_rain.size()) << std::endl;
+    InterpParams params = ok_params();
+    std::vector<Observations> obs = prepare_ok(link_rain, params, stats);
 
     Kriging krig;
-    krig.set_params(10, 15.0, 1.0); // default params range in pixel units 
-
-    int n_rows = (int)_config["domain"]["n_rows"].get<int>();
-    int n_cols = (int)_config["domain"]["n_cols"].get<int>();
-
-    // Search for a new set of links at box_step intervals and use these within the box
-    int box_step = 5; // needs to be an odd number
-    int dbox = (int)(box_step / 2.0);
-    float range = 20; // distance in image coords 
-    std::vector<Observations> local_obs;
-    int min_number_locals = 10;
-
-    Eigen::MatrixXf map(n_rows, n_cols);
-
-    // loop over the boxes
-    for (float row = dbox; row < n_rows; row += box_step) {
-        for (float col = dbox; col < n_cols; col += box_step) {
-
-            // Get the observations for within range of the center of the box
-            local_obs.clear();
-            for (const auto& link : link_rain) {
-                float dy = link.y - row;
-                float dx = link.x - col;
-                float dist = sqrt(dx * dx + dy * dy);
-                if (dist < range) {
-                    Observations obs;
-                    obs.value = link.value;
-                    obs.x = link.x;
-                    obs.y = link.y;
-                    local_obs.push_back(obs);
-                }
-            }
-            int number_locals = local_obs.size();
-
-            // Do the interpolation if we have enough locals
-            if (number_locals >= min_number_locals) {
-                Eigen::MatrixXd gamma = krig.buildGammaMatrix(local_obs);
-                Eigen::VectorXd values(number_locals);
-
-                // Interpolate within the box
-                for (float ia = -dbox; ia <= dbox; ia++) {
-                    for (int ib = -dbox; ib <= dbox; ib++) {
-                        int y = (int)(row + ia);
-                        int x = (int)(col + ib);
-                        if (y >= 0 && y < n_rows && x >= 0 && x < n_cols) {
-
-                            // calculate the weights
-                            for (std::size_t iobs = 0; iobs < local_obs.size(); iobs++) {
-                                double dx = x - local_obs[iobs].x;
-                                double dy = y - local_obs[iobs].y;
-                                double dist = sqrt(dx * dx + dy * dy);
-                                double gamma = krig.variogram(dist);
-                                values(iobs) = gamma;
-                            }
-                            Eigen::VectorXd weights = krig.solveWeights(gamma, values);
-
-                            double val = 0;
-                            for (int ival = 0; ival < number_locals; ival++) {
-                                val += local_obs[ival].value * weights(ival);
-                            }
-
-                            // check the limits for the rain value
-                            if (val > 200)
-                                val = NAN;
-                            if (val < 0.5)
-                                val = 0.0;
-
-                            map(y, x) = val;
-                        }
-                    }
-                }
-            }
+    krig.set_params(_variogram);
 
-            // not enough locals so fill with nan
-            else {
-                for (float ia = -dbox; ia <= dbox; ia++) {
-                    for (int ib = -dbox; ib <= dbox; ib++) {
-                        int y = (int)(row + ia);
-                        int x = (int)(col + ib);
-                        if (y >= 0 && y < n_rows && x >= 0 && x < n_cols) {
-                            map(y, x) = NAN;
-                        }
-                    }
-                }
-            }
+    MapWindow window = { 0, 0, params.n_rows, params.n_cols };
+    Eigen::MatrixXf map = interp_ok(obs, params, window, krig, stats);
+    if (_use_ihs)
+        untransform(map);
+    return map;
+}
+
+/// @brief Prepare the links for kriging a map, transforming the rain and fitting the
+/// variogram as set in the "variogram" section of the config
+/// @param link_rain link rain observations in image coordinates
+/// @param params search parameters, the limits are transformed with the rain
+/// @param stats returns the time for the fit if not null
+/// @return links to be kriged
+std::vector<Observations> CmlInterp::prepare_ok(
+    const std::vector<Observations>& link_rain, InterpParams& params, InterpStats* stats)
+{
+    // krige the transformed rain, with the limits in the same space
+    std::vector<Observations> obs = link_rain;
+    if (_use_ihs) {
+        for (auto& link : obs)
+            link.value = to_ihs(link.value);
+        params.max_value = to_ihs(params.max_value);
+        params.min_value = to_ihs(params.min_value);
+    }
+
+    if (_fit_variogram) {
+        auto t_fit = std::chrono::steady_clock::now();
+        VariogramParams fitted = _variogram;
+        bool is_fitted = fit_variogram(obs, _variogram_fit, fitted);
+        if (is_fitted)
+            _variogram = fitted;
+        if (stats) {
+            stats->fit_ms += elapsed_ms(t_fit);
+            stats->variogram_fits++;
+            if (!is_fitted)
+                stats->variogram_fallbacks++;
         }
     }
-    return map;
+    return obs;
+}
+
+/// @brief Transform a kriged map back to rain rate
+/// @param map map of the transformed rain, NaN is left as it is
+void CmlInterp::untransform(Eigen::MatrixXf& map)
+{
+    map = map.unaryExpr([this](float val) { return std::isnan(val) ? val : (float)from_ihs(val); });
 }
 
 /// @brief Generate the rainfall map using Inverse Distance Weighting 
@@ -214,115 +394,48 @@ Eigen::MatrixXf CmlInterp::make_map_idw(time_t m_time)
 {
     // get the link rain for this time
     auto link_rain = get_link_rain(m_time);
-    std::cout << std::format("Found {} links with data", link_rain.size()) << std::endl;
+    return make_map_idw(link_rain);
+}
 
-    int n_rows = (int)_config["domain"]["n_rows"].get<int>();
-    int n_cols = (int)_config["domain"]["n_cols"].get<int>();
-
-    // Search for a new set of links at box_step intervals and use these within the box
-    int box_step = 5; // needs to be an odd number
-    int dbox = (int)(box_step / 2.0);
-    float range = 20000 / _pjn.delta(); // distance in image coords
-    std::vector<Observations> local_obs;
-    int min_number_locals = 10;
-
-    Eigen::MatrixXf map(n_rows, n_cols);
-
-    // loop over the boxes
-    for (float row = dbox; row < n_rows; row += box_step) {
-        for (float col = dbox; col < n_cols; col += box_step) {
-
-            // Get the observations for within range of the center of the box
-            local_obs.clear();
-            for (const auto& link : link_rain) {
-                float dy = link.y - row;
-                float dx = link.x - col;
-                float dist = sqrt(dx * dx + dy * dy);
-                if (dist < range) {
-                    Observations obs;
-                    obs.value = link.value;
-                    obs.x = link.x;
-                    obs.y = link.y;
-                    local_obs.push_back(obs);
-                }
-            }
-            int number_locals = local_obs.size();
-
-            // Do the interpolation if we have enough locals
-            if (number_locals >= min_number_locals) {
-                Eigen::VectorXd weights(number_locals);
-
-                // Interpolate within the box
-                for (float ia = -dbox; ia <= dbox; ia++) {
-                    for (int ib = -dbox; ib <= dbox; ib++) {
-                        int y = (int)(row + ia);
-                        int x = (int)(col + ib);
-                        if (y >= 0 && y < n_rows && x >= 0 && x < n_cols) {
-
-                            double val = 0;
-                            double sum_weight = 0;
-                            for (std::size_t iobs = 0; iobs < number_locals; iobs++) {
-                                double dx = x - local_obs[iobs].x;
-                                double dy = y - local_obs[iobs].y;
-                                double weight = 1.0/(dx * dx + dy * dy);
-                                sum_weight += weight; 
-                                val += weight *  local_obs[iobs].value ;
-                            }
-                            val /= sum_weight ; 
-                            
-                            // check the limits for the rain value
-                            if (val > 200)
-                                val = NAN;
-                            if (val < 0.5)
-                                val = 0.0;
-
-                            map(y, x) = val;
-                        }
-                    }
-                }
-            }
+/// @brief Generate the rainfall map using Inverse Distance Weighting
+/// @param link_rain link rain observations in image coordinates
+/// @param stats returns the counts and timings if not null
+Eigen::MatrixXf CmlInterp::make_map_idw(const std::vector<Observations>& link_rain, InterpStats* stats)
+{
+    std::cout << std::format("Found {} links with data", link_rain.size()) << std::endl;
 
-            // not enough locals so fill with nan
-            else {
-                for (float ia = -dbox; ia <= dbox; ia++) {
-                    for (int ib = -dbox; ib <= dbox; ib++) {
-                        int y = (int)(row + ia);
-                        int x = (int)(col + ib);
-                        if (y >= 0 && y < n_rows && x >= 0 && x < n_cols) {
-                            map(y, x) = NAN;
-                        }
-                    }
-                }
-            }
-        }
-    }
-    return map;
+    InterpParams params = idw_params();
+    MapWindow window = { 0, 0, params.n_rows, params.n_cols };
+    return interp_idw(link_rain, params, window, stats);
 }
 
-/// @brief Read the link rainfall data
-/// @param m_time Valid time
-/// @return unordered map with link_id and rain amount
-std::vector<Observations> CmlInterp::get_link_rain(time_t m_time)
+/// @brief Generate the rainfall map with the method in the config, "idw" or "ok"
+/// @param link_rain link rain observations in image coordinates
+/// @param stats returns the counts and timings if not null
+Eigen::MatrixXf CmlInterp::make_map(const std::vector<Observations>& link_rain, InterpStats* stats)
 {
-    std::vector<Observations> link_rain;
-
-    mongocxx::database db = _client->database("cml");
-    mongocxx::collection cml_data = db.collection("cml_data");
+    if (method() == "ok")
+        return make_map_ok(link_rain, stats);
+    return make_map_idw(link_rain, stats);
+}
 
+/// @brief Read the rain for a set of links at a time step
+/// @param cml_data time series collection
+/// @param link_ids array of link ids for the $in query
+/// @param links coordinates of the links
+/// @param m_time valid time
+/// @return link id, location and rain for the links that have a rain estimate
+std::vector<LinkRain> find_link_rain(mongocxx::collection& cml_data, bsoncxx::array::view link_ids,
+    const std::unordered_map<int, Coordinates>& links, time_t m_time)
+{
+    std::vector<LinkRain> link_rain;
     const auto time_tp = std::chrono::system_clock::from_time_t(m_time);
 
-    // Build the array of link ids
-    bsoncxx::builder::stream::array array_builder;
-    for (const auto& link : _link_coordinates) {
-        int link_id = link.first;
-        array_builder << link_id;
-    }
-
     // Search for all link_ids in the domain for m_time and with a rain key:value pair
     bsoncxx::builder::stream::document query_builder;
-    query_builder << "link_id" << bsoncxx::builder::stream::open_document << "$in"
-                  << array_builder.view() << bsoncxx::builder::stream::close_document
-                  << "time.end_time" << bsoncxx::types::b_date(time_tp) << "rain"
+    query_builder << "link_id" << bsoncxx::builder::stream::open_document << "$in" << link_ids
+                  << bsoncxx::builder::stream::close_document << "time.end_time"
+                  << bsoncxx::types::b_date(time_tp) << "rain"
                   << bsoncxx::builder::stream::open_document << "$exists" << true
                   << bsoncxx::builder::stream::close_document;
 
@@ -335,8 +448,10 @@ std::vector<Observations> CmlInterp::get_link_rain(time_t m_time)
                 if (doc["link_id"] && doc["rain"]) {
                     int link_id = doc["link_id"].get_int32();
                     double val = doc["rain"].get_double();
-                    link_rain.push_back(
-                        { val, _link_coordinates[link_id].x, _link_coordinates[link_id].y });
+                    auto link = links.find(link_id);
+                    if (link == links.end())
+                        continue;
+                    link_rain.push_back({ link_id, link->second.lon, link->second.lat, val });
                 }
 
             } catch (const bsoncxx::exception& e) {
@@ -352,19 +467,55 @@ std::vector<Observations> CmlInterp::get_link_rain(time_t m_time)
     return link_rain;
 }
 
-void CmlInterp::writeNetCDF(
-    const std::string& filename, const Eigen::MatrixXf& data, time_t map_time)
+/// @brief Read the rain for the links in the domain
+/// @param m_time Valid time
+/// @return link id, location and rain for the links that have a rain estimate
+std::vector<LinkRain> CmlInterp::fetch_link_rain(time_t m_time)
+{
+    mongocxx::database db = client().database("cml");
+    mongocxx::collection cml_data = db.collection(data_collection());
+    return find_link_rain(cml_data, _link_id_array.view(), _link_coordinates, m_time);
+}
+
+/// @brief Put the link rain in the image coordinates of the domain
+/// The coordinates of the links in the domain are found once by get_link_ids
+/// @param link_rain rain for the links, can include links outside the domain
+/// @return observations for the links in the domain
+std::vector<Observations> CmlInterp::index_link_rain(const std::vector<LinkRain>& link_rain)
+{
+    std::vector<Observations> link_obs;
+    link_obs.reserve(link_rain.size());
+    for (const auto& link : link_rain) {
+        auto coords = _link_coordinates.find(link.link_id);
+        if (coords == _link_coordinates.end())
+            continue;
+        link_obs.push_back({ link.value, coords->second.x, coords->second.y });
+    }
+    return link_obs;
+}
+
+/// @brief Read the link rainfall data
+/// @param m_time Valid time
+/// @return link rain observations in image coordinates
+std::vector<Observations> CmlInterp::get_link_rain(time_t m_time)
+{
+    return index_link_rain(fetch_link_rain(m_time));
+}
+
+/// @brief Create the dimensions, variables and attributes for a CF netCDF file
+/// @param file netCDF file open for writing
+/// @param map_time valid time of the map
+/// @param chunked use chunks the size of a tile and compress the rainfall
+/// @return the rainfall variable
+netCDF::NcVar CmlInterp::define_netcdf(netCDF::NcFile& file, time_t map_time, bool chunked)
 {
     // Get grid coords
-    std::vector<float> x = _pjn.x_vals();
-    std::vector<float> y = _pjn.y_vals();
+    const std::vector<float>& x = _x_vals;
+    const std::vector<float>& y = _y_vals;
     int nx = _pjn.nx();
     int ny = _pjn.ny();
     int nt = 1;
 
-    // Create NetCDF file
-    netCDF::NcFile file(filename, netCDF::NcFile::replace);
-
     // Define dimensions
     auto xDim = file.addDim("x", nx);
     auto yDim = file.addDim("y", ny);
@@ -376,6 +527,17 @@ void CmlInterp::writeNetCDF(
     auto tVar = file.addVar("time", netCDF::ncInt64, tDim);
     auto dataVar = file.addVar("rainfall", netCDF::ncFloat, { tDim, yDim, xDim });
 
+    if (chunked) {
+        size_t tile_rows = _config["tiling"].value("tile_rows", 512);
+        size_t tile_cols = _config["tiling"].value("tile_cols", 512);
+        int deflate_level = _config["tiling"].value("deflate_level", 4);
+        std::vector<size_t> chunks
+            = { 1, std::min(tile_rows, (size_t)ny), std::min(tile_cols, (size_t)nx) };
+        dataVar.setChunking(netCDF::NcVar::nc_CHUNKED, chunks);
+        if (deflate_level > 0)
+            dataVar.setCompression(true, true, deflate_level);
+    }
+
     // Add CF-compliant attributes to coordinate variables
     xVar.putAtt("standard_name", "projection_x_coordinate");
     xVar.putAtt("units", "m");
@@ -417,6 +579,21 @@ void CmlInterp::writeNetCDF(
     yVar.putVar(y.data());
     tVar.putVar(&map_time);
 
+    return dataVar;
+}
+
+/// @brief Write the map and any rolling accumulations to a netCDF file
+/// @param filename path to the netCDF file
+/// @param data rain rate map
+/// @param map_time valid time of the map
+/// @param accumulator rolling accumulations to be written with the map, can be null
+void CmlInterp::writeNetCDF(const std::string& filename, const Eigen::MatrixXf& data,
+    time_t map_time, const RainAccumulator* accumulator)
+{
+    // Create NetCDF file
+    netCDF::NcFile file(filename, netCDF::NcFile::replace);
+    auto dataVar = define_netcdf(file, map_time, false);
+
     // Flatten data for writing
     std::vector<float> flatData(data.size());
     for (Eigen::Index i = 0; i < data.rows(); ++i) {
@@ -425,4 +602,130 @@ void CmlInterp::writeNetCDF(
         }
     }
     dataVar.putVar(flatData.data());
+
+    if (accumulator == nullptr)
+        return;
+
+    auto tDim = file.getDim("time");
+    auto yDim = file.getDim("y");
+    auto xDim = file.getDim("x");
+    std::vector<int> flatCount(data.size());
+    for (int iw = 0; iw < accumulator->number_windows(); ++iw) {
+        int hours = accumulator->window_hours(iw);
+        Eigen::MatrixXf total = accumulator->total(iw);
+        const Eigen::MatrixXi& coverage = accumulator->coverage(iw);
+        for (Eigen::Index i = 0; i < total.rows(); ++i) {
+            for (Eigen::Index j = 0; j < total.cols(); ++j) {
+                flatData[i * total.cols() + j] = total(i, j);
+                flatCount[i * total.cols() + j] = coverage(i, j);
+            }
+        }
+
+        auto accumVar = file.addVar(
+            std::format("accumulation_{}h", hours), netCDF::ncFloat, { tDim, yDim, xDim });
+        accumVar.putAtt("units", "mm");
+        accumVar.putAtt("long_name", std::format("Rainfall accumulation over the last {} h", hours));
+        accumVar.putAtt("grid_mapping", "projection");
+        accumVar.putVar(flatData.data());
+
+        auto countVar = file.addVar(
+            std::format("coverage_{}h", hours), netCDF::ncInt, { tDim, yDim, xDim });
+        countVar.putAtt("units", "1");
+        countVar.putAtt("long_name",
+            std::format("Number of maps with valid data in the {} h accumulation", hours));
+        countVar.putAtt("maximum_count", netCDF::ncInt, accumulator->window_steps(iw));
+        countVar.putVar(flatCount.data());
+    }
+}
+
+/// @brief Interpolate the map tile by tile and write each tile as it is finished
+/// Only n_threads tiles are held in memory at any time. The method is the one in the
+/// config, for kriging the variogram is fitted once to all the links for the map
+/// @param filename path to the netCDF file
+/// @param link_rain link rain observations in image coordinates
+/// @param map_time valid time of the map
+/// @param metrics returns the interpolation counts and the time spent writing if not null
+void CmlInterp::write_tiled_netcdf(const std::string& filename,
+    const std::vector<Observations>& link_rain, time_t map_time, StepMetrics* metrics)
+{
+    netCDF::NcFile file(filename, netCDF::NcFile::replace);
+    auto dataVar = define_netcdf(file, map_time, true);
+
+    // the fit and the transform are done once for the map, the times are in the stats
+    bool use_ok = method() == "ok";
+    InterpStats total_stats;
+    InterpParams params = use_ok ? ok_params() : idw_params();
+    std::vector<Observations> obs = use_ok ? prepare_ok(link_rain, params, &total_stats) : link_rain;
+    int tile_rows = _config["tiling"].value("tile_rows", 512);
+    int tile_cols = _config["tiling"].value("tile_cols", 512);
+    int n_threads = _config["tiling"].value("n_threads", 1);
+    std::vector<MapWindow> tiles = make_tiles(params.n_rows, params.n_cols, tile_rows, tile_cols);
+
+    // links further than this from a tile are not used by any box in the tile
+    float halo = params.range + params.box_step;
+
+    // The netCDF library is not thread safe so the writes are serialised
+    std::mutex write_mutex;
+    std::atomic<int> next_tile = 0;
+    double write_ms = 0;
+
+    // the first error in a worker stops the others and is rethrown once they have finished
+    std::exception_ptr error = nullptr;
+    auto worker = [&]() {
+        std::vector<float> flatData;
+        InterpStats stats;
+        Kriging krig;
+        krig.set_params(_variogram);
+        try {
+            for (int it = next_tile++; it < (int)tiles.size(); it = next_tile++) {
+                const MapWindow& tile = tiles[it];
+                auto tile_obs = select_window_obs(obs, tile, halo);
+                Eigen::MatrixXf map;
+                if (use_ok) {
+                    map = interp_ok(tile_obs, params, tile, krig, &stats);
+                    if (_use_ihs)
+                        untransform(map);
+                } else {
+                    map = interp_idw(tile_obs, params, tile, &stats);
+                }
+
+                flatData.resize(map.size());
+                for (Eigen::Index i = 0; i < map.rows(); ++i) {
+                    for (Eigen::Index j = 0; j < map.cols(); ++j) {
+                        flatData[i * map.cols() + j] = map(i, j);
+                    }
+                }
+
+                std::vector<size_t> start = { 0, (size_t)tile.row0, (size_t)tile.col0 };
+                std::vector<size_t> count = { 1, (size_t)tile.n_rows, (size_t)tile.n_cols };
+                std::lock_guard<std::mutex> lock(write_mutex);
+                auto t_write = std::chrono::steady_clock::now();
+                dataVar.putVar(start, count, flatData.data());
+                write_ms += elapsed_ms(t_write);
+            }
+        } catch (...) {
+            next_tile = (int)tiles.size();
+            std::lock_guard<std::mutex> lock(write_mutex);
+            if (!error)
+                error = std::current_exception();
+        }
+        std::lock_guard<std::mutex> lock(write_mutex);
+        total_stats.merge(stats);
+    };
+
+    std::vector<std::thread> threads;
+    for (int ia = 1; ia < n_threads; ++ia) {
+        threads.emplace_back(worker);
+    }
+    worker();
+    for (auto& thread : threads) {
+        thread.join();
+    }
+    if (error)
+        std::rethrow_exception(error);
+
+    if (metrics) {
+        metrics->interp.merge(total_stats);
+        metrics->write_ms = write_ms;
+    }
 }
@@ -1,18 +1,26 @@
 #ifndef CML_INTERP_H
 #define CML_INTERP_H
 #include <Eigen/Dense>
+#include <chrono>
 #include <cmath>
 #include <ctime>
+#include <memory>
 #include <string>
 #include <unordered_map>
 #include <vector>
 
+#include <netcdf>
 #include <nlohmann/json.hpp>
 using json = nlohmann::json;
 
 // Include the Singleton header for the mongodb client
+#include "accumulator.h"
 #include "image_projection.h"
+#include "map_engine.h"
 #include "mongo_client_manager.h"
+#include <bsoncxx/array/view.hpp>
+#include <bsoncxx/builder/basic/array.hpp>
+#include <mongocxx/collection.hpp>
 /// @brief Structure for link coordinates
 struct Coordinates {
     double lon;
@@ -21,13 +29,66 @@ struct Coordinates {
     double y;
 };
 
-/// @brief Structure with link rain data
-struct Observations {
+/// @brief Rain for a link at a time step, before it is put on a grid
+struct LinkRain {
+    int link_id;
+    double lon;
+    double lat;
     double value;
-    double x;
-    double y;
 };
 
+/// @brief Timings (ms) and counts for the production of one map
+struct StepMetrics {
+    std::string domain; // name of the domain
+    time_t map_time = 0;
+    int number_obs = 0; // links with rain data
+    double fetch_ms = 0;
+    double interp_ms = 0;
+    double write_ms = 0;
+    double total_ms = 0;
+    long bytes_written = 0;
+    InterpStats interp; // phases and counts inside the interpolation
+    json variogram; // variogram used for kriging, null for IDW
+    std::string file_name;
+
+    json to_json() const
+    {
+        double mean_size = interp.kriging_systems > 0
+            ? double(interp.kriging_size_sum) / interp.kriging_systems
+            : 0.0;
+        return { { "domain", domain }, { "map_time", map_time }, { "number_obs", number_obs },
+            { "fetch_ms", fetch_ms }, { "interp_ms", interp_ms }, { "write_ms", write_ms },
+            { "total_ms", total_ms }, { "select_ms", interp.select_ms },
+            { "kernel_ms", interp.kernel_ms }, { "build_ms", interp.build_ms },
+            { "boxes", interp.boxes }, { "boxes_nan", interp.boxes_nan },
+            { "pixels", interp.pixels }, { "pixels_nan", interp.pixels_nan },
+            { "kriging_systems", interp.kriging_systems },
+            { "kriging_size_mean", mean_size }, { "kriging_size_max", interp.kriging_size_max },
+            { "fit_ms", interp.fit_ms }, { "variogram_fits", interp.variogram_fits },
+            { "variogram_fallbacks", interp.variogram_fallbacks }, { "variogram", variogram },
+            { "bytes_written", bytes_written }, { "file", file_name } };
+    }
+};
+
+/// @brief Seconds between maps unless the config sets "time_step", the step of the time series data
+constexpr int DEFAULT_TIME_STEP = 15 * 60;
+
+/// @brief Seconds between maps, used for the map times and the accumulation windows
+/// so that they cannot drift apart. "time_step" in the "daemon" section is read if
+/// there is none at the top level
+inline int map_time_step(const json& config)
+{
+    int daemon_step = config.value("daemon", json::object()).value("time_step", DEFAULT_TIME_STEP);
+    return config.value("time_step", daemon_step);
+}
+
+/// @brief Milliseconds elapsed since a steady_clock time point
+inline double elapsed_ms(std::chrono::steady_clock::time_point start)
+{
+    return std::chrono::duration<double, std::milli>(std::chrono::steady_clock::now() - start)
+        .count();
+}
+
 class CmlInterp {
 public:
     CmlInterp();
@@ -35,74 +96,77 @@ public:
     std::string convertTimeToIso(const time_t ts);
     void set_config(json config);
     int get_link_ids();
+    bool count_step_records(time_t m_time, int& n_records, int& n_rain);
+    std::vector<LinkRain> fetch_link_rain(time_t m_time);
+    std::vector<Observations> index_link_rain(const std::vector<LinkRain>& link_rain);
     Eigen::MatrixXf make_map_ok(time_t m_time);
     Eigen::MatrixXf make_map_idw(time_t m_time);
-    void writeNetCDF(const std::string& filename, const Eigen::MatrixXf& data, time_t map_time);
+    Eigen::MatrixXf make_map_ok(
+        const std::vector<Observations>& link_rain, InterpStats* stats = nullptr);
+    Eigen::MatrixXf make_map_idw(
+        const std::vector<Observations>& link_rain, InterpStats* stats = nullptr);
+    Eigen::MatrixXf make_map(
+        const std::vector<Observations>& link_rain, InterpStats* stats = nullptr);
+    std::string method() const { return _config.value("method", "idw"); };
+    const VariogramParams& variogram() const { return _variogram; };
+    std::string process_step(time_t m_time, StepMetrics& metrics);
+    std::string process_step(
+        time_t m_time, const std::vector<LinkRain>& link_rain, StepMetrics& metrics);
+    void writeNetCDF(const std::string& filename, const Eigen::MatrixXf& data, time_t map_time,
+        const RainAccumulator* accumulator = nullptr);
+    void write_tiled_netcdf(const std::string& filename,
+        const std::vector<Observations>& link_rain, time_t map_time,
+        StepMetrics* metrics = nullptr);
+    void to_image_coords(double lon, double lat, double& x, double& y)
+    {
+        _pjn.to_image_coords(lon, lat, x, y);
+    };
+    const std::unordered_map<int, Coordinates>& link_coordinates() const
+    {
+        return _link_coordinates;
+    };
+    std::string name() const { return _config.value("name", ""); };
+    const std::vector<float>& x_vals() const { return _x_vals; };
+    const std::vector<float>& y_vals() const { return _y_vals; };
+    std::string data_collection() const { return _config.value("data_collection", "cml_data"); };
+    std::string metadata_collection() const
+    {
+        return _config.value("metadata_collection", "cml_metadata");
+    };
 
 private:
-    mongocxx::client* _client;
+    mongocxx::client* _client; // connected on first use
+    mongocxx::client& client();
     std::unordered_map<int, Coordinates> _link_coordinates;
+    bsoncxx::builder::basic::array _link_id_array; // link ids for the $in queries
     json _config;
     image_projection _pjn;
+    std::vector<float> _x_vals; // grid coordinates for the netCDF file
+    std::vector<float> _y_vals;
+    std::unique_ptr<RainAccumulator> _accumulator; // rolling accumulations, if configured
+
+    // Variogram for kriging, the last good fit is kept for the next map
+    VariogramParams _variogram;
+    VariogramFitParams _variogram_fit;
+    bool _fit_variogram;
+    bool _use_ihs; // krige the transformed rain
 
     // Inverse Hyperbolic Transformation
     float _prescale;
     double to_ihs(double value) { return asinh(value * _prescale); };
     double from_ihs(double value) { return value > 0.0f ? sinh(value) / _prescale : 0.0f; };
     std::vector<Observations> get_link_rain(time_t m_time);
+    InterpParams idw_params();
+    InterpParams ok_params();
+    std::vector<Observations> prepare_ok(
+        const std::vector<Observations>& link_rain, InterpParams& params, InterpStats* stats);
+    void untransform(Eigen::MatrixXf& map);
+    netCDF::NcVar define_netcdf(netCDF::NcFile& file, time_t map_time, bool chunked);
 };
 
-class Kriging {
-public:
-    Eigen::MatrixXd buildGammaMatrix(const std::vector<Observations>& observations)
-    {
-        int n = observations.size();
-        Eigen::MatrixXd gamma = Eigen::MatrixXd::Zero(n + 1, n + 1);
-
-        for (int i = 0; i < n; ++i) {
-            for (int j = 0; j <= i; ++j) {
-                double dx = observations[i].x - observations[j].x;
-                double dy = observations[i].y - observations[j].y;
-                double dist = std::sqrt(dx * dx + dy * dy);
-                gamma(i, j) = gamma(j, i) = variogram(dist);
-            }
-            gamma(i, n) = gamma(n, i) = 1.0;
-        }
-
-        gamma(n, n) = 0.0; // Lagrange multiplier
-        return gamma;
-    }
-
-    Eigen::VectorXd solveWeights(const Eigen::MatrixXd& gamma, const Eigen::VectorXd& values)
-    {
-        Eigen::VectorXd rhs(values.size() + 1);
-        rhs.head(values.size()) = values;
-        rhs(values.size()) = 1.0; // Constraint for weights to sum to 1
-
-        // Solve gamma * weights = rhs
-        Eigen::VectorXd weights = gamma.ldlt().solve(rhs);
-        return weights;
-    }
-
-    double variogram(double distance)
-    {
-        // Example spherical variogram model
-        if (distance < 1.0)
-            return _nugget;    
-        if (distance > _range)
-            return _nugget + _sill;
-        return _nugget + _sill * (1.5 * distance / _range - 0.5 * std::pow(distance / _range, 3));
-    }
-    void set_params(double range, double sill, double nugget) { 
-        _range = range;
-        _sill = sill;
-        _nugget = nugget;
-    }
-
-private:
-    double _range; // pixel units
-    double _sill; 
-    double _nugget; 
-};
+bool count_link_records(mongocxx::collection& cml_data, bsoncxx::array::view link_ids,
+    time_t m_time, int& n_records, int& n_rain);
+std::vector<LinkRain> find_link_rain(mongocxx::collection& cml_data, bsoncxx::array::view link_ids,
+    const std::unordered_map<int, Coordinates>& links, time_t m_time);
 
 #endif // CML_INTERP_H
@@ -0,0 +1,161 @@
+// Python bindings for CmlInterp
+// The maps are returned as NumPy arrays that share the memory of the Eigen matrix
+#include <pybind11/numpy.h>
+#include <pybind11/pybind11.h>
+#include <pybind11/stl.h>
+
+#include "cml_interp.h"
+
+namespace py = pybind11;
+
+/// @brief Hand an Eigen map over to NumPy without copying the data
+/// @param map map that is moved onto the heap and freed by NumPy
+/// @return array with shape (n_rows, n_cols) in Fortran order
+static py::array_t<float> to_numpy(Eigen::MatrixXf&& map)
+{
+    auto* data = new Eigen::MatrixXf(std::move(map));
+    py::capsule owner(data, [](void* p) { delete reinterpret_cast<Eigen::MatrixXf*>(p); });
+
+    // Eigen is column major
+    std::vector<py::ssize_t> shape = { data->rows(), data->cols() };
+    std::vector<py::ssize_t> strides
+        = { (py::ssize_t)sizeof(float), (py::ssize_t)(sizeof(float) * data->rows()) };
+    return py::array_t<float>(shape, strides, data->data(), owner);
+}
+
+/// @brief Make the list of observations from arrays of image coords and rain rates
+/// @param x column of each link in image coords
+/// @param y row of each link in image coords
+/// @param values rain rate at each link
+static std::vector<Observations> to_observations(
+    py::array_t<double, py::array::c_style | py::array::forcecast> x,
+    py::array_t<double, py::array::c_style | py::array::forcecast> y,
+    py::array_t<double, py::array::c_style | py::array::forcecast> values)
+{
+    if (x.size() != y.size() || x.size() != values.size())
+        throw std::invalid_argument("x, y and values must be the same length");
+
+    auto xs = x.unchecked<1>();
+    auto ys = y.unchecked<1>();
+    auto vs = values.unchecked<1>();
+    std::vector<Observations> obs(values.size());
+    for (py::ssize_t ia = 0; ia < values.size(); ++ia) {
+        obs[ia] = { vs(ia), xs(ia), ys(ia) };
+    }
+    return obs;
+}
+
+PYBIND11_MODULE(cml_interp_py, m)
+{
+    m.doc() = "Generate gridded maps from CML rainfall estimates";
+
+    py::class_<CmlInterp>(m, "CmlInterp")
+        .def(py::init<>())
+        .def(
+            "set_config",
+            [](CmlInterp& self, py::object config) {
+                // accept either the JSON text or the parsed dictionary
+                std::string text;
+                if (py::isinstance<py::str>(config))
+                    text = config.cast<std::string>();
+                else
+                    text = py::module_::import("json").attr("dumps")(config).cast<std::string>();
+                self.set_config(json::parse(text));
+            },
+            py::arg("config"), "Set up the map domain from the JSON configuration")
+        .def("get_link_ids", &CmlInterp::get_link_ids,
+            "Read the link metadata for the domain, returns the number of links")
+        .def(
+            "make_map_idw",
+            [](CmlInterp& self, time_t m_time) {
+                Eigen::MatrixXf map;
+                {
+                    py::gil_scoped_release release;
+                    map = self.make_map_idw(m_time);
+                }
+                return to_numpy(std::move(map));
+            },
+            py::arg("time"), "IDW map from the link rain in the database, time in s since 1970")
+        .def(
+            "make_map_idw",
+            [](CmlInterp& self, py::array_t<double> x, py::array_t<double> y,
+                py::array_t<double> values) {
+                auto obs = to_observations(x, y, values);
+                Eigen::MatrixXf map;
+                {
+                    py::gil_scoped_release release;
+                    map = self.make_map_idw(obs);
+                }
+                return to_numpy(std::move(map));
+            },
+            py::arg("x"), py::arg("y"), py::arg("values"),
+            "IDW map from link rain at x, y in image coords")
+        .def(
+            "make_map_ok",
+            [](CmlInterp& self, time_t m_time) {
+                Eigen::MatrixXf map;
+                {
+                    py::gil_scoped_release release;
+                    map = self.make_map_ok(m_time);
+                }
+                return to_numpy(std::move(map));
+            },
+            py::arg("time"),
+            "Ordinary kriging map from the link rain in the database, time in s since 1970")
+        .def(
+            "make_map_ok",
+            [](CmlInterp& self, py::array_t<double> x, py::array_t<double> y,
+                py::array_t<double> values) {
+                auto obs = to_observations(x, y, values);
+                Eigen::MatrixXf map;
+                {
+                    py::gil_scoped_release release;
+                    map = self.make_map_ok(obs);
+                }
+                return to_numpy(std::move(map));
+            },
+            py::arg("x"), py::arg("y"), py::arg("values"),
+            "Ordinary kriging map from link rain at x, y in image coords")
+        .def(
+            "to_image_coords",
+            [](CmlInterp& self, py::array_t<double, py::array::c_style | py::array::forcecast> lon,
+                py::array_t<double, py::array::c_style | py::array::forcecast> lat) {
+                if (lon.size() != lat.size())
+                    throw std::invalid_argument("lon and lat must be the same length");
+                py::array_t<double> x(lon.size());
+                py::array_t<double> y(lon.size());
+                auto lons = lon.unchecked<1>();
+                auto lats = lat.unchecked<1>();
+                auto xs = x.mutable_unchecked<1>();
+                auto ys = y.mutable_unchecked<1>();
+                for (py::ssize_t ia = 0; ia < lon.size(); ++ia) {
+                    self.to_image_coords(lons(ia), lats(ia), xs(ia), ys(ia));
+                }
+                return py::make_tuple(x, y);
+            },
+            py::arg("lon"), py::arg("lat"), "Convert lon, lat arrays into image coords")
+        .def(
+            "x_vals",
+            [](CmlInterp& self) {
+                return py::array_t<float>(self.x_vals().size(), self.x_vals().data());
+            },
+            "Projection x coordinates of the grid columns")
+        .def(
+            "y_vals",
+            [](CmlInterp& self) {
+                return py::array_t<float>(self.y_vals().size(), self.y_vals().data());
+            },
+            "Projection y coordinates of the grid rows")
+        .def(
+            "write_netcdf",
+            [](CmlInterp& self, const std::string& filename,
+                py::array_t<float, py::array::f_style | py::array::forcecast> data,
+                time_t map_time) {
+                if (data.ndim() != 2)
+                    throw std::invalid_argument("data must be a 2D array");
+                Eigen::Map<const Eigen::MatrixXf> map(data.data(), data.shape(0), data.shape(1));
+                self.writeNetCDF(filename, map, map_time);
+            },
+            py::arg("filename"), py::arg("data"), py::arg("time"),
+            "Write a map to a CF netCDF file");
+}
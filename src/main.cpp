@@ -7,15 +7,21 @@
 #include <fstream>
 #include <iostream>
 #include <nlohmann/json.hpp>
+#include <stdexcept>
 #include <stdio.h>
 #include <string>
 #include <ctime>
 #include <filesystem>
 
 using json = nlohmann::json;
+#include "cml_daemon.h"
+#include "cml_domains.h"
 #include "cml_interp.h"
 
-int run(std::string start, std::string end, json config);
+int run(std::string start, std::string end, json config, bool profile = false,
+    std::string metrics_file = "");
+json summarise(const std::vector<StepMetrics>& steps);
+int run_daemon(std::string start, json config);
 std::vector<int> get_link_ids(json config);
 
 int main(int argc, char* argv[])
@@ -25,16 +31,25 @@ int main(int argc, char* argv[])
     options.add_options()("h,help", "Print usage")(
         "s,start", "Start time as ISO date", cxxopts::value<std::string>())(
         "e,end", "End time as ISO date", cxxopts::value<std::string>())(
-        "c,config", "Configuration file", cxxopts::value<std::string>());
+        "c,config", "Configuration file", cxxopts::value<std::string>())(
+        "d,daemon", "Run continuously and make maps as the rain data are completed")(
+        "p,profile", "Print a JSON line with the timings and counts for each map and the run")(
+        "m,metrics", "File for the JSON lines from --profile", cxxopts::value<std::string>());
 
     auto result = options.parse(argc, argv);
     if (result.count("help")) {
         std::cout << options.help() << std::endl;
         return 0;
     }
-    std::string start_str = result["start"].as<std::string>();
-    std::string end_str = result["end"].as<std::string>();
-    
+    bool daemon = result.count("daemon") > 0;
+    std::string start_str = result.count("start") ? result["start"].as<std::string>() : "";
+    std::string end_str = result.count("end") ? result["end"].as<std::string>() : "";
+    if (!daemon && (start_str.empty() || end_str.empty())) {
+        std::cerr << "Start and end times are required unless running as a daemon" << std::endl;
+        std::cout << options.help() << std::endl;
+        return 1;
+    }
+
     // parse the config file 
     std::string config_file = result["config"].as<std::string>();
     std::ifstream f;
@@ -46,45 +61,101 @@ int main(int argc, char* argv[])
     json config = json::parse(f);
 
     // run the application
-    auto status = run(start_str, end_str, config);
-    return status;
+    try {
+        if (daemon)
+            return run_daemon(start_str, config);
+        std::string metrics_file = result.count("metrics") ? result["metrics"].as<std::string>() : "";
+        bool profile = result.count("profile") > 0 || !metrics_file.empty();
+        auto status = run(start_str, end_str, config, profile, metrics_file);
+        return status;
+    } catch (const std::invalid_argument& e) {
+        std::cerr << std::format("Invalid configuration: {}", e.what()) << std::endl;
+        return 1;
+    }
+}
+
+/// @brief Totals of the step metrics over a run
+/// @param steps metrics for each map
+/// @return summary with the total and mean time in each phase
+json summarise(const std::vector<StepMetrics>& steps)
+{
+    StepMetrics total;
+    double max_ms = 0;
+    for (const auto& step : steps) {
+        total.number_obs += step.number_obs;
+        total.fetch_ms += step.fetch_ms;
+        total.interp_ms += step.interp_ms;
+        total.write_ms += step.write_ms;
+        total.total_ms += step.total_ms;
+        total.bytes_written += step.bytes_written;
+        total.interp.merge(step.interp);
+        max_ms = std::max(max_ms, step.total_ms);
+    }
+
+    json summary = total.to_json();
+    summary.erase("domain");
+    summary.erase("map_time");
+    summary.erase("file");
+    summary["steps"] = steps.size();
+    summary["max_total_ms"] = max_ms;
+    if (!steps.empty()) {
+        for (const char* phase : { "fetch_ms", "interp_ms", "write_ms", "total_ms" })
+            summary[std::string("mean_") + phase] = summary[phase].get<double>() / steps.size();
+    }
+    return { { "summary", summary } };
 }
 
-int run(std::string start, std::string end, json config)
+int run(std::string start, std::string end, json config, bool profile, std::string metrics_file)
 {
     std::cout << std::format("start date = {}", start) << std::endl;
     std::cout << std::format("end date = {}", end) << std::endl;
-    CmlInterp cml;
+    CmlDomains cml(config);
 
-    // Get the link_ids in the area of interest
-    cml.set_config(config);
+    // Get the link_ids in the areas of interest
     auto number_links = cml.get_link_ids();
-    std::cout << std::format("Found {} links in map area\n", number_links);
+    std::cout << std::format("Found {} links in {} map areas\n", number_links, cml.size());
 
     // Get the start and end times for the maps
     std::time_t start_time = cml.convertIsoToTime(start);
     std::time_t end_time = cml.convertIsoToTime(end);
-    int time_step = 15 * 60; // assume 15 min steps
+    int time_step = map_time_step(config);
 
-    // Loop over the times to be processed
-    std::string data_dir = config["directory"]; 
-    std::string name = config["name"];
+    std::ofstream metrics_out;
+    if (!metrics_file.empty())
+        metrics_out.open(metrics_file, std::ios::app);
+    std::ostream& out = metrics_out.is_open() ? metrics_out : std::cout;
 
+    // Loop over the times to be processed, the link rain is read once for all the domains
+    std::vector<StepMetrics> steps;
     for (time_t m_time = start_time; m_time <= end_time; m_time += time_step){
-        Eigen::MatrixXf map = cml.make_map_idw(m_time);
-
-        // Format the time as yyyy-mm-ddThh:mm:ss
-        char c_time[64] = {0};
-        tm *tm_time = gmtime(&m_time); 
-        strftime(c_time, 64, "%Y-%m-%dT%H:%M:%S", tm_time);
-        
-        // Construct the full path for the output file
-        std::string full_path = data_dir + std::string(c_time) + "_" + name + ".nc";
-        std::cout << std::format("Writing {}\n", full_path); 
-
-        // Write the netCD file 
-        cml.writeNetCDF(full_path, map, m_time) ;
+        std::vector<StepMetrics> metrics;
+        cml.process_step(m_time, metrics);
+        if (profile) {
+            for (const auto& domain_metrics : metrics) {
+                out << domain_metrics.to_json().dump() << std::endl;
+                steps.push_back(domain_metrics);
+            }
+        }
     }
+    if (profile)
+        out << summarise(steps).dump() << std::endl;
+
+    return 0;
+}
+
+int run_daemon(std::string start, json config)
+{
+    std::cout << std::format("start date = {}", start) << std::endl;
+    CmlDomains cml(config);
+
+    // The link metadata are read once and kept for the life of the daemon
+    auto number_links = cml.get_link_ids();
+    std::cout << std::format("Found {} links in {} map areas\n", number_links, cml.size());
+
+    // Start from now if a start time has not been given
+    std::time_t start_time = start.empty() ? std::time(nullptr) : cml.convertIsoToTime(start);
 
+    CmlDaemon daemon(cml, config);
+    daemon.run(start_time);
     return 0;
 }
@@ -0,0 +1,478 @@
+#include "map_engine.h"
+#include <algorithm>
+#include <chrono>
+#include <numeric>
+#include <random>
+
+using steady_clock = std::chrono::steady_clock;
+
+/// @brief Milliseconds between two time points
+static double ms_between(steady_clock::time_point start, steady_clock::time_point end)
+{
+    return std::chrono::duration<double, std::milli>(end - start).count();
+}
+
+/// @brief Add the counts for a box to the statistics
+/// @param stats statistics, nothing is done if this is null
+/// @param has_links false if the box was filled with NaN
+/// @param n_pixels pixels in the box that are in the window
+/// @param n_nan pixels in the box that are NaN
+static void count_box(InterpStats* stats, bool has_links, long n_pixels, long n_nan)
+{
+    if (!stats)
+        return;
+    if (has_links)
+        stats->boxes++;
+    else
+        stats->boxes_nan++;
+    stats->pixels += n_pixels;
+    stats->pixels_nan += n_nan;
+}
+
+/// @brief Copy the links into float arrays
+/// @param link_rain link rain observations in image coordinates
+/// @return links as arrays
+static ObsArrays to_arrays(const std::vector<Observations>& link_rain)
+{
+    ObsArrays obs;
+    int n = link_rain.size();
+    obs.x.resize(n);
+    obs.y.resize(n);
+    obs.value.resize(n);
+    obs.link.resize(n);
+    for (int ia = 0; ia < n; ++ia) {
+        obs.x(ia) = link_rain[ia].x;
+        obs.y(ia) = link_rain[ia].y;
+        obs.value(ia) = link_rain[ia].value;
+        obs.link(ia) = ia;
+    }
+    return obs;
+}
+
+/// @brief Copy the links for which a condition is true
+/// @param links all the links
+/// @param keep true for the links to copy
+/// @param selected returns the links
+static void gather_obs(
+    const ObsArrays& links, const Eigen::Array<bool, Eigen::Dynamic, 1>& keep, ObsArrays& selected)
+{
+    int n = keep.count();
+    selected.x.resize(n);
+    selected.y.resize(n);
+    selected.value.resize(n);
+    selected.link.resize(n);
+    for (Eigen::Index ia = 0, ib = 0; ia < links.size(); ++ia) {
+        if (keep(ia)) {
+            selected.x(ib) = links.x(ia);
+            selected.y(ib) = links.y(ia);
+            selected.value(ib) = links.value(ia);
+            selected.link(ib) = links.link(ia);
+            ib++;
+        }
+    }
+}
+
+/// @brief Select the links that could be within range of a row of boxes
+/// The band is a little wider than the range so that it includes every link
+/// that select_local_obs will find for the boxes in the row
+/// @param links all the links
+/// @param row row of the centre of the boxes
+/// @param range search range in image coords
+/// @param band returns the links in the band
+static void select_band_obs(const ObsArrays& links, float row, float range, ObsArrays& band)
+{
+    gather_obs(links, (links.y - row).abs() < range + 1.0f, band);
+}
+
+/// @brief Select the links that are within range of the centre of a box
+/// @param links all the links, or the band for the row
+/// @param row row of the centre of the box
+/// @param col column of the centre of the box
+/// @param range search range in image coords
+/// @param local_obs returns the links within range
+static void select_local_obs(
+    const ObsArrays& links, float row, float col, float range, ObsArrays& local_obs)
+{
+    gather_obs(links, ((links.x - col).square() + (links.y - row).square()).sqrt() < range, local_obs);
+}
+
+/// @brief The pixels of a box that are inside the window
+/// @param row row of the centre of the box
+/// @param col column of the centre of the box
+/// @param dbox half the width of the box
+/// @param window part of the grid being interpolated
+/// @param px returns the column of each pixel
+/// @param py returns the row of each pixel
+static void box_pixels(
+    int row, int col, int dbox, const MapWindow& window, Eigen::ArrayXf& px, Eigen::ArrayXf& py)
+{
+    int n_side = 2 * dbox + 1;
+    px.resize(n_side * n_side);
+    py.resize(n_side * n_side);
+    int n = 0;
+    for (int y = row - dbox; y <= row + dbox; ++y) {
+        for (int x = col - dbox; x <= col + dbox; ++x) {
+            if (y < window.row0 || y >= window.row0 + window.n_rows || x < window.col0
+                || x >= window.col0 + window.n_cols)
+                continue;
+            px(n) = x;
+            py(n) = y;
+            n++;
+        }
+    }
+    px.conservativeResize(n);
+    py.conservativeResize(n);
+}
+
+/// @brief Apply the limits for the rain values and copy the pixels into the map
+/// @param vals interpolated value for each pixel
+/// @param px column of each pixel
+/// @param py row of each pixel
+/// @param params search parameters with the limits for the rain values
+/// @param window part of the grid being interpolated
+/// @param map map for the window
+/// @return number of pixels that are NaN
+static long put_pixels(const Eigen::ArrayXf& vals, const Eigen::ArrayXf& px,
+    const Eigen::ArrayXf& py, const InterpParams& params, const MapWindow& window,
+    Eigen::MatrixXf& map)
+{
+    long n_nan = 0;
+    for (Eigen::Index ip = 0; ip < vals.size(); ++ip) {
+        float val = vals(ip);
+
+        // check the limits for the rain value
+        if (val > params.max_value || std::isnan(val)) {
+            val = NAN;
+            n_nan++;
+        }
+        if (val < params.min_value)
+            val = 0.0;
+        map((int)py(ip) - window.row0, (int)px(ip) - window.col0) = val;
+    }
+    return n_nan;
+}
+
+/// @brief Generate the rainfall map over a window using Inverse Distance Weighting
+/// The links are selected around boxes that are aligned with the full grid so that
+/// the result does not depend on how the grid is split into windows
+/// @param link_rain link rain observations in image coordinates
+/// @param params search parameters
+/// @param window part of the grid to be interpolated
+/// @param stats returns the counts and timings if not null
+/// @return map with the size of the window
+Eigen::MatrixXf interp_idw(const std::vector<Observations>& link_rain, const InterpParams& params,
+    const MapWindow& window, InterpStats* stats)
+{
+    int box_step = params.box_step;
+    int dbox = box_step / 2;
+    int row_end = window.row0 + window.n_rows;
+    int col_end = window.col0 + window.n_cols;
+    ObsArrays links = to_arrays(link_rain);
+    ObsArrays band, local_obs;
+    Eigen::ArrayXf px, py;
+
+    Eigen::MatrixXf map(window.n_rows, window.n_cols);
+
+    // loop over the boxes that overlap the window
+    for (int k_row = window.row0 / box_step; k_row * box_step < row_end; k_row++) {
+        int row = k_row * box_step + dbox;
+        select_band_obs(links, row, params.range, band);
+        for (int k_col = window.col0 / box_step; k_col * box_step < col_end; k_col++) {
+            int col = k_col * box_step + dbox;
+
+            // Get the observations for within range of the center of the box
+            steady_clock::time_point t_select, t_kernel;
+            if (stats)
+                t_select = steady_clock::now();
+            select_local_obs(band, row, col, params.range, local_obs);
+            int number_locals = local_obs.size();
+            if (stats) {
+                t_kernel = steady_clock::now();
+                stats->select_ms += ms_between(t_select, t_kernel);
+            }
+
+            box_pixels(row, col, dbox, window, px, py);
+            long n_nan = px.size();
+            if (number_locals < params.min_number_locals) {
+                // not enough locals so fill with nan
+                for (Eigen::Index ip = 0; ip < px.size(); ++ip)
+                    map((int)py(ip) - window.row0, (int)px(ip) - window.col0) = NAN;
+            } else {
+                // inverse distance squared weights, vectorised over the links
+                Eigen::ArrayXf vals(px.size());
+                for (Eigen::Index ip = 0; ip < px.size(); ++ip) {
+                    auto weights
+                        = ((local_obs.x - px(ip)).square() + (local_obs.y - py(ip)).square()).inverse();
+                    vals(ip) = (weights * local_obs.value).sum() / weights.sum();
+                }
+                n_nan = put_pixels(vals, px, py, params, window, map);
+            }
+
+            if (stats) {
+                stats->kernel_ms += ms_between(t_kernel, steady_clock::now());
+                count_box(stats, number_locals >= params.min_number_locals, px.size(), n_nan);
+            }
+        }
+    }
+    return map;
+}
+
+/// @brief Generate the rainfall map over a window using ordinary Kriging
+/// @param link_rain link rain observations in image coordinates
+/// @param params search parameters
+/// @param window part of the grid to be interpolated
+/// @param krig kriging with the variogram parameters set
+/// @param stats returns the counts and timings if not null
+/// @return map with the size of the window
+Eigen::MatrixXf interp_ok(const std::vector<Observations>& link_rain, const InterpParams& params,
+    const MapWindow& window, Kriging& krig, InterpStats* stats)
+{
+    int box_step = params.box_step;
+    int dbox = box_step / 2;
+    int row_end = window.row0 + window.n_rows;
+    int col_end = window.col0 + window.n_cols;
+    ObsArrays links = to_arrays(link_rain);
+    ObsArrays band, local_obs;
+    Eigen::ArrayXf px, py;
+
+    Eigen::MatrixXf map(window.n_rows, window.n_cols);
+
+    // loop over the boxes that overlap the window
+    for (int k_row = window.row0 / box_step; k_row * box_step < row_end; k_row++) {
+        int row = k_row * box_step + dbox;
+        select_band_obs(links, row, params.range, band);
+        for (int k_col = window.col0 / box_step; k_col * box_step < col_end; k_col++) {
+            int col = k_col * box_step + dbox;
+
+            // Get the observations for within range of the center of the box
+            steady_clock::time_point t_select, t_kernel;
+            if (stats)
+                t_select = steady_clock::now();
+            select_local_obs(band, row, col, params.range, local_obs);
+            int number_locals = local_obs.size();
+            if (stats) {
+                t_kernel = steady_clock::now();
+                stats->select_ms += ms_between(t_select, t_kernel);
+            }
+
+            box_pixels(row, col, dbox, window, px, py);
+            long n_nan = px.size();
+            if (number_locals < params.min_number_locals) {
+                // not enough locals so fill with nan
+                for (Eigen::Index ip = 0; ip < px.size(); ++ip)
+                    map((int)py(ip) - window.row0, (int)px(ip) - window.col0) = NAN;
+            } else {
+                // the kriging system is the same for all the pixels in the box
+                // so it is only factorised once, with the coordinates in double
+                Eigen::ArrayXd ox(number_locals), oy(number_locals), ov(number_locals);
+                for (int ia = 0; ia < number_locals; ++ia) {
+                    const Observations& obs = link_rain[local_obs.link(ia)];
+                    ox(ia) = obs.x;
+                    oy(ia) = obs.y;
+                    ov(ia) = obs.value;
+                }
+                Eigen::LDLT<Eigen::MatrixXd> factor(krig.buildGammaMatrix(ox, oy));
+                if (stats) {
+                    auto t_built = steady_clock::now();
+                    stats->build_ms += ms_between(t_kernel, t_built);
+                    t_kernel = t_built;
+                    stats->kriging_systems++;
+                    stats->kriging_size_sum += number_locals;
+                    stats->kriging_size_max = std::max(stats->kriging_size_max, number_locals);
+                }
+
+                // variogram from each link to each pixel, and the weights for all the pixels
+                Eigen::ArrayXXd dx
+                    = px.cast<double>().replicate(1, number_locals).rowwise() - ox.transpose();
+                Eigen::ArrayXXd dy
+                    = py.cast<double>().replicate(1, number_locals).rowwise() - oy.transpose();
+                Eigen::ArrayXXd values = krig.variogram((dx.square() + dy.square()).sqrt());
+                Eigen::MatrixXd weights = krig.solveBoxWeights(factor, values.transpose().matrix());
+                Eigen::ArrayXf vals
+                    = (weights.topRows(number_locals).transpose() * ov.matrix()).cast<float>().array();
+                n_nan = put_pixels(vals, px, py, params, window, map);
+            }
+
+            if (stats) {
+                stats->kernel_ms += ms_between(t_kernel, steady_clock::now());
+                count_box(stats, number_locals >= params.min_number_locals, px.size(), n_nan);
+            }
+        }
+    }
+    return map;
+}
+
+/// @brief Split the grid into tiles
+/// @param n_rows rows in the grid
+/// @param n_cols columns in the grid
+/// @param tile_rows maximum rows in a tile
+/// @param tile_cols maximum columns in a tile
+/// @return list of tiles in row major order
+std::vector<MapWindow> make_tiles(int n_rows, int n_cols, int tile_rows, int tile_cols)
+{
+    std::vector<MapWindow> tiles;
+    for (int row0 = 0; row0 < n_rows; row0 += tile_rows) {
+        for (int col0 = 0; col0 < n_cols; col0 += tile_cols) {
+            tiles.push_back(
+                { row0, col0, std::min(tile_rows, n_rows - row0), std::min(tile_cols, n_cols - col0) });
+        }
+    }
+    return tiles;
+}
+
+/// @brief Select the links that can be used for a window
+/// @param link_rain link rain observations in image coordinates
+/// @param window part of the grid
+/// @param halo distance around the window in image coords
+/// @return links within the window and its halo
+std::vector<Observations> select_window_obs(
+    const std::vector<Observations>& link_rain, const MapWindow& window, float halo)
+{
+    std::vector<Observations> window_obs;
+    for (const auto& link : link_rain) {
+        if (link.y >= window.row0 - halo && link.y < window.row0 + window.n_rows + halo
+            && link.x >= window.col0 - halo && link.x < window.col0 + window.n_cols + halo)
+            window_obs.push_back(link);
+    }
+    return window_obs;
+}
+
+/// @brief Shape of the variogram model, from 0 at no distance to 1 at the range
+static double variogram_shape(VariogramModel model, double distance, double range)
+{
+    if (model == VariogramModel::exponential)
+        return 1.0 - std::exp(-3.0 * distance / range);
+    double h = std::min(distance / range, 1.0);
+    return 1.5 * h - 0.5 * h * h * h;
+}
+
+/// @brief Fit a variogram to the link rain at a time step
+/// The pairs of links closer than max_lag are found with a grid of cells max_lag
+/// wide, so the cost depends on the number of close pairs rather than on all N^2
+/// pairs, and the links are visited in a random order until max_pairs pairs have
+/// been found. The pairs are binned by distance and for each of n_ranges ranges
+/// the nugget and sill are found by weighted least squares on the bins, which is
+/// linear once the range is fixed. The range with the smallest error is kept.
+/// @param link_rain link rain observations in image coordinates
+/// @param fit settings for the fit
+/// @param params returns the fitted variogram, unchanged if the fit fails
+/// @return false if there are not enough links or pairs, or no range gives a positive sill
+bool fit_variogram(const std::vector<Observations>& link_rain, const VariogramFitParams& fit,
+    VariogramParams& params)
+{
+    int n = link_rain.size();
+    if (n < fit.min_links || fit.max_lag <= 0 || fit.n_bins < 1)
+        return false;
+
+    // grid of cells at least max_lag wide over the links
+    double x_min = link_rain[0].x, x_max = x_min;
+    double y_min = link_rain[0].y, y_max = y_min;
+    for (const auto& link : link_rain) {
+        x_min = std::min(x_min, link.x);
+        x_max = std::max(x_max, link.x);
+        y_min = std::min(y_min, link.y);
+        y_max = std::max(y_max, link.y);
+    }
+    // the cells are made larger if there would be many more cells than links
+    double cell_size = fit.max_lag;
+    while (((x_max - x_min) / cell_size + 1) * ((y_max - y_min) / cell_size + 1) > 4.0 * n)
+        cell_size *= 2;
+    int n_cols = (int)((x_max - x_min) / cell_size) + 1;
+    int n_rows = (int)((y_max - y_min) / cell_size) + 1;
+    std::vector<int> link_cell(n);
+    std::vector<std::vector<int>> cells((size_t)n_rows * n_cols);
+    for (int ia = 0; ia < n; ++ia) {
+        int col = (int)((link_rain[ia].x - x_min) / cell_size);
+        int row = (int)((link_rain[ia].y - y_min) / cell_size);
+        link_cell[ia] = row * n_cols + col;
+        cells[link_cell[ia]].push_back(ia);
+    }
+
+    // bin the pairs in the neighbouring cells, each pair once
+    double bin_width = fit.max_lag / fit.n_bins;
+    std::vector<long> count(fit.n_bins, 0);
+    std::vector<double> sum_distance(fit.n_bins, 0.0);
+    std::vector<double> sum_gamma(fit.n_bins, 0.0);
+    std::vector<int> order(n);
+    std::iota(order.begin(), order.end(), 0);
+    std::mt19937 gen(fit.seed);
+    std::shuffle(order.begin(), order.end(), gen);
+
+    long n_pairs = 0;
+    for (int ia : order) {
+        const Observations& obs = link_rain[ia];
+        int row = link_cell[ia] / n_cols;
+        int col = link_cell[ia] % n_cols;
+        for (int r = std::max(row - 1, 0); r <= std::min(row + 1, n_rows - 1); ++r) {
+            for (int c = std::max(col - 1, 0); c <= std::min(col + 1, n_cols - 1); ++c) {
+                for (int ib : cells[r * n_cols + c]) {
+                    if (ib <= ia)
+                        continue;
+                    double distance = std::hypot(link_rain[ib].x - obs.x, link_rain[ib].y - obs.y);
+                    if (distance >= fit.max_lag)
+                        continue;
+                    int bin = std::min((int)(distance / bin_width), fit.n_bins - 1);
+                    double diff = link_rain[ib].value - obs.value;
+                    count[bin]++;
+                    sum_distance[bin] += distance;
+                    sum_gamma[bin] += 0.5 * diff * diff;
+                    n_pairs++;
+                }
+            }
+        }
+        if (n_pairs >= fit.max_pairs)
+            break;
+    }
+
+    // experimental variogram, weighted by the number of pairs in each bin
+    std::vector<double> lag, gamma, weight;
+    for (int bin = 0; bin < fit.n_bins; ++bin) {
+        if (count[bin] < fit.min_bin_pairs)
+            continue;
+        lag.push_back(sum_distance[bin] / count[bin]);
+        gamma.push_back(sum_gamma[bin] / count[bin]);
+        weight.push_back(count[bin]);
+    }
+    if ((int)lag.size() < fit.min_bins)
+        return false;
+
+    // for a fixed range the model is linear in the nugget and sill
+    bool found = false;
+    double best_error = 0;
+    for (int ir = 0; ir < fit.n_ranges; ++ir) {
+        double range = bin_width + (2.0 * fit.max_lag - bin_width) * ir / std::max(fit.n_ranges - 1, 1);
+        double sw = 0, sf = 0, sg = 0, sff = 0, sfg = 0;
+        for (size_t ib = 0; ib < lag.size(); ++ib) {
+            double f = variogram_shape(fit.model, lag[ib], range);
+            sw += weight[ib];
+            sf += weight[ib] * f;
+            sg += weight[ib] * gamma[ib];
+            sff += weight[ib] * f * f;
+            sfg += weight[ib] * f * gamma[ib];
+        }
+        double det = sw * sff - sf * sf;
+        if (det <= 0)
+            continue;
+        double nugget = (sff * sg - sf * sfg) / det;
+        double sill = (sw * sfg - sf * sg) / det;
+        if (nugget < 0) {
+            // refit through the origin
+            nugget = 0;
+            sill = sfg / sff;
+        }
+        if (sill <= 0)
+            continue;
+
+        double error = 0;
+        for (size_t ib = 0; ib < lag.size(); ++ib) {
+            double residual = nugget + sill * variogram_shape(fit.model, lag[ib], range) - gamma[ib];
+            error += weight[ib] * residual * residual;
+        }
+        if (!found || error < best_error) {
+            found = true;
+            best_error = error;
+            params = { fit.model, range, sill, nugget };
+        }
+    }
+    return found;
+}
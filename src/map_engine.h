@@ -0,0 +1,211 @@
+#ifndef MAP_ENGINE_H
+#define MAP_ENGINE_H
+// Interpolation of the link rain onto the grid
+// Only depends on Eigen so that the kernels can be used without the database
+#include <Eigen/Dense>
+#include <algorithm>
+#include <cmath>
+#include <vector>
+
+/// @brief Structure with link rain data
+struct Observations {
+    double value;
+    double x;
+    double y;
+};
+
+/// @brief Part of the grid, in image coords
+struct MapWindow {
+    int row0;
+    int col0;
+    int n_rows;
+    int n_cols;
+};
+
+/// @brief Parameters for the search for links around each box
+struct InterpParams {
+    int n_rows; // size of the full grid
+    int n_cols;
+    int box_step = 5; // needs to be an odd number
+    float range = 20; // distance in image coords
+    int min_number_locals = 10;
+    float max_value = 200; // larger values are set to NaN
+    float min_value = 0.5; // smaller values are set to 0
+};
+
+/// @brief Counts and timings (ms) from the interpolation of a map or window
+struct InterpStats {
+    long boxes = 0; // boxes interpolated
+    long boxes_nan = 0; // boxes filled with NaN because there were not enough links
+    long pixels = 0;
+    long pixels_nan = 0;
+    long kriging_systems = 0; // kriging systems built
+    long kriging_size_sum = 0; // sum of the number of links in the systems
+    int kriging_size_max = 0;
+    double select_ms = 0; // selecting the links around each box
+    double kernel_ms = 0; // weights and values for the pixels
+    double build_ms = 0; // building the kriging systems
+    double fit_ms = 0; // fitting the variogram
+    long variogram_fits = 0;
+    long variogram_fallbacks = 0; // fits that failed, the previous parameters were used
+
+    void merge(const InterpStats& other)
+    {
+        boxes += other.boxes;
+        boxes_nan += other.boxes_nan;
+        pixels += other.pixels;
+        pixels_nan += other.pixels_nan;
+        kriging_systems += other.kriging_systems;
+        kriging_size_sum += other.kriging_size_sum;
+        kriging_size_max = std::max(kriging_size_max, other.kriging_size_max);
+        select_ms += other.select_ms;
+        kernel_ms += other.kernel_ms;
+        build_ms += other.build_ms;
+        fit_ms += other.fit_ms;
+        variogram_fits += other.variogram_fits;
+        variogram_fallbacks += other.variogram_fallbacks;
+    }
+};
+
+/// @brief Links as contiguous float arrays so that the kernels can be vectorised
+struct ObsArrays {
+    Eigen::ArrayXf x;
+    Eigen::ArrayXf y;
+    Eigen::ArrayXf value;
+    Eigen::ArrayXi link; // index of each link in the observations
+
+    Eigen::Index size() const { return x.size(); }
+};
+
+enum class VariogramModel { spherical, exponential };
+
+/// @brief Variogram model and parameters, the range is in image coords
+struct VariogramParams {
+    VariogramModel model = VariogramModel::spherical;
+    double range = 10;
+    double sill = 15;
+    double nugget = 1;
+};
+
+/// @brief Settings for fitting the variogram to the links at a time step
+struct VariogramFitParams {
+    VariogramModel model = VariogramModel::spherical;
+    double max_lag = 40; // longest distance between links in the fit, image coords
+    int n_bins = 15; // distance bins out to max_lag
+    long max_pairs = 50000; // pairs of links used in the fit
+    int min_links = 30; // fewer links than this and the fit is not done
+    int min_bin_pairs = 20; // bins with fewer pairs are not used
+    int min_bins = 4; // fewer usable bins than this and the fit fails
+    int n_ranges = 40; // ranges tried between one bin and 2 * max_lag
+    unsigned int seed = 0; // seed for the order that the links are sampled
+};
+
+class Kriging {
+public:
+    Eigen::MatrixXd buildGammaMatrix(const std::vector<Observations>& observations)
+    {
+        int n = observations.size();
+        Eigen::ArrayXd x(n), y(n);
+        for (int i = 0; i < n; ++i) {
+            x(i) = observations[i].x;
+            y(i) = observations[i].y;
+        }
+        return buildGammaMatrix(x, y);
+    }
+
+    /// @brief Kriging matrix with the variogram between each pair of links
+    /// The coordinates are in double as the matrix can be badly conditioned
+    /// @param x link x in image coords
+    /// @param y link y in image coords
+    Eigen::MatrixXd buildGammaMatrix(const Eigen::ArrayXd& x, const Eigen::ArrayXd& y) const
+    {
+        int n = x.size();
+        Eigen::MatrixXd gamma(n + 1, n + 1);
+        for (int j = 0; j < n; ++j)
+            gamma.col(j).head(n) = variogram(((x - x(j)).square() + (y - y(j)).square()).sqrt());
+        gamma.col(n).setOnes();
+        gamma.row(n).setOnes();
+        gamma(n, n) = 0.0; // Lagrange multiplier
+        return gamma;
+    }
+
+    Eigen::VectorXd solveWeights(const Eigen::MatrixXd& gamma, const Eigen::VectorXd& values)
+    {
+        Eigen::VectorXd rhs(values.size() + 1);
+        rhs.head(values.size()) = values;
+        rhs(values.size()) = 1.0; // Constraint for weights to sum to 1
+
+        // Solve gamma * weights = rhs
+        Eigen::VectorXd weights = gamma.ldlt().solve(rhs);
+        return weights;
+    }
+
+    /// @brief Solve for the weights of many pixels with one factorisation of the kriging matrix
+    /// @param factor LDLT factorisation of the matrix from buildGammaMatrix
+    /// @param values variogram from each link (rows) to each pixel (columns)
+    /// @return weights for each link (rows) and pixel (columns), the last row is the Lagrange multiplier
+    Eigen::MatrixXd solveBoxWeights(
+        const Eigen::LDLT<Eigen::MatrixXd>& factor, const Eigen::MatrixXd& values) const
+    {
+        Eigen::MatrixXd rhs(values.rows() + 1, values.cols());
+        rhs.topRows(values.rows()) = values;
+        rhs.row(values.rows()).setOnes(); // Constraint for weights to sum to 1
+        return factor.solve(rhs);
+    }
+
+    double variogram(double distance)
+    {
+        if (distance < 1.0)
+            return _nugget;
+        if (_model == VariogramModel::exponential)
+            return _nugget + _sill * (1.0 - std::exp(-3.0 * distance / _range));
+        if (distance > _range)
+            return _nugget + _sill;
+        return _nugget + _sill * (1.5 * distance / _range - 0.5 * std::pow(distance / _range, 3));
+    }
+
+    /// @brief Variogram for an array of distances
+    template <typename Derived>
+    typename Derived::PlainObject variogram(const Eigen::ArrayBase<Derived>& distance) const
+    {
+        using Scalar = typename Derived::Scalar;
+        typename Derived::PlainObject d = distance;
+        if (_model == VariogramModel::exponential) {
+            return (d < Scalar(1)).select(Scalar(_nugget),
+                Scalar(_nugget) + Scalar(_sill) * (Scalar(1) - (Scalar(-3.0 / _range) * d).exp()));
+        }
+        auto h = (d / Scalar(_range)).min(Scalar(1));
+        return (d < Scalar(1))
+            .select(Scalar(_nugget), Scalar(_nugget) + Scalar(_sill) * (Scalar(1.5) * h - Scalar(0.5) * h.cube()));
+    }
+
+    void set_params(double range, double sill, double nugget) {
+        _range = range;
+        _sill = sill;
+        _nugget = nugget;
+    }
+
+    void set_params(const VariogramParams& params)
+    {
+        set_params(params.range, params.sill, params.nugget);
+        _model = params.model;
+    }
+
+private:
+    double _range; // pixel units
+    double _sill;
+    double _nugget;
+    VariogramModel _model = VariogramModel::spherical;
+};
+
+Eigen::MatrixXf interp_idw(const std::vector<Observations>& link_rain, const InterpParams& params,
+    const MapWindow& window, InterpStats* stats = nullptr);
+Eigen::MatrixXf interp_ok(const std::vector<Observations>& link_rain, const InterpParams& params,
+    const MapWindow& window, Kriging& krig, InterpStats* stats = nullptr);
+bool fit_variogram(const std::vector<Observations>& link_rain, const VariogramFitParams& fit,
+    VariogramParams& params);
+std::vector<MapWindow> make_tiles(int n_rows, int n_cols, int tile_rows, int tile_cols);
+std::vector<Observations> select_window_obs(
+    const std::vector<Observations>& link_rain, const MapWindow& window, float halo);
+
+#endif // MAP_ENGINE_H